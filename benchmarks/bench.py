@@ -0,0 +1,197 @@
+"""Benchmarks for parsing and diffing at realistic and extreme sizes
+
+Generates synthetic docker inspect and uci show output, runs the parsing
+and reconcile code against it with every subprocess call stubbed through
+the doTest/testRunReturn hooks, and prints the timings as json.
+
+    PYTHONPATH=src python benchmarks/bench.py --output bench.json
+    PYTHONPATH=src python benchmarks/bench.py --compare bench.json
+"""
+from subprocess import CompletedProcess
+import argparse
+import contextlib
+import io
+import json
+import platform
+import sys
+import time
+
+from typing import Any, Callable, Dict, List, Optional
+
+from bpe_docker_to_openwrt.__about__ import __version__
+from bpe_docker_to_openwrt.ContainerRecord import ContainerRecord
+from bpe_docker_to_openwrt.NamingRules import COMPOSE_PROJECT_LABEL, COMPOSE_SERVICE_LABEL, HOSTNAME_LABEL, NamingRules
+from bpe_docker_to_openwrt.RouterObject import RouterObject
+from bpe_docker_to_openwrt.main import getContainerIPs, reconcile
+
+DEFAULT_SIZES = [10, 1000, 10000, 100000]
+DOMAIN = "docker.lan"
+
+
+def ipFor(i: int, net: int = 18) -> str:
+    return f"172.{net}.{(i // 256) % 256}.{i % 256}"
+
+
+def dockerInspectOutput(count: int) -> str:
+    """What 'docker ps -q | xargs docker inspect --format ...' prints for count containers"""
+    lines = []
+    for i in range(count):
+        if i % 10 == 0:
+            # Some containers sit on two networks
+            lines.append(f"app_{i}.svc {ipFor(i)} {ipFor(i, 19)}")
+        else:
+            lines.append(f"app_{i} {ipFor(i)}")
+    return "\n".join(lines) + "\n"
+
+
+def containerRecords(count: int) -> List[ContainerRecord]:
+    """Containers as the engine API lists them, half from compose and a few with a hostname label"""
+    records = []
+    for i in range(count):
+        labels: Dict[str, str] = {}
+        if i % 2 == 0:
+            labels = {COMPOSE_PROJECT_LABEL: f"Stack_{i % 7}", COMPOSE_SERVICE_LABEL: f"svc_{i}"}
+        if i % 50 == 0:
+            labels[HOSTNAME_LABEL] = f"Pinned.{i}"
+        records.append(ContainerRecord(name=f"app_{i}:v1@x", networks={"bridge": [ipFor(i)]}, labels=labels))
+    return records
+
+
+def uciDefinitions(count: int) -> List[str]:
+    return [f"'/app-{i}.{DOMAIN}/{ipFor(i)}'" for i in range(count)]
+
+
+def uciShowOutput(count: int) -> str:
+    return "dhcp.cfg01411c.address=" + " ".join(uciDefinitions(count)) + "\n"
+
+
+def desiredState(count: int) -> Dict[str, str]:
+    """The router's mappings with 10% of containers moved, 1% gone and 1% new"""
+    desired: Dict[str, str] = {}
+    for i in range(count):
+        if i % 100 == 1:
+            continue
+        desired[f"app-{i}.{DOMAIN}"] = ipFor(i, 20) if i % 10 == 0 else ipFor(i)
+    for i in range(0, count, 100):
+        desired[f"new-{i}.{DOMAIN}"] = ipFor(i, 21)
+    return desired
+
+
+class CannedRouter(RouterObject):
+    """RouterObject whose ssh calls answer from canned output via the doTest hook"""
+
+    def __init__(self, showOutput: str):
+        super().__init__("bench.invalid", cmdname="ssh")
+        self._showOutput = showOutput
+
+    def doSSHcmd(self, cmd, doTest=False, testRunReturn=None, inputText=None):
+        if cmd == self._cmd_showDns:
+            canned = CompletedProcess(args=[], returncode=0, stdout=self._showOutput, stderr="-")
+        else:
+            # Every command of a batch script succeeds
+            count = (inputText or "").count("\n")
+            canned = CompletedProcess(args=[], returncode=0, stdout="".join(f"{self._batchMarker}:{i}:0\n" for i in range(count)), stderr="-")
+        return super().doSSHcmd(cmd, doTest=True, testRunReturn=canned, inputText=inputText)
+
+
+def timeit(func: Callable[[], Any], repeat: int) -> float:
+    """Best of repeat runs, in seconds"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def benchSize(count: int, repeat: int) -> List[Dict[str, Any]]:
+    results: List[Dict[str, Any]] = []
+
+    def record(name: str, seconds: float, items: int):
+        results.append({"benchmark": name, "size": count, "seconds": seconds, "perItemMicroseconds": seconds / max(items, 1) * 1e6})
+
+    inspect = CompletedProcess(args=[], returncode=0, stdout=dockerInspectOutput(count))
+    record("getContainerIPs", timeit(lambda: getContainerIPs(doTest=True, testRunReturn=inspect), repeat), count)
+
+    records = containerRecords(count)
+    rules = NamingRules(composeTemplate="{service}-{project}", rfc1123=True)
+    record("namingRules", timeit(lambda: rules.assign(records), repeat), count)
+
+    definitions = uciDefinitions(count)
+    show = CompletedProcess(args=[], returncode=0, stdout=uciShowOutput(count))
+    router = RouterObject("bench.invalid", cmdname="ssh")
+    record("getDefinedExtraDNS", timeit(lambda: router.getDefinedExtraDNS(doTest=True, testRunReturn=show), repeat), count)
+    # A router with nothing loaded has to parse the list given to it
+    empty = RouterObject("bench.invalid", cmdname="ssh")
+    record("mappingsFromDefinitions", timeit(lambda: empty.mappingsFromDefinitions(definitions), repeat), count)
+
+    lookups = [f"app-{i}.{DOMAIN}" for i in range(0, count, max(1, count // 1000))]
+    lookups.append(f"missing.{DOMAIN}")
+    record("findDefinitionWithDNS", timeit(lambda: [router.findDefinitionWithDNS(name) for name in lookups], repeat), len(lookups))
+
+    desired = desiredState(count)
+    showText = uciShowOutput(count)
+
+    def fullReconcile():
+        reconcile(CannedRouter(showText), desired, [DOMAIN])
+    record("reconcile", timeit(fullReconcile, repeat), count)
+
+    return results
+
+
+def runBenchmarks(sizes: List[int], repeat: int) -> Dict[str, Any]:
+    results: List[Dict[str, Any]] = []
+    # reconcile reports each change, and the stubs log every command
+    with contextlib.redirect_stdout(io.StringIO()):
+        for count in sizes:
+            results.extend(benchSize(count, repeat))
+    return {
+        "version": __version__,
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "machine": platform.machine(),
+        "timestamp": time.time(),
+        "repeat": repeat,
+        "results": results,
+    }
+
+
+def compare(old: Dict[str, Any], new: Dict[str, Any], threshold: float) -> List[str]:
+    """Benchmarks that got slower than threshold times their old time"""
+    before = {(r["benchmark"], r["size"]): r["seconds"] for r in old.get("results", [])}
+    regressions = []
+    for r in new["results"]:
+        previous = before.get((r["benchmark"], r["size"]))
+        if previous is not None and previous > 0 and r["seconds"] > previous * threshold:
+            regressions.append(f"{r['benchmark']} at {r['size']}: {previous:.6f}s -> {r['seconds']:.6f}s")
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Time parsing and diffing on synthetic data")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="Entry counts to run (default: %(default)s)")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per benchmark, the best is kept (default: %(default)s)")
+    parser.add_argument("--output", default=None, help="Write the json here instead of stdout")
+    parser.add_argument("--compare", default=None, help="Earlier json output to check for regressions")
+    parser.add_argument("--threshold", type=float, default=1.5, help="Slowdown factor counted as a regression (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    report = runBenchmarks(args.sizes, args.repeat)
+    text = json.dumps(report, indent=2)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.compare is not None:
+        with open(args.compare, "r") as f:
+            regressions = compare(json.load(f), report, args.threshold)
+        for line in regressions:
+            sys.stderr.write(f"REGRESSION: {line}\n")
+        return 1 if len(regressions) > 0 else 0
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
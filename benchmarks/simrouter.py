@@ -0,0 +1,548 @@
+"""A simulated OpenWrt router for end-to-end load and latency tests
+
+Stands in for ssh, uci, service, killall and the docker cli. Each router is
+a directory holding a uci dhcp config (etc/config/dhcp) and its uncommitted
+changes (tmp/.uci/dhcp). What is sent "over ssh" runs in a real shell with
+/etc/config and /tmp mapped into that directory, so batch scripts,
+fingerprints, reverts and hosts file uploads behave as they do on a router.
+Handshake cost, per-command latency and failures can be injected.
+
+    PYTHONPATH=src python benchmarks/simrouter.py --records 10000 --latency 0.02 --handshake 0.3
+    PYTHONPATH=src python benchmarks/simrouter.py --records 10000 -- --hosts-file
+
+Times main.main() against a simulated router and docker, and prints the
+timings and what the router saw as json. Arguments after -- go to main.
+"""
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+import argparse
+import contextlib
+import fnmatch
+import json
+import os
+import pathlib
+import re
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+
+THIS = str(pathlib.Path(__file__).resolve())
+
+# ssh options that take a value
+SSH_VALUE_OPTIONS = {"-b", "-c", "-D", "-E", "-e", "-F", "-I", "-i", "-J", "-L", "-l", "-m", "-O", "-o", "-p", "-Q", "-R", "-S", "-W", "-w"}
+
+re_router_path = re.compile(r"(?<![\w.-])/(etc/config/|tmp/)")
+
+UCI_WRAPPER = r'''#!/bin/sh
+# List edits are most of the traffic, so they are appended in shell; the rest goes to python
+[ "$1" = "-q" ] && shift
+case "$1" in
+add_list|del_list)
+    [ -n "$BPE_SIM_UCI_LATENCY" ] && sleep "$BPE_SIM_UCI_LATENCY"
+    case "uci $*" in $BPE_SIM_FAIL) echo "uci: I/O error (injected)" >&2; exit 1;; esac
+    mkdir -p "$BPE_SIM_HOST/tmp/.uci"
+    printf '%s\n' "$*" >> "$BPE_SIM_HOST/tmp/.uci/dhcp"
+    exit 0;;
+esac
+exec {python} {this} --tool uci "$@"
+'''
+
+SERVICE_WRAPPER = r'''#!/bin/sh
+[ -n "$BPE_SIM_RELOAD_LATENCY" ] && sleep "$BPE_SIM_RELOAD_LATENCY"
+case "service $*" in $BPE_SIM_FAIL) echo "service: $* failed (injected)" >&2; exit 1;; esac
+echo "$*" >> "$BPE_SIM_HOST/reloads"
+'''
+
+KILLALL_WRAPPER = r'''#!/bin/sh
+echo "$*" >> "$BPE_SIM_HOST/signals"
+'''
+
+TOOL_WRAPPER = '''#!/bin/sh
+exec {python} {this} --tool {tool} "$@"
+'''
+
+
+def uciQuote(value: str) -> str:
+    return "'" + value.replace("'", "'\\''") + "'"
+
+
+# ------------------
+# --- uci config ---
+# ------------------
+class SimSection:
+    def __init__(self, type: str, name: str):
+        self.type = type
+        self.name = name
+        self.options: Dict[str, str] = {}
+        self.lists: Dict[str, List[str]] = {}
+
+
+def loadConfig(path: pathlib.Path) -> List[SimSection]:
+    """Read a config in 'uci export' format"""
+    sections: List[SimSection] = []
+    if not path.exists():
+        return sections
+    for line in path.read_text().splitlines():
+        words = shlex.split(line)
+        if len(words) == 0:
+            continue
+        if words[0] == "config":
+            sections.append(SimSection(words[1], words[2] if len(words) > 2 else f"cfg{len(sections):06x}"))
+        elif words[0] == "option" and len(sections) > 0:
+            sections[-1].options[words[1]] = words[2]
+        elif words[0] == "list" and len(sections) > 0:
+            sections[-1].lists.setdefault(words[1], []).append(words[2])
+    return sections
+
+
+def renderExport(package: str, sections: List[SimSection]) -> str:
+    lines = [f"package {package}", ""]
+    for section in sections:
+        lines.append(f"config {section.type} {uciQuote(section.name)}")
+        lines.extend(f"\toption {key} {uciQuote(value)}" for key, value in section.options.items())
+        lines.extend(f"\tlist {key} {uciQuote(value)}" for key, values in section.lists.items() for value in values)
+        lines.append("")
+    return "\n".join(lines) + "\n"
+
+
+def renderShow(package: str, sections: List[SimSection]) -> str:
+    lines = []
+    for section in sections:
+        lines.append(f"{package}.{section.name}={section.type}")
+        lines.extend(f"{package}.{section.name}.{key}={uciQuote(value)}" for key, value in section.options.items())
+        lines.extend(f"{package}.{section.name}.{key}=" + " ".join(uciQuote(v) for v in values) for key, values in section.lists.items())
+    return "\n".join(lines) + ("\n" if len(lines) > 0 else "")
+
+
+def findSection(sections: List[SimSection], ref: str) -> Optional[SimSection]:
+    """A section by name or by '@type[index]'"""
+    match = re.fullmatch(r"@([^\[\]]+)\[(-?\d+)\]", ref)
+    if match is None:
+        return next((section for section in sections if section.name == ref), None)
+    ofType = [section for section in sections if section.type == match.group(1)]
+    try:
+        return ofType[int(match.group(2))]
+    except IndexError:
+        return None
+
+
+def applyChange(sections: List[SimSection], change: str):
+    """Apply one staged change ('add_list dhcp.@dnsmasq[0].address=VALUE' and the like)
+
+    Raises:
+        ValueError: If it names a section that does not exist
+    """
+    op, _, rest = change.partition(" ")
+    key, _, value = rest.partition("=")
+    package, _, sectionOption = key.partition(".")
+    ref, _, option = sectionOption.partition(".")
+    section = findSection(sections, ref)
+    if section is None:
+        raise ValueError(f"Entry not found: {key}")
+    if op == "add_list":
+        section.lists.setdefault(option, []).append(value)
+    elif op == "del_list":
+        values = section.lists.get(option, [])
+        section.lists[option] = [v for v in values if v != value]
+    elif op == "delete":
+        section.options.pop(option, None)
+        section.lists.pop(option, None)
+    elif op == "set":
+        section.options[option] = value
+
+
+class SimUci:
+    """The uci command for one simulated router"""
+
+    def __init__(self, hostRoot: pathlib.Path):
+        self.configPath = hostRoot / "etc" / "config" / "dhcp"
+        self.changesPath = hostRoot / "tmp" / ".uci" / "dhcp"
+        self.commitsPath = hostRoot / "commits"
+
+    def changes(self) -> List[str]:
+        if not self.changesPath.exists():
+            return []
+        return [line for line in self.changesPath.read_text().splitlines() if len(line) > 0]
+
+    def current(self) -> List[SimSection]:
+        """The config with the uncommitted changes applied, as uci shows it"""
+        sections = loadConfig(self.configPath)
+        for change in self.changes():
+            try:
+                applyChange(sections, change)
+            except ValueError:
+                pass
+        return sections
+
+    def stage(self, change: str):
+        self.changesPath.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.changesPath, "a") as f:
+            f.write(change + "\n")
+
+    def run(self, args: List[str], stdin: Iterator[str]) -> Tuple[int, str, str]:
+        """(exit status, stdout, stderr) of 'uci args...'"""
+        args = [arg for arg in args if arg != "-q"]
+        if len(args) == 0:
+            return 1, "", "Usage: uci [<options>] <command> [<arguments>]\n"
+        pattern = os.environ.get("BPE_SIM_FAIL", "")
+        if len(pattern) > 0 and fnmatch.fnmatchcase("uci " + " ".join(args), pattern):
+            return 1, "", "uci: I/O error (injected)\n"
+        latency = float(os.environ.get("BPE_SIM_UCI_LATENCY") or 0)
+        if latency > 0:
+            time.sleep(latency)
+
+        command = args[0]
+        if command == "batch":
+            out: List[str] = []
+            for line in stdin:
+                words = shlex.split(line)
+                if len(words) == 0:
+                    continue
+                rc, stdout, stderr = self.run(words, iter(()))
+                out.append(stdout)
+                if rc != 0:
+                    return rc, "".join(out), stderr
+            return 0, "".join(out), ""
+        if command in ("export", "show"):
+            if len(args) > 1 and args[1].partition(".")[0] != "dhcp":
+                return 1, "", "uci: Entry not found\n"
+            sections = self.current()
+            if command == "export":
+                return 0, renderExport("dhcp", sections), ""
+            text = renderShow("dhcp", sections)
+            if len(args) > 1 and "." in args[1]:
+                prefix = args[1]
+                text = "".join(line + "\n" for line in text.splitlines() if line.startswith(prefix + "=") or line.startswith(prefix + "."))
+                if len(text) == 0:
+                    return 1, "", "uci: Entry not found\n"
+            return 0, text, ""
+        if command in ("add_list", "del_list", "set", "delete") and len(args) > 1:
+            self.stage(f"{command} {args[1]}")
+            return 0, "", ""
+        if command == "commit":
+            sections = loadConfig(self.configPath)
+            for change in self.changes():
+                try:
+                    applyChange(sections, change)
+                except ValueError as e:
+                    return 1, "", f"uci: {e}\n"
+            tmpname = self.configPath.with_name(".dhcp.tmp")
+            tmpname.write_text(renderExport("dhcp", sections))
+            os.replace(tmpname, self.configPath)
+            self.changesPath.unlink(missing_ok=True)
+            with open(self.commitsPath, "a") as f:
+                f.write("dhcp\n")
+            return 0, "", ""
+        if command == "revert":
+            self.changesPath.unlink(missing_ok=True)
+            return 0, "", ""
+        if command == "changes":
+            return 0, "".join(change + "\n" for change in self.changes()), ""
+        return 1, "", f"uci: Unsupported command {command}\n"
+
+
+# -------------
+# --- Tools ---
+# -------------
+def toolUci(args: List[str]) -> int:
+    uci = SimUci(pathlib.Path(os.environ["BPE_SIM_HOST"]))
+    rc, stdout, stderr = uci.run(args, iter(sys.stdin) if "batch" in args else iter(()))
+    sys.stdout.write(stdout)
+    sys.stderr.write(stderr)
+    return rc
+
+
+def toolSsh(args: List[str]) -> int:
+    """ssh [options] [user@]host [command...], run on the simulated router named host"""
+    root = pathlib.Path(os.environ["BPE_SIM_ROOT"])
+    controlPath: Optional[str] = None
+    operation: Optional[str] = None
+    master = False
+    destination: Optional[str] = None
+    index = 0
+    # Like OpenSSH, options may come before or after the destination; the first word after both starts the command
+    while index < len(args):
+        option = args[index]
+        if not option.startswith("-"):
+            if destination is not None:
+                break
+            destination = option
+            index += 1
+            continue
+        if option in SSH_VALUE_OPTIONS:
+            value = args[index + 1] if index + 1 < len(args) else ""
+            if option == "-S":
+                controlPath = value
+            elif option == "-O":
+                operation = value
+            index += 2
+            continue
+        master = master or "M" in option
+        index += 1
+    if destination is None:
+        sys.stderr.write("usage: ssh destination [command]\n")
+        return 255
+    host = destination.rpartition("@")[2]
+    command = " ".join(args[index:])
+    hostRoot = root / "routers" / host
+    if not hostRoot.is_dir():
+        sys.stderr.write(f"ssh: Could not resolve hostname {host}: Name or service not known\n")
+        return 255
+
+    if operation is not None:
+        alive = controlPath is not None and os.path.exists(controlPath)
+        if operation == "check":
+            return 0 if alive else 255
+        if operation == "exit" and alive and controlPath is not None:
+            os.remove(controlPath)
+        return 0
+
+    failures = hostRoot / "connect-failures"
+    if failures.exists():
+        left = int(failures.read_text() or 0)
+        if left > 0:
+            failures.write_text(str(left - 1))
+            sys.stderr.write(f"ssh: connect to host {host} port 22: Connection refused\n")
+            return 255
+
+    # A fresh connection pays for the handshake, riding on a live master does not
+    handshake = controlPath is None or not os.path.exists(controlPath)
+    if handshake:
+        time.sleep(float(os.environ.get("BPE_SIM_HANDSHAKE") or 0))
+        if controlPath is not None:
+            pathlib.Path(controlPath).touch()
+    with open(hostRoot / "sessions", "a") as f:
+        f.write(f"{int(handshake)} {command}\n")
+    if master:
+        return 0
+
+    time.sleep(float(os.environ.get("BPE_SIM_LATENCY") or 0))
+    prefix = str(hostRoot)
+
+    def toRouter(text: str) -> str:
+        return re_router_path.sub(lambda m: f"{prefix}/{m.group(1)}", text)
+
+    # A script piped to a remote shell names router paths too
+    readsScript = command.strip() in ("sh", "sh -s")
+    env = dict(os.environ, BPE_SIM_HOST=prefix, PATH=f"{root / 'bin'}{os.pathsep}{os.environ.get('PATH', '')}")
+    result = subprocess.run(["sh", "-c", toRouter(command)], input=toRouter(sys.stdin.read()) if readsScript else None,
+                            capture_output=True, text=True, env=env, cwd=prefix)
+    sys.stdout.write(result.stdout.replace(prefix + "/", "/"))
+    sys.stderr.write(result.stderr.replace(prefix + "/", "/"))
+    return result.returncode
+
+
+def toolDocker(args: List[str]) -> int:
+    """The two docker cli calls the container listing makes: 'ps -q' and 'inspect --format F ID...'"""
+    listing = pathlib.Path(os.environ["BPE_SIM_ROOT"]) / "docker" / "containers"
+    containers: Dict[str, str] = {}
+    if listing.exists():
+        for line in listing.read_text().splitlines():
+            containerId, _, rest = line.partition(" ")
+            containers[containerId] = rest
+    if args[:1] == ["ps"]:
+        sys.stdout.write("".join(containerId + "\n" for containerId in containers))
+        return 0
+    if args[:1] == ["inspect"]:
+        ids = [arg for arg in args[1:] if not arg.startswith("-")]
+        if "--format" in args:
+            ids.remove(args[args.index("--format") + 1])
+        missing = [containerId for containerId in ids if containerId not in containers]
+        sys.stdout.write("".join(containers[containerId] + "\n" for containerId in ids if containerId in containers))
+        if len(missing) > 0:
+            sys.stderr.write(f"Error: No such object: {missing[0]}\n")
+            return 1
+        return 0
+    sys.stderr.write(f"docker: '{' '.join(args)}' is not simulated\n")
+    return 1
+
+
+TOOLS = {"ssh": toolSsh, "uci": toolUci, "docker": toolDocker}
+
+
+# ------------------
+# --- Simulation ---
+# ------------------
+class Simulation:
+    """A directory of simulated routers and one docker engine, with the tools to reach them
+
+    Put bin/ first on PATH (see env() and activated()) and the code under
+    test finds the simulated ssh and docker instead of the real ones.
+    """
+
+    def __init__(self, root: str | pathlib.Path, handshake: float = 0.0, latency: float = 0.0,
+                 uciLatency: float = 0.0, reloadLatency: float = 0.0, fail: Optional[str] = None):
+        """
+        Args:
+            handshake: Seconds an ssh connection takes to set up, not paid when riding on a master connection
+            latency: Seconds added to every ssh command (the round trip)
+            uciLatency: Seconds every uci call takes on the router
+            reloadLatency: Seconds 'service dnsmasq reload' takes
+            fail: Glob matched against every uci and service command line ('uci commit*'), which fail if it matches
+        """
+        self.root = pathlib.Path(root)
+        self.settings = {"BPE_SIM_HANDSHAKE": handshake, "BPE_SIM_LATENCY": latency,
+                         "BPE_SIM_UCI_LATENCY": uciLatency, "BPE_SIM_RELOAD_LATENCY": reloadLatency}
+        self.fail = fail
+        bindir = self.root / "bin"
+        bindir.mkdir(parents=True, exist_ok=True)
+        python = shlex.quote(sys.executable)
+        this = shlex.quote(THIS)
+        scripts = {
+            "ssh": TOOL_WRAPPER.format(python=python, this=this, tool="ssh"),
+            "docker": TOOL_WRAPPER.format(python=python, this=this, tool="docker"),
+            "uci": UCI_WRAPPER.replace("{python}", python).replace("{this}", this),
+            "service": SERVICE_WRAPPER,
+            "killall": KILLALL_WRAPPER,
+        }
+        for name, text in scripts.items():
+            (bindir / name).write_text(text)
+            (bindir / name).chmod(0o755)
+        (self.root / "docker").mkdir(exist_ok=True)
+
+    def addRouter(self, hostname: str = "openwrt.lan", addresses: Optional[List[str]] = None) -> pathlib.Path:
+        """A router whose dnsmasq section starts out with addresses ('/name/ip' definitions)"""
+        hostRoot = self.root / "routers" / hostname
+        (hostRoot / "etc" / "config").mkdir(parents=True, exist_ok=True)
+        (hostRoot / "tmp" / "hosts").mkdir(parents=True, exist_ok=True)
+        dnsmasq = SimSection("dnsmasq", "cfg01411c")
+        dnsmasq.options.update({"domainneeded": "1", "localise_queries": "1", "local": "/lan/", "domain": "lan"})
+        if addresses:
+            dnsmasq.lists["address"] = list(addresses)
+        lan = SimSection("dhcp", "lan")
+        lan.options.update({"interface": "lan", "start": "100", "limit": "150", "leasetime": "12h"})
+        (hostRoot / "etc" / "config" / "dhcp").write_text(renderExport("dhcp", [dnsmasq, lan]))
+        return hostRoot
+
+    def setContainers(self, containers: Dict[str, str]):
+        """Running containers, name -> ip, as the docker cli will list them"""
+        lines = [f"{index:012x} /{name} bridge={ip}," for index, (name, ip) in enumerate(containers.items())]
+        (self.root / "docker" / "containers").write_text("".join(line + "\n" for line in lines))
+
+    def failConnections(self, hostname: str, count: int):
+        """Make the next count ssh connections to hostname fail as if refused"""
+        (self.root / "routers" / hostname / "connect-failures").write_text(str(count))
+
+    def env(self) -> Dict[str, str]:
+        env = {"BPE_SIM_ROOT": str(self.root), "BPE_SIM_FAIL": self.fail or "",
+               "PATH": f"{self.root / 'bin'}{os.pathsep}{os.environ.get('PATH', '')}",
+               # Nothing listens here, so main falls back to the (simulated) docker cli
+               "DOCKER_HOST": f"unix://{self.root / 'docker' / 'docker.sock'}"}
+        env.update({key: (f"{value:g}" if value > 0 else "") for key, value in self.settings.items()})
+        return env
+
+    @contextlib.contextmanager
+    def activated(self) -> Iterator["Simulation"]:
+        """Point this process's environment at the simulation for the length of the with block"""
+        from bpe_docker_to_openwrt.RouterObject import resolveExecutable
+        saved = {key: os.environ.get(key) for key in self.env()}
+        os.environ.update(self.env())
+        # ssh is looked up once per process, and has to be found on the new PATH
+        resolveExecutable.cache_clear()
+        try:
+            yield self
+        finally:
+            resolveExecutable.cache_clear()
+            for key, value in saved.items():
+                if value is None:
+                    os.environ.pop(key, None)
+                else:
+                    os.environ[key] = value
+
+    @property
+    def ssh(self) -> str:
+        return str(self.root / "bin" / "ssh")
+
+    # -------------------
+    # --- Router view ---
+    # -------------------
+    def uci(self, hostname: str) -> SimUci:
+        return SimUci(self.root / "routers" / hostname)
+
+    def addresses(self, hostname: str = "openwrt.lan") -> List[str]:
+        """The committed address list"""
+        section = findSection(loadConfig(self.uci(hostname).configPath), "@dnsmasq[0]")
+        return list(section.lists.get("address", [])) if section is not None else []
+
+    def pending(self, hostname: str = "openwrt.lan") -> List[str]:
+        """Changes staged with uci but not committed"""
+        return self.uci(hostname).changes()
+
+    def stats(self, hostname: str = "openwrt.lan") -> Dict[str, int]:
+        hostRoot = self.root / "routers" / hostname
+
+        def lines(name: str) -> List[str]:
+            path = hostRoot / name
+            return path.read_text().splitlines() if path.exists() else []
+        sessions = lines("sessions")
+        return {
+            "sessions": len(sessions),
+            "handshakes": len([s for s in sessions if s.startswith("1 ")]),
+            "commits": len(lines("commits")),
+            "reloads": len(lines("reloads")),
+            "signals": len(lines("signals")),
+        }
+
+
+# -----------------
+# --- Load test ---
+# -----------------
+def ipFor(i: int, net: int = 18) -> str:
+    return f"172.{net}.{(i // 256) % 256}.{i % 256}"
+
+
+def runLoad(records: int, containers: Optional[int], mainArgs: List[str], handshake: float, latency: float,
+            uciLatency: float, reloadLatency: float, fail: Optional[str]) -> Dict[str, Any]:
+    """Run main.main() twice against a router holding records addresses: once with changes to make, once without"""
+    from bpe_docker_to_openwrt.main import main
+    if containers is None:
+        containers = records
+    with tempfile.TemporaryDirectory(prefix="bpe-sim-") as root:
+        sim = Simulation(root, handshake=handshake, latency=latency, uciLatency=uciLatency, reloadLatency=reloadLatency, fail=fail)
+        sim.addRouter("openwrt.lan", [f"/app-{i}.docker.lan/{ipFor(i)}" for i in range(records)])
+        # 10% of the containers moved and every hundredth one is new
+        sim.setContainers({f"app_{i}" if i % 100 != 1 else f"new_{i}": ipFor(i, 20) if i % 10 == 0 else ipFor(i) for i in range(containers)})
+
+        args = ["--router", "openwrt.lan", "--domain", "docker.lan", "--no-state-cache", "--identity-file", ""] + mainArgs
+        runs = []
+        with sim.activated(), contextlib.redirect_stdout(sys.stderr):
+            for label in ("changes", "steady"):
+                before = sim.stats()
+                start = time.perf_counter()
+                exitCode = main(args)
+                seconds = time.perf_counter() - start
+                after = sim.stats()
+                runs.append({"run": label, "exitCode": exitCode, "seconds": seconds,
+                             "router": {key: after[key] - before[key] for key in after}})
+        return {"records": records, "containers": containers, "addressesAfter": len(sim.addresses()),
+                "settings": sim.settings, "runs": runs}
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv[:1] == ["--tool"]:
+        return TOOLS[argv[1]](argv[2:])
+
+    mainArgs: List[str] = []
+    if "--" in argv:
+        mainArgs = argv[argv.index("--") + 1:]
+        argv = argv[:argv.index("--")]
+    parser = argparse.ArgumentParser(description="Time a full run of bpe-docker-to-openwrt against a simulated router")
+    parser.add_argument("--records", type=int, default=10000, help="Addresses the router starts with (default: %(default)s)")
+    parser.add_argument("--containers", type=int, default=None, help="Running containers (default: as many as --records)")
+    parser.add_argument("--handshake", type=float, default=0.0, help="Seconds per ssh connection setup")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every ssh command")
+    parser.add_argument("--uci-latency", type=float, default=0.0, help="Seconds per uci call on the router")
+    parser.add_argument("--reload-latency", type=float, default=0.0, help="Seconds per dnsmasq reload")
+    parser.add_argument("--fail", default=None, metavar="GLOB", help="uci or service command lines that fail, e.g. 'uci commit*'")
+    args = parser.parse_args(argv)
+
+    report = runLoad(args.records, args.containers, mainArgs, args.handshake, args.latency, args.uci_latency, args.reload_latency, args.fail)
+    print(json.dumps(report, indent=2))
+    return 0 if all(run["exitCode"] == 0 for run in report["runs"]) else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,20 @@
+import os
+import pathlib
+
+
+def writeAtomic(path: str | pathlib.Path, text: str):
+    """Write text to path then rename it into place, so a reader never sees half a file
+
+    The temporary file is hidden and ends in .tmp, next to path so the
+    rename stays on one filesystem, and is removed again if writing fails.
+    """
+    import tempfile
+    path = pathlib.Path(path).expanduser()
+    fd, tmpname = tempfile.mkstemp(dir=str(path.parent), prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(text)
+        os.replace(tmpname, path)
+    except BaseException:
+        pathlib.Path(tmpname).unlink(missing_ok=True)
+        raise
@@ -0,0 +1,151 @@
+import time
+
+from typing import Callable, Dict, List, Optional, Set, Union
+
+from bpe_docker_to_openwrt.RouterObject import ROUTER_LOCK_HELD, RouterObject, BatchResult
+from bpe_docker_to_openwrt.RouterPool import runOnRouters
+from bpe_docker_to_openwrt.ReconcilePlan import planChanges
+
+
+class ChangeScheduler:
+    """Collect mapping changes and push them to the router in bursts
+
+    Changes are held until nothing new has arrived for quietWindow seconds,
+    or the oldest pending change is maxLatency seconds old, then all of them
+    go out in one batch with a single commit and dnsmasq reload. Only the
+    last requested state of each name is kept, so an add followed by a
+    remove (or the reverse) that leaves the router as it was sends nothing.
+    Given several routers, each gets its own net changes, concurrently.
+    A router with a router lock is locked for its batch like a one-shot run
+    locks it, so the two never send the same change; while another run holds
+    it, its changes wait for the next flush.
+    """
+
+    def __init__(self, router: Union[RouterObject, List[RouterObject]], quietWindow: float = 2.0, maxLatency: float = 10.0,
+                 clock: Callable[[], float] = time.monotonic, maxWorkers: int = 4):
+        self._routers: List[RouterObject] = router if isinstance(router, list) else [router]
+        self._maxWorkers = maxWorkers
+        self._quietWindow = quietWindow
+        self._maxLatency = maxLatency
+        self._clock = clock
+
+        # dns -> wanted ip, None meaning the mapping should go away
+        self._pending: Dict[str, Optional[str]] = {}
+        self._firstChange: Optional[float] = None
+        self._lastChange: Optional[float] = None
+
+        self._received: int = 0
+        self._flushed: int = 0
+        self._reloads: int = 0
+
+    def schedule(self, dns: str, ip: Optional[str]):
+        now = self._clock()
+        self._received += 1
+        self._pending[dns] = ip
+        if self._firstChange is None:
+            self._firstChange = now
+        self._lastChange = now
+
+    def requeue(self, dns: str, ip: Optional[str]):
+        """Hold a change that did not go through again, unless a newer one for dns has come in"""
+        if dns in self._pending:
+            return
+        now = self._clock()
+        self._pending[dns] = ip
+        if self._firstChange is None:
+            self._firstChange = now
+        self._lastChange = now
+
+    def scheduleAdd(self, dns: str, ip: str):
+        self.schedule(dns, ip)
+
+    def scheduleRemove(self, dns: str):
+        self.schedule(dns, None)
+
+    def netChanges(self, router: Optional[RouterObject] = None) -> Dict[str, Optional[str]]:
+        """Pending changes that would actually alter the (first) router"""
+        if router is None:
+            router = self._routers[0]
+        return {dns: ip for dns, ip in self._pending.items() if router.mappedIP(dns) != ip}
+
+    def nextDeadline(self) -> Optional[float]:
+        """Clock time at which the pending changes are due, None if nothing is pending"""
+        if self._firstChange is None or self._lastChange is None:
+            return None
+        return min(self._lastChange + self._quietWindow, self._firstChange + self._maxLatency)
+
+    def due(self) -> bool:
+        deadline = self.nextDeadline()
+        return deadline is not None and self._clock() >= deadline
+
+    def discard(self):
+        self._pending = {}
+        self._firstChange = None
+        self._lastChange = None
+
+    def flush(self) -> int:
+        """Send every pending change now
+
+        Changes a router did not take (its batch failed, was reverted,
+        raised, or another run held its lock) are put back, to go out with
+        the next flush.
+
+        Returns:
+            int: Number of names changed on at least one router
+        """
+        changesPerRouter = {router.Target: self.netChanges(router) for router in self._routers}
+        self.discard()
+        if not any(len(changes) > 0 for changes in changesPerRouter.values()):
+            return 0
+
+        def apply(router: RouterObject) -> Optional[List[BatchResult]]:
+            changes = changesPerRouter[router.Target]
+            if len(changes) == 0:
+                return None
+            if not router.acquireRouterLock():
+                # That run has been asked to go again, and a failed result puts the changes back
+                return [BatchResult("router lock", ROUTER_LOCK_HELD, "held by another run")]
+            try:
+                desired = {dns: ip for dns, ip in changes.items() if ip is not None}
+                plan = planChanges(desired, router.Mappings, scope=changes.keys())
+                return router.applyPlan(plan)
+            finally:
+                router.releaseRouterLock()
+
+        outcomes = runOnRouters(self._routers, apply, self._maxWorkers)
+
+        changed: Set[str] = set()
+        for target, changes in changesPerRouter.items():
+            if len(changes) == 0:
+                continue
+            if outcomes[target].ok:
+                changed.update(changes)
+                self._reloads += 1
+                continue
+            # The router's table was rolled back with it, so netChanges() sees these again
+            for dns, ip in changes.items():
+                self.requeue(dns, ip)
+
+        self._flushed += len(changed)
+        return len(changed)
+
+    def takeRerunRequests(self) -> bool:
+        """True if a run that found one of the routers locked by a flush asked for another pass"""
+        return any([router.takeRerunRequest() for router in self._routers])
+
+    def poll(self) -> int:
+        """Flush if the pending changes are due"""
+        if self.due():
+            return self.flush()
+        return 0
+
+    # ------------------
+    # --- Properties ---
+    # ------------------
+    @property
+    def Pending(self) -> int:
+        return len(self._pending)
+
+    @property
+    def Stats(self) -> Dict[str, int]:
+        return {"received": self._received, "flushed": self._flushed, "reloads": self._reloads}
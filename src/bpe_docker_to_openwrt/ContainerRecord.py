@@ -0,0 +1,20 @@
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple
+
+
+@dataclass
+class ContainerRecord:
+    name: str
+    id: str = ""
+    # network name -> addresses on that network (ipv4 first, then ipv6)
+    networks: Dict[str, List[str]] = field(default_factory=dict)
+    labels: Dict[str, str] = field(default_factory=dict)
+
+    @property
+    def ips(self) -> List[str]:
+        return [ip for addrs in self.networks.values() for ip in addrs]
+
+    @property
+    def addresses(self) -> List[Tuple[str, str, int]]:
+        """(network, ip, address family 4 or 6) for every address"""
+        return [(netname, ip, 6 if ":" in ip else 4) for netname, addrs in self.networks.items() for ip in addrs]
@@ -0,0 +1,224 @@
+from sys import stderr
+from queue import Queue, Empty
+import threading
+import time
+
+from typing import Any, Callable, Dict, Optional
+
+from bpe_docker_to_openwrt.RouterObject import RouterObject
+from bpe_docker_to_openwrt.DockerClient import DockerClient, ContainerRecord
+from bpe_docker_to_openwrt.ChangeScheduler import ChangeScheduler
+from bpe_docker_to_openwrt.NamingRules import NamingRules
+
+
+class ContainerWatcher:
+    """Keep router mappings in step with docker by following the engine's event stream
+
+    Starts with a full reconcile, then only touches the containers named in
+    each event. Changes go through a ChangeScheduler so a burst of events
+    ends in one commit. A full reconcile is repeated every resyncInterval
+    seconds in case an event was missed, or after retryDelay while they fail.
+    """
+
+    eventFilters = {
+        "type": ["container", "network"],
+        "event": ["start", "die", "destroy", "rename", "connect", "disconnect"],
+    }
+
+    def __init__(self, router: RouterObject, client: DockerClient, base_domain: str,
+                 resyncInterval: float = 300.0,
+                 fullResync: Optional[Callable[[], bool]] = None,
+                 nameFilter: Optional[Callable[[str], str]] = None,
+                 retryDelay: float = 5.0,
+                 scheduler: Optional[ChangeScheduler] = None,
+                 naming: Optional[NamingRules] = None):
+        self._router = router
+        self._client = client
+        self._base_domain = base_domain
+        self._resyncInterval = resyncInterval
+        self._fullResync = fullResync
+        self._nameFilter = nameFilter
+        # Takes over from nameFilter when given, so labels can pick the name
+        self._naming = naming
+        self._retryDelay = retryDelay
+        if scheduler is None:
+            scheduler = ChangeScheduler(router)
+        self._scheduler = scheduler
+
+        self._events: "Queue[Any]" = Queue()
+        self._reader: Optional[threading.Thread] = None
+        self._lastEventTime: Optional[float] = None
+        self._stop = threading.Event()
+
+        self._eventsSeen: int = 0
+        self._resyncs: int = 0
+
+    # ---------------
+    # --- Mapping ---
+    # ---------------
+    def hostname(self, containerName: str) -> str:
+        if self._nameFilter is not None:
+            containerName = self._nameFilter(containerName)
+        return f"{containerName}.{self._base_domain}"
+
+    def hostnameFor(self, record: ContainerRecord) -> Optional[str]:
+        if self._naming is None:
+            return self.hostname(record.name)
+        name = self._naming.nameFor(record)
+        return f"{name}.{self._base_domain}" if name is not None else None
+
+    def setMapping(self, dns: str, ip: Optional[str]):
+        """Schedule dns to point at ip (or nowhere if ip is None)"""
+        self._scheduler.schedule(dns, ip)
+
+    def applyRecord(self, record: ContainerRecord):
+        dns = self.hostnameFor(record)
+        if dns is None:
+            return
+        ips = record.ips
+        self.setMapping(dns, ips[0] if len(ips) > 0 else None)
+
+    def handleEvent(self, event: Dict[str, Any]) -> bool:
+        """Schedule the router changes for one engine event
+
+        Returns:
+            bool: True if the event affected a container
+        """
+        kind = event.get("Type")
+        action = event.get("Action", "")
+        actor = event.get("Actor") or {}
+        attributes = actor.get("Attributes") or {}
+
+        if kind == "network":
+            containerId = attributes.get("container")
+        else:
+            containerId = actor.get("ID")
+
+        # Container events carry the container's labels among their attributes
+        if kind == "container" and action in ("die", "destroy"):
+            name = attributes.get("name")
+            dns = self.hostnameFor(ContainerRecord(name=name, labels=attributes)) if name else None
+            if dns is not None:
+                self.setMapping(dns, None)
+                return True
+            return False
+
+        touched = False
+        if kind == "container" and action == "rename":
+            oldName = (attributes.get("oldName") or "").lstrip("/")
+            dns = self.hostnameFor(ContainerRecord(name=oldName, labels=attributes)) if oldName else None
+            if dns is not None:
+                self.setMapping(dns, None)
+                touched = True
+        if containerId:
+            record = self._client.inspectContainer(containerId)
+            if record is not None:
+                self.applyRecord(record)
+                touched = True
+        return touched
+
+    # ---------------
+    # --- Running ---
+    # ---------------
+    def resync(self) -> bool:
+        """Full reconcile. False if it did not fully succeed."""
+        self._resyncs += 1
+        # The full reconcile covers anything still waiting
+        self._scheduler.discard()
+        if self._fullResync is not None:
+            return self._fullResync()
+        return True
+
+    def nextResyncAfter(self, ok: bool) -> float:
+        """When the next full reconcile is due, sooner if the last one failed"""
+        return time.monotonic() + (self._resyncInterval if ok else min(self._retryDelay, self._resyncInterval))
+
+    def startReader(self):
+        since = self._lastEventTime
+
+        def readEvents():
+            try:
+                for event in self._client.events(self.eventFilters, since=since):
+                    self._events.put(event)
+            except Exception as e:
+                self._events.put(e)
+            else:
+                self._events.put(EOFError("docker event stream ended"))
+
+        self._reader = threading.Thread(target=readEvents, name="docker-events", daemon=True)
+        self._reader.start()
+
+    def stop(self):
+        self._stop.set()
+        self._client.closeEvents()
+
+    def run(self, maxEvents: Optional[int] = None):
+        """Watch until stop() is called (or maxEvents events were handled)"""
+        self._stop.clear()
+        # Anything that happens while resyncing is still picked up from the stream
+        self._lastEventTime = time.time()
+        self.startReader()
+        nextResync = self.nextResyncAfter(self.resync())
+
+        while not self._stop.is_set():
+            wakeAt = nextResync
+            flushAt = self._scheduler.nextDeadline()
+            if flushAt is not None:
+                wakeAt = min(wakeAt, flushAt)
+            try:
+                item = self._events.get(timeout=max(0.0, wakeAt - time.monotonic()))
+            except Empty:
+                if self._scheduler.due():
+                    self.flush()
+                    if self._scheduler.takeRerunRequests():
+                        # A run that found a router locked by the flush left its work to us
+                        nextResync = time.monotonic()
+                if time.monotonic() >= nextResync:
+                    nextResync = self.nextResyncAfter(self.resync())
+                continue
+
+            if isinstance(item, Exception):
+                if self._stop.is_set():
+                    break
+                stderr.write(f"WARNING: Lost docker event stream ({item}), reconnecting\n")
+                self._stop.wait(self._retryDelay)
+                self.startReader()
+                # Events may have been missed while disconnected
+                nextResync = self.nextResyncAfter(self.resync())
+                continue
+
+            self._eventsSeen += 1
+            if "time" in item:
+                self._lastEventTime = float(item.get("timeNano", item["time"] * 1e9)) / 1e9
+            try:
+                self.handleEvent(item)
+            except Exception as e:
+                stderr.write(f"ERROR: Could not handle docker event {item.get('Type')}/{item.get('Action')}: {e}\n")
+
+            if maxEvents is not None and self._eventsSeen >= maxEvents:
+                break
+
+        # Don't lose changes that were still waiting out the quiet window
+        self.flush()
+        self._client.closeEvents()
+
+    def flush(self):
+        try:
+            self._scheduler.flush()
+        except Exception as e:
+            stderr.write(f"ERROR: Could not update router: {e}\n")
+
+    # ------------------
+    # --- Properties ---
+    # ------------------
+    @property
+    def EventsSeen(self) -> int:
+        return self._eventsSeen
+
+    @property
+    def Resyncs(self) -> int:
+        return self._resyncs
+
+    @property
+    def Scheduler(self) -> ChangeScheduler:
+        return self._scheduler
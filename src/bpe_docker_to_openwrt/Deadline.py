@@ -0,0 +1,102 @@
+from subprocess import CompletedProcess, Popen, PIPE, TimeoutExpired
+import os
+import random
+import signal
+import time
+
+from typing import Callable, List, Optional
+
+# Seconds a process group gets to exit after SIGTERM before it is killed
+KILL_GRACE = 2.0
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+class Deadline:
+    """A point in time by which the current run has to be done
+
+    Unbounded until started. Each subprocess call asks timeoutFor() for
+    its timeout, which is its own limit cut down to what is left of the run.
+    """
+
+    def __init__(self, seconds: Optional[float] = None, clock: Callable[[], float] = time.monotonic):
+        self._clock = clock
+        self._endsAt: Optional[float] = None
+        self.start(seconds)
+
+    def start(self, seconds: Optional[float]):
+        """Run for at most seconds from now, no limit for None"""
+        self._endsAt = self._clock() + seconds if seconds is not None else None
+
+    def clear(self):
+        self._endsAt = None
+
+    def remaining(self) -> Optional[float]:
+        if self._endsAt is None:
+            return None
+        return max(0.0, self._endsAt - self._clock())
+
+    def expired(self) -> bool:
+        remaining = self.remaining()
+        return remaining is not None and remaining <= 0
+
+    def timeoutFor(self, perCall: Optional[float], what: str = "run") -> Optional[float]:
+        """The timeout for one call: perCall, or less if the run ends sooner
+
+        Raises:
+            DeadlineExceeded: If the run is already out of time
+        """
+        remaining = self.remaining()
+        if remaining is None:
+            return perCall
+        if remaining <= 0:
+            raise DeadlineExceeded(f"Out of time before {what}")
+        return remaining if perCall is None else min(perCall, remaining)
+
+
+# The deadline of the current run, shared by every module and set from the command line
+runDeadline = Deadline()
+
+
+def killGroup(proc: Popen, grace: float = KILL_GRACE):
+    """Stop proc and everything it started: SIGTERM its process group, then SIGKILL after grace
+
+    proc has to have been started with start_new_session=True.
+    """
+    for sig, wait in ((signal.SIGTERM, grace), (signal.SIGKILL, None)):
+        try:
+            os.killpg(proc.pid, sig)
+        except ProcessLookupError:
+            return
+        try:
+            proc.wait(timeout=wait)
+            return
+        except TimeoutExpired:
+            continue
+
+
+def runBounded(args: List[str], inputText: Optional[str] = None, timeout: Optional[float] = None) -> CompletedProcess[str]:
+    """subprocess.run(args, capture_output=True, text=True) in its own process group
+
+    On timeout, or if interrupted, the whole group is stopped, so nothing
+    it started is left behind.
+
+    Raises:
+        TimeoutExpired: If it ran past timeout
+    """
+    proc = Popen(args, stdin=PIPE if inputText is not None else None, stdout=PIPE, stderr=PIPE, text=True, start_new_session=True)
+    try:
+        stdout, errors = proc.communicate(inputText, timeout=timeout)
+    except BaseException:
+        killGroup(proc)
+        # Collect what it wrote and close the pipes
+        proc.communicate()
+        raise
+    return CompletedProcess(args, proc.returncode, stdout, errors)
+
+
+def backoffDelays(retries: int, base: float, cap: float = 30.0) -> List[float]:
+    """Seconds to wait before each retry: doubling from base, capped, with jitter so routers are not hit in step"""
+    return [min(cap, base * (2 ** attempt)) * random.uniform(0.5, 1.0) for attempt in range(retries)]
@@ -0,0 +1,359 @@
+from http.client import HTTPConnection
+from subprocess import Popen, DEVNULL, TimeoutExpired
+from sys import stderr
+from urllib.parse import urlsplit, urlencode
+import json
+import os
+import socket
+
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from bpe_docker_to_openwrt.ContainerRecord import ContainerRecord
+from bpe_docker_to_openwrt.KeepAlive import requestKeepAlive
+
+DEFAULT_DOCKER_HOST = "unix:///var/run/docker.sock"
+
+
+def stripPrefix(address: str) -> str:
+    """'10.0.1.5/24' -> '10.0.1.5', swarm gives task and virtual ips with their prefix length"""
+    return address.partition("/")[0]
+
+
+class DockerError(Exception):
+    def __init__(self, message: str, status: Optional[int] = None):
+        super().__init__(message)
+        self.status = status
+
+
+class UnixHTTPConnection(HTTPConnection):
+    """HTTPConnection that talks to a unix domain socket instead of a tcp port"""
+
+    def __init__(self, socketPath: str, timeout: Optional[float] = None):
+        super().__init__("localhost", timeout=timeout)
+        self._socketPath = socketPath
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self._socketPath)
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+
+
+class SSHDialConnection(HTTPConnection):
+    """HTTPConnection tunnelled to a remote engine through 'ssh host docker system dial-stdio'
+
+    This is what the docker cli does for ssh:// hosts. The ssh process talks
+    to one end of a socketpair, so http.client gets an ordinary socket.
+    """
+
+    def __init__(self, destination: str, port: Optional[int] = None, sshexe: str = "ssh", timeout: Optional[float] = None):
+        super().__init__("localhost", timeout=timeout)
+        self._destination = destination
+        self._sshPort = port
+        self._sshexe = sshexe
+        self._proc: Optional[Popen] = None
+
+    def connect(self):
+        shellcmd = [self._sshexe]
+        if self._sshPort is not None:
+            shellcmd.extend(["-p", str(self._sshPort)])
+        # '--' so the destination can never be read as an option
+        shellcmd.extend(["--", self._destination, "docker", "system", "dial-stdio"])
+
+        ours, theirs = socket.socketpair()
+        try:
+            self._proc = Popen(shellcmd, stdin=theirs, stdout=theirs, stderr=DEVNULL)
+        except OSError:
+            ours.close()
+            raise
+        finally:
+            theirs.close()
+        ours.settimeout(self.timeout)
+        self.sock = ours
+
+    def close(self):
+        super().close()
+        if self._proc is not None:
+            self._proc.terminate()
+            try:
+                self._proc.wait(timeout=5)
+            except TimeoutExpired:
+                self._proc.kill()
+                self._proc.wait()
+            self._proc = None
+
+
+class DockerClient:
+    """Minimal Docker Engine API client
+
+    Talks HTTP straight to the engine (unix socket, tcp, or ssh://) and
+    keeps the connection open between requests.
+    """
+
+    def __init__(self, host: Optional[str] = None, timeout: Optional[float] = 10.0, sshexe: str = "ssh"):
+        if host is None or len(host) == 0:
+            host = os.environ.get("DOCKER_HOST", DEFAULT_DOCKER_HOST)
+        self._host: str = host
+        self._sshexe: str = sshexe
+        self._timeout: Optional[float] = timeout
+        self._conn: Optional[HTTPConnection] = None
+        self._eventsConn: Optional[HTTPConnection] = None
+
+    def newConnection(self) -> HTTPConnection:
+        url = urlsplit(self._host)
+        if url.scheme == "unix":
+            return UnixHTTPConnection(url.path, timeout=self._timeout)
+        if url.scheme in ("tcp", "http"):
+            return HTTPConnection(url.hostname or "localhost", url.port or 2375, timeout=self._timeout)
+        if url.scheme == "ssh":
+            destination = url.hostname or ""
+            if url.username:
+                destination = f"{url.username}@{destination}"
+            return SSHDialConnection(destination, url.port, sshexe=self._sshexe, timeout=self._timeout)
+        if url.scheme == "" and self._host.startswith("/"):
+            # Allow a bare socket path
+            return UnixHTTPConnection(self._host, timeout=self._timeout)
+        raise DockerError(f"Unsupported docker host '{self._host}'")
+
+    def connection(self) -> HTTPConnection:
+        """The kept-alive connection for requests, opened if there is none"""
+        if self._conn is None:
+            self._conn = self.newConnection()
+        return self._conn
+
+    def dropConnection(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def close(self):
+        self.dropConnection()
+        self.closeEvents()
+
+    def closeEvents(self):
+        """Stop a running events() stream, even from another thread"""
+        conn = self._eventsConn
+        self._eventsConn = None
+        if conn is not None and conn.sock is not None:
+            try:
+                conn.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            conn.close()
+
+    def __enter__(self) -> "DockerClient":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def request(self, method: str, path: str, params: Optional[Dict[str, Any]] = None) -> Any:
+        if params:
+            path = f"{path}?{urlencode(params)}"
+
+        response, body = requestKeepAlive(self.connection, self.dropConnection, method, path, headers={"Host": "docker"})
+
+        if response.status >= 400:
+            raise DockerError(f"{method} {path} failed with {response.status}: {body.decode(errors='replace').strip()}", response.status)
+
+        if len(body) == 0:
+            return None
+        return json.loads(body)
+
+    def listContainers(self, all: bool = False) -> List[ContainerRecord]:
+        """Get every running container with its network addresses in one request"""
+        params = {"all": "1"} if all else None
+        records: List[ContainerRecord] = []
+
+        for item in self.request("GET", "/containers/json", params) or []:
+            record = self.containerFromJSON(item)
+            if record is not None:
+                records.append(record)
+
+        return records
+
+    def inspectContainer(self, containerId: str) -> Optional[ContainerRecord]:
+        """Get a single container, or None if it no longer exists"""
+        try:
+            item = self.request("GET", f"/containers/{containerId}/json")
+        except DockerError as e:
+            if e.status == 404:
+                return None
+            raise
+        record = self.containerFromJSON(item)
+        if record is not None and not (item.get("State") or {}).get("Running", True):
+            # Stopped containers keep their network entries but have no live addresses
+            record.networks = {}
+        return record
+
+    def listSwarm(self) -> List[ContainerRecord]:
+        """Every service in the swarm, and every running task, across all nodes
+
+        One request each for services, tasks and nodes, so has to be asked
+        of a manager. See swarmRecordsFromJSON for what the records hold.
+
+        Raises:
+            DockerError: With status 503 if the engine is not a swarm manager
+        """
+        services = self.request("GET", "/services") or []
+        tasks = self.request("GET", "/tasks", {"filters": json.dumps({"desired-state": ["running"]})}) or []
+        nodes = self.request("GET", "/nodes") or []
+        return self.swarmRecordsFromJSON(services, tasks, nodes)
+
+    def events(self, filters: Optional[Dict[str, List[str]]] = None, since: Optional[float] = None, until: Optional[float] = None) -> Iterator[Dict[str, Any]]:
+        """Stream engine events as they happen
+
+        Uses its own connection, since the response never ends unless until is
+        given. closeEvents() interrupts the stream from another thread.
+        """
+        params: Dict[str, str] = {}
+        if filters:
+            params["filters"] = json.dumps(filters)
+        if since is not None:
+            params["since"] = f"{since:.9f}"
+        if until is not None:
+            params["until"] = f"{until:.9f}"
+        path = "/events"
+        if params:
+            path = f"{path}?{urlencode(params)}"
+
+        conn = self.newConnection()
+        # Events can be minutes apart, the read timeout would end the stream
+        conn.timeout = None
+        self._eventsConn = conn
+        try:
+            conn.request("GET", path, headers={"Host": "docker"})
+            response = conn.getresponse()
+            if response.status >= 400:
+                raise DockerError(f"GET {path} failed with {response.status}: {response.read().decode(errors='replace').strip()}", response.status)
+
+            while True:
+                line = response.readline()
+                if len(line) == 0:
+                    break
+                line = line.strip()
+                if len(line) > 0:
+                    yield json.loads(line)
+        finally:
+            if self._eventsConn is conn:
+                self._eventsConn = None
+            conn.close()
+
+    @staticmethod
+    def containerFromJSON(item: Dict[str, Any]) -> Optional[ContainerRecord]:
+        names = item.get("Names") or []
+        if len(names) > 0:
+            name = names[0]
+        else:
+            # /containers/{id}/json uses Name instead of Names
+            name = item.get("Name") or ""
+        name = name.lstrip("/")
+        if len(name) == 0:
+            stderr.write(f"WARNING: Skipping container without a name: {item.get('Id', '')}\n")
+            return None
+
+        networks: Dict[str, List[str]] = {}
+        settings = item.get("NetworkSettings") or {}
+        for netname, net in (settings.get("Networks") or {}).items():
+            addrs = [addr for addr in (net.get("IPAddress"), net.get("GlobalIPv6Address")) if addr]
+            if len(addrs) > 0:
+                networks[netname] = addrs
+
+        labels = item.get("Labels")
+        if labels is None:
+            labels = (item.get("Config") or {}).get("Labels") or {}
+
+        return ContainerRecord(name=name, id=item.get("Id", ""), networks=networks, labels=labels)
+
+    @staticmethod
+    def swarmRecordsFromJSON(services: List[Dict[str, Any]], tasks: List[Dict[str, Any]], nodes: List[Dict[str, Any]]) -> List[ContainerRecord]:
+        """Records for the services with running tasks, each followed by its tasks
+
+        A service publishing ports through the routing mesh gets the address
+        of a node (one running it if there is one), as every node answers on
+        those ports. One publishing in host mode gets the address of a node
+        running it, and any other service its virtual ip. The service's
+        labels go with it, so the hostname label names services.
+
+        Tasks are named SERVICE-SLOT, or SERVICE-NODE for global services,
+        with their overlay addresses. Addresses on the ingress network only
+        carry the routing mesh and are left out.
+        """
+        nodeNames: Dict[str, str] = {}
+        nodeAddrs: Dict[str, str] = {}
+        for node in nodes:
+            nodeId = node.get("ID", "")
+            nodeNames[nodeId] = (node.get("Description") or {}).get("Hostname") or nodeId
+            status = node.get("Status") or {}
+            addr = status.get("Addr") or ""
+            if addr in ("", "0.0.0.0"):
+                # A manager listening on every interface reports 0.0.0.0, its manager address is the one to use
+                addr = ((node.get("ManagerStatus") or {}).get("Addr") or "").rpartition(":")[0]
+            if status.get("State") == "ready" and len(addr) > 0:
+                nodeAddrs[nodeId] = addr
+
+        networkNames: Dict[str, str] = {}
+        running: Dict[str, List[Dict[str, Any]]] = {}
+        for task in tasks:
+            if (task.get("Status") or {}).get("State") != "running":
+                continue
+            running.setdefault(task.get("ServiceID", ""), []).append(task)
+            for attachment in task.get("NetworksAttachments") or []:
+                network = attachment.get("Network") or {}
+                networkNames[network.get("ID", "")] = (network.get("Spec") or {}).get("Name") or network.get("ID", "")
+
+        records: List[ContainerRecord] = []
+        for service in services:
+            spec = service.get("Spec") or {}
+            name = spec.get("Name") or ""
+            serviceTasks = running.get(service.get("ID", ""), [])
+            if len(name) == 0 or len(serviceTasks) == 0:
+                continue
+
+            def order(task: Dict[str, Any]) -> Tuple[int, str]:
+                return (task.get("Slot") or 0, nodeNames.get(task.get("NodeID", ""), ""))
+            serviceTasks.sort(key=order)
+            taskRecords: List[ContainerRecord] = []
+            for task in serviceTasks:
+                networks: Dict[str, List[str]] = {}
+                for attachment in task.get("NetworksAttachments") or []:
+                    network = attachment.get("Network") or {}
+                    netSpec = network.get("Spec") or {}
+                    if netSpec.get("Ingress") or netSpec.get("Name") == "ingress":
+                        continue
+                    addrs = [stripPrefix(addr) for addr in attachment.get("Addresses") or [] if addr]
+                    if len(addrs) > 0:
+                        networks[networkNames.get(network.get("ID", ""), "")] = addrs
+                slot = task.get("Slot")
+                suffix = str(slot) if slot else nodeNames.get(task.get("NodeID", ""), task.get("NodeID", ""))
+                taskRecords.append(ContainerRecord(name=f"{name}-{suffix}", id=task.get("ID", ""), networks=networks))
+
+            endpoint = service.get("Endpoint") or {}
+            ports = endpoint.get("Ports") or []
+            taskNodes = [task.get("NodeID", "") for task in serviceTasks if task.get("NodeID", "") in nodeAddrs]
+            networks = {}
+            if any(port.get("PublishMode", "ingress") == "ingress" for port in ports):
+                meshNodes = taskNodes or sorted(nodeAddrs, key=lambda nodeId: nodeNames[nodeId])
+                if len(meshNodes) > 0:
+                    networks["ingress"] = [nodeAddrs[meshNodes[0]]]
+            elif len(ports) > 0:
+                if len(taskNodes) > 0:
+                    networks["host"] = [nodeAddrs[taskNodes[0]]]
+            else:
+                for vip in endpoint.get("VirtualIPs") or []:
+                    if vip.get("Addr"):
+                        networks.setdefault(networkNames.get(vip.get("NetworkID", ""), vip.get("NetworkID", "")), []).append(stripPrefix(vip["Addr"]))
+            records.append(ContainerRecord(name=name, id=service.get("ID", ""), networks=networks, labels=spec.get("Labels") or {}))
+            records.extend(taskRecords)
+        return records
+
+    # ------------------
+    # --- Properties ---
+    # ------------------
+    @property
+    def Host(self) -> str:
+        return self._host
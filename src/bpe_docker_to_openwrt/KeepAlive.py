@@ -0,0 +1,32 @@
+from http.client import HTTPConnection, HTTPException, HTTPResponse
+
+from typing import Callable, Dict, Optional, Tuple
+
+
+def requestKeepAlive(connection: Callable[[], HTTPConnection], drop: Callable[[], None],
+                     method: str, path: str, body: Optional[bytes] = None,
+                     headers: Optional[Dict[str, str]] = None) -> Tuple[HTTPResponse, bytes]:
+    """One request on a kept-alive connection, read to the end
+
+    The server may have dropped the connection since it was last used, so
+    a request that fails on it is sent once more on a fresh one.
+
+    Args:
+        connection: The connection to use, opening one if there is none
+        drop: Closes and forgets that connection, so connection() opens a new one
+
+    Returns:
+        Tuple[HTTPResponse, bytes]: The response and its body
+    """
+    attempt = 0
+    while True:
+        conn = connection()
+        try:
+            conn.request(method, path, body=body, headers=headers or {})
+            response = conn.getresponse()
+            return response, response.read()
+        except (HTTPException, ConnectionError):
+            drop()
+            attempt += 1
+            if attempt == 2:
+                raise
@@ -0,0 +1,163 @@
+import ipaddress
+import sys
+
+from typing import Iterable, List, Optional, Tuple, Union
+
+# A packed address, with IPv6 offset past every IPv4 one, or the text of anything that is not an address
+IpKey = Union[int, str]
+
+IPV6_OFFSET = 1 << 128
+
+# Bits of MappingRecord.quoting
+QUOTE_LEADING = 1
+QUOTE_TRAILING = 2
+
+
+def packIp(text: str) -> Tuple[int, int]:
+    """(version, address as an int) for an ip, (0, 0) for anything else
+
+    Dotted quads only pack in their canonical spelling (no leading zeros),
+    the same ones ipaddress accepts.
+    """
+    parts = text.split(".")
+    if len(parts) == 4:
+        # Nearly every record is IPv4, so skip ipaddress for those
+        try:
+            a, b, c, d = map(int, parts)
+        except ValueError:
+            return 0, 0
+        if 0 <= a <= 255 and 0 <= b <= 255 and 0 <= c <= 255 and 0 <= d <= 255 and f"{a}.{b}.{c}.{d}" == text:
+            return 4, (a << 24) | (b << 16) | (c << 8) | d
+        return 0, 0
+    try:
+        address = ipaddress.ip_address(text)
+    except ValueError:
+        return 0, 0
+    return address.version, int(address)
+
+
+def formatIp(version: int, packed: int) -> str:
+    if version == 4:
+        return f"{packed >> 24}.{(packed >> 16) & 255}.{(packed >> 8) & 255}.{packed & 255}"
+    return str(ipaddress.IPv6Address(packed))
+
+
+def ipKey(text: str) -> IpKey:
+    """Key that compares equal for two spellings of the same address"""
+    version, packed = packIp(text)
+    if version == 0:
+        return text
+    return packed if version == 4 else packed + IPV6_OFFSET
+
+
+def renderDefinition(names: Iterable[str], ip: str) -> str:
+    return "/" + "/".join(names) + "/" + ip
+
+
+def internNames(names: List[str]) -> Tuple[Tuple[str, ...], Tuple[str, ...]]:
+    """(names, lowercase keys), interned, sharing strings (and the tuple) where they are already lowercase"""
+    lowered = [sys.intern(name.lower()) for name in names]
+    keys = tuple(lowered)
+    if lowered == names:
+        return keys, keys
+    return tuple([key if key == name else name for name, key in zip(names, lowered)]), keys
+
+
+class MappingRecord:
+    """One dnsmasq address definition ('/name1/name2/ip'), stored compactly
+
+    Names are interned, with a lowercase copy only where it differs, and the
+    ip is kept as a packed int. The exact text is only stored when it can't
+    be rebuilt from those (doubled slashes, a non-canonical or non-ip
+    address), so raw round-trips to what was parsed.
+    """
+
+    __slots__ = ("names", "keys", "version", "packed", "quoting", "_text")
+
+    def __init__(self, names: Tuple[str, ...], keys: Tuple[str, ...], version: int, packed: int, quoting: int = 0, text: Optional[str] = None):
+        self.names = names
+        self.keys = keys
+        self.version = version
+        self.packed = packed
+        self.quoting = quoting
+        # Only set when rendering from the parts would give something else
+        self._text = text
+
+    @classmethod
+    def fromDefinition(cls, definition: str) -> "MappingRecord":
+        """Parse '/name1/name2/ip', quoted or not
+
+        Anything that does not map a name still parses, to a record without
+        names, so a list round-trips whatever is in it.
+        """
+        text = definition
+        quoting = 0
+        if len(text) > 0 and text[0] == "'":
+            text = text[1:]
+            quoting |= QUOTE_LEADING
+        if len(text) > 0 and text[-1] == "'":
+            text = text[:-1]
+            quoting |= QUOTE_TRAILING
+        sections = text.split("/")
+        if len(sections) <= 2:
+            return cls((), (), 0, 0, quoting, text)
+        ip = sections.pop()
+        names, keys = internNames([name for name in sections if len(name) > 0])
+        version, packed = packIp(ip)
+        exact = (sections[0] == "" and len(names) == len(sections) - 1
+                 and (version == 4 or (version == 6 and formatIp(version, packed) == ip)))
+        return cls(names, keys, version, packed, quoting, None if exact else text)
+
+    @classmethod
+    def fromMapping(cls, names: Iterable[str], ip: str) -> "MappingRecord":
+        return cls.fromDefinition(renderDefinition(names, ip))
+
+    @property
+    def text(self) -> str:
+        """The definition without quotes"""
+        if self._text is not None:
+            return self._text
+        return renderDefinition(self.names, formatIp(self.version, self.packed))
+
+    @property
+    def raw(self) -> str:
+        """The definition as it was given, quoting included"""
+        return ("'" if self.quoting & QUOTE_LEADING else "") + self.text + ("'" if self.quoting & QUOTE_TRAILING else "")
+
+    @property
+    def ip(self) -> str:
+        if self._text is None:
+            return formatIp(self.version, self.packed)
+        if self._text.count("/") < 2:
+            # Too short to hold an ip at all
+            return ""
+        return self._text.rpartition("/")[2]
+
+    @property
+    def ipKey(self) -> IpKey:
+        if self.version == 4:
+            return self.packed
+        if self.version == 6:
+            return self.packed + IPV6_OFFSET
+        return self.ip
+
+    @property
+    def sortKey(self) -> Tuple[int, int, Tuple[str, ...]]:
+        """Orders by address family, then address, then names"""
+        return self.version, self.packed, self.keys
+
+    def __eq__(self, other: object) -> bool:
+        # Quoting is left out: quoted or not, it is the same definition
+        if not isinstance(other, MappingRecord):
+            return NotImplemented
+        return (self.packed == other.packed and self.names == other.names
+                and self.version == other.version and self._text == other._text)
+
+    def __hash__(self) -> int:
+        return hash(self.names) ^ self.packed
+
+    def __lt__(self, other: "MappingRecord") -> bool:
+        return self.sortKey < other.sortKey
+
+    def __repr__(self) -> str:
+        return f"MappingRecord({self.raw!r})"
@@ -0,0 +1,148 @@
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Union
+
+from bpe_docker_to_openwrt.MappingRecord import IpKey, MappingRecord, ipKey
+
+
+# An index slot holds its one record directly, and a list only once a second one shares the key
+IndexSlot = Union[MappingRecord, List[MappingRecord]]
+
+
+def indexAdd(index: Dict[Any, IndexSlot], key: Any, record: MappingRecord):
+    held = index.get(key)
+    if held is None:
+        index[key] = record
+    elif isinstance(held, list):
+        held.append(record)
+    else:
+        index[key] = [held, record]
+
+
+def indexRemove(index: Dict[Any, IndexSlot], key: Any, record: MappingRecord):
+    held = index.get(key)
+    if isinstance(held, list):
+        held.remove(record)
+        if len(held) == 1:
+            index[key] = held[0]
+    elif held is not None:
+        del index[key]
+
+
+def indexGet(index: Dict[Any, IndexSlot], key: Any) -> Sequence[MappingRecord]:
+    held = index.get(key)
+    if held is None:
+        return ()
+    if isinstance(held, list):
+        return held
+    return (held,)
+
+
+class MappingTable:
+    """The router's address definitions, parsed once and indexed
+
+    Each definition is held once, as a compact MappingRecord.
+    Case-insensitive name -> record and address -> record indexes are kept
+    in step as definitions are added and removed, so lookups don't have to
+    rescan the whole list. Addresses are compared packed, so two spellings
+    of the same IPv6 address match.
+    """
+
+    def __init__(self, definitions: Optional[Iterable[str]] = None):
+        # Every record, in list order, mapped to itself so an equal one finds the held one
+        self._records: Dict[MappingRecord, MappingRecord] = {}
+        # lowercase name -> records holding it, in list order
+        self._byName: Dict[str, IndexSlot] = {}
+        # address -> records pointing at it, in list order
+        self._byIp: Dict[IpKey, IndexSlot] = {}
+
+        if definitions is not None:
+            for definition in definitions:
+                self.addRecord(MappingRecord.fromDefinition(definition))
+
+    def addRecord(self, record: MappingRecord) -> MappingRecord:
+        """Add a record, or return the equal one already held"""
+        held = self._records.setdefault(record, record)
+        if held is not record:
+            return held
+        for key in record.keys:
+            indexAdd(self._byName, key, record)
+        if len(record.names) > 0:
+            indexAdd(self._byIp, record.ipKey, record)
+        return record
+
+    def add(self, definition: str) -> str:
+        """Add a definition (quoted or not). Returns it unquoted."""
+        return self.addRecord(MappingRecord.fromDefinition(definition)).text
+
+    def addMapping(self, names: List[str], ip: str) -> str:
+        return self.addRecord(MappingRecord.fromMapping(names, ip)).text
+
+    def record(self, definition: str | MappingRecord) -> Optional[MappingRecord]:
+        """The held record equal to definition, None if there is none"""
+        if isinstance(definition, str):
+            definition = MappingRecord.fromDefinition(definition)
+        return self._records.get(definition)
+
+    def remove(self, definition: str | MappingRecord) -> bool:
+        record = self.record(definition)
+        if record is None:
+            return False
+        del self._records[record]
+        for key in record.keys:
+            indexRemove(self._byName, key, record)
+        if len(record.names) > 0:
+            indexRemove(self._byIp, record.ipKey, record)
+        return True
+
+    def recordsWithName(self, name: str) -> List[MappingRecord]:
+        return list(indexGet(self._byName, name.lower()))
+
+    def findByName(self, name: str) -> str:
+        """The first definition mapping name (any case), or "" if there is none"""
+        holders = indexGet(self._byName, name.lower())
+        if len(holders) == 0:
+            return ""
+        return holders[0].text
+
+    def records(self) -> List[MappingRecord]:
+        """Every record, in list order"""
+        return list(self._records)
+
+    def keys(self) -> List[str]:
+        """Every definition, unquoted, in list order"""
+        return [record.text for record in self._records]
+
+    def ipFor(self, name: str) -> Optional[str]:
+        holders = indexGet(self._byName, name.lower())
+        if len(holders) == 0:
+            return None
+        return holders[0].ip
+
+    def namesFor(self, ip: str) -> List[str]:
+        names: List[str] = []
+        for record in indexGet(self._byIp, ipKey(ip)):
+            names.extend(record.names)
+        return names
+
+    def definitionsFor(self, ip: str) -> List[str]:
+        return [record.text for record in indexGet(self._byIp, ipKey(ip))]
+
+    def mappings(self) -> Dict[str, str]:
+        """name -> ip for every name (a name in several definitions gets the last one's ip)"""
+        outDict: Dict[str, str] = {}
+        for record in self._records:
+            if len(record.names) == 0:
+                continue
+            ip = record.ip
+            for name in record.names:
+                outDict[name] = ip
+        return outDict
+
+    def definitions(self) -> List[str]:
+        """Definitions as they were given (quoting included)"""
+        return [record.raw for record in self._records]
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def __contains__(self, name: str) -> bool:
+        return name.lower() in self._byName
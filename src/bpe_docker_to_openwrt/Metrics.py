@@ -0,0 +1,181 @@
+import contextlib
+import json
+import pathlib
+import re
+import threading
+import time
+
+from dataclasses import dataclass
+from typing import Callable, ContextManager, Dict, Iterator, List, Optional, Tuple
+
+from bpe_docker_to_openwrt.AtomicWrite import writeAtomic
+
+# Prefix of every exported Prometheus metric
+PROMETHEUS_PREFIX = "bpe_docker_to_openwrt"
+
+# What span() hands out while metrics are off: reusable and does nothing
+NULL_SPAN: ContextManager[None] = contextlib.nullcontext()
+
+re_metric_name = re.compile(r"[^a-zA-Z0-9_]")
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def labelsKey(labels: Dict[str, object]) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def escapeLabelValue(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def prometheusLabels(labels: Labels) -> str:
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join(f'{re_metric_name.sub("_", key)}="{escapeLabelValue(value)}"' for key, value in labels) + "}"
+
+
+@dataclass
+class SpanStats:
+    count: int = 0
+    seconds: float = 0.0
+    maxSeconds: float = 0.0
+
+
+class Metrics:
+    """Timed spans and counters for one run, exported as json or a Prometheus textfile
+
+    Off by default. While off, span() returns a shared no-op context manager
+    and count() returns at once, so instrumented code pays one attribute
+    check per call.
+    """
+
+    def __init__(self, enabled: bool = False, clock: Callable[[], float] = time.perf_counter, wallClock: Callable[[], float] = time.time):
+        self._enabled = enabled
+        self._clock = clock
+        self._wallClock = wallClock
+        # Routers are handled on several threads at once
+        self._lock = threading.Lock()
+        self._spans: Dict[Tuple[str, Labels], SpanStats] = {}
+        self._counters: Dict[Tuple[str, Labels], float] = {}
+
+    def enable(self):
+        self._enabled = True
+
+    def disable(self):
+        self._enabled = False
+
+    def reset(self):
+        with self._lock:
+            self._spans = {}
+            self._counters = {}
+
+    def span(self, name: str, **labels: object) -> ContextManager[None]:
+        """Time the with block under name (and labels), including when it raises"""
+        if not self._enabled:
+            return NULL_SPAN
+        return self._timed(name, labelsKey(labels))
+
+    @contextlib.contextmanager
+    def _timed(self, name: str, labels: Labels) -> Iterator[None]:
+        start = self._clock()
+        try:
+            yield
+        finally:
+            self.observe(name, self._clock() - start, labels)
+
+    def observe(self, name: str, seconds: float, labels: Labels = ()):
+        with self._lock:
+            stats = self._spans.setdefault((name, labels), SpanStats())
+            stats.count += 1
+            stats.seconds += seconds
+            stats.maxSeconds = max(stats.maxSeconds, seconds)
+
+    def count(self, name: str, value: float = 1, **labels: object):
+        if not self._enabled:
+            return
+        key = (name, labelsKey(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def spanStats(self, name: str, **labels: object) -> Optional[SpanStats]:
+        return self._spans.get((name, labelsKey(labels)))
+
+    def counterValue(self, name: str, **labels: object) -> float:
+        return self._counters.get((name, labelsKey(labels)), 0)
+
+    # --------------
+    # --- Export ---
+    # --------------
+    def collected(self) -> Tuple[List[Tuple[str, Labels, SpanStats]], List[Tuple[str, Labels, float]]]:
+        """Copies of the spans and counters, sorted by name and labels"""
+        with self._lock:
+            spans = [(name, labels, SpanStats(stats.count, stats.seconds, stats.maxSeconds)) for (name, labels), stats in sorted(self._spans.items())]
+            counters = [(name, labels, value) for (name, labels), value in sorted(self._counters.items())]
+        return spans, counters
+
+    def snapshot(self) -> Dict[str, object]:
+        spans, counters = self.collected()
+        return {
+            "timestamp": self._wallClock(),
+            "spans": [{"name": name, "labels": dict(labels), "count": stats.count, "seconds": stats.seconds, "maxSeconds": stats.maxSeconds}
+                      for name, labels, stats in spans],
+            "counters": [{"name": name, "labels": dict(labels), "value": value} for name, labels, value in counters],
+        }
+
+    def toJson(self) -> str:
+        return json.dumps(self.snapshot(), indent=2)
+
+    def toPrometheus(self) -> str:
+        """The metrics in Prometheus text exposition format"""
+        spans, counters = self.collected()
+        lines: List[str] = []
+
+        spanName = f"{PROMETHEUS_PREFIX}_span_seconds"
+        lines.append(f"# HELP {spanName} Time spent in each phase of a run")
+        lines.append(f"# TYPE {spanName} summary")
+        for name, labels, stats in spans:
+            text = prometheusLabels((("span", name),) + labels)
+            lines.append(f"{spanName}_sum{text} {stats.seconds:.6f}")
+            lines.append(f"{spanName}_count{text} {stats.count}")
+
+        maxName = f"{PROMETHEUS_PREFIX}_span_max_seconds"
+        lines.append(f"# HELP {maxName} Longest single run of each phase")
+        lines.append(f"# TYPE {maxName} gauge")
+        for name, labels, stats in spans:
+            lines.append(f"{maxName}{prometheusLabels((('span', name),) + labels)} {stats.maxSeconds:.6f}")
+
+        # Samples of one metric have to follow its TYPE line, which sorting by name gives us
+        lastName = None
+        for name, labels, value in counters:
+            metricName = f"{PROMETHEUS_PREFIX}_{re_metric_name.sub('_', name)}_total"
+            if metricName != lastName:
+                lines.append(f"# TYPE {metricName} counter")
+                lastName = metricName
+            lines.append(f"{metricName}{prometheusLabels(labels)} {value:g}")
+
+        timestampName = f"{PROMETHEUS_PREFIX}_last_run_timestamp_seconds"
+        lines.append(f"# TYPE {timestampName} gauge")
+        lines.append(f"{timestampName} {self._wallClock():.3f}")
+        return "\n".join(lines) + "\n"
+
+    def writeFile(self, path: str | pathlib.Path, text: str):
+        """Write then rename, so node_exporter's textfile collector never reads half a file"""
+        writeAtomic(path, text)
+
+    def writeJson(self, path: str | pathlib.Path):
+        self.writeFile(path, self.toJson() + "\n")
+
+    def writePrometheus(self, path: str | pathlib.Path):
+        self.writeFile(path, self.toPrometheus())
+
+    # ------------------
+    # --- Properties ---
+    # ------------------
+    @property
+    def Enabled(self) -> bool:
+        return self._enabled
+
+
+# Shared by every module, turned on from the command line
+metrics = Metrics()
@@ -0,0 +1,218 @@
+from sys import stderr
+import re
+
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from bpe_docker_to_openwrt.ContainerRecord import ContainerRecord
+
+# Container label that sets a container's hostname outright
+HOSTNAME_LABEL = "bpe-docker-to-openwrt.hostname"
+
+COMPOSE_PROJECT_LABEL = "com.docker.compose.project"
+COMPOSE_SERVICE_LABEL = "com.docker.compose.service"
+COMPOSE_NUMBER_LABEL = "com.docker.compose.container-number"
+
+# Characters dropped (or replaced by replaceSymbols) from every name
+SYMBOLS = "@#$%\\"
+
+# Longest single label and whole name RFC 1123 allows
+MAX_LABEL_LENGTH = 63
+MAX_NAME_LENGTH = 253
+
+re_rfc1123_name = re.compile(r"[a-z0-9]([a-z0-9-]{0,61}[a-z0-9])?(\.[a-z0-9]([a-z0-9-]{0,61}[a-z0-9])?)*")
+re_not_rfc1123 = re.compile(r"[^a-z0-9.-]+")
+
+
+def compileTable(replaceUnderscores: str = "-", replaceDots: str = ".", replaceColons: str = "-", replaceSymbols: str = "") -> Dict[int, str]:
+    """A str.translate table doing what the replacement steps do one after another
+
+    Each step sees the output of the ones before it ('_' -> '.' then '.' ->
+    '-' turns '_' into '-'), so every character is run through the whole
+    chain once here rather than for every name.
+    """
+    steps: List[Tuple[str, str]] = [("_", replaceUnderscores), (".", replaceDots), (":", replaceColons)]
+    # The symbols go in one regex pass, so a replacement is never looked at again
+    symbols = {ord(symbol): replaceSymbols for symbol in SYMBOLS}
+
+    def chain(text: str, start: int) -> str:
+        for source, replacement in steps[start:]:
+            text = text.replace(source, replacement)
+        return text.translate(symbols)
+
+    table: Dict[int, str] = dict(symbols)
+    for index, (source, replacement) in enumerate(steps):
+        table[ord(source)] = chain(replacement, index + 1)
+    return table
+
+
+def compileBytesTable(table: Dict[int, str]) -> Optional[Tuple[bytes, bytes]]:
+    """(bytes.translate table, characters to delete) doing the same as table on ASCII text
+
+    None if some character becomes more than one, or a non-ASCII, character.
+    bytes.translate works from a flat 256 byte table, several times faster
+    than str.translate with a dict.
+    """
+    if any(len(replacement) > 1 or not replacement.isascii() for replacement in table.values()):
+        return None
+    mapping = bytearray(range(256))
+    delete = bytearray()
+    for source, replacement in table.items():
+        if len(replacement) == 0:
+            delete.append(source)
+        else:
+            mapping[source] = ord(replacement)
+    return bytes(mapping), bytes(delete)
+
+
+def templateFields(template: str) -> List[str]:
+    import string
+    return [name for literal, name, spec, conversion in string.Formatter().parse(template) if name is not None]
+
+
+@dataclass
+class NameCollision:
+    name: str
+    # (container name, ip) for every container that wants the name, sorted so the first one holds it
+    claims: List[Tuple[str, str]] = field(default_factory=list)
+
+
+class NamingRules:
+    """How a container becomes a hostname, set up once and applied to every container
+
+    The name comes from the first rule that gives one: the hostname label,
+    then the compose template (for compose containers), then the container
+    name. It is then normalized in a single str.translate pass and, with
+    rfc1123, forced into a valid DNS name. With the defaults, and no
+    hostname label, '_' and ':' become '-' and symbols are dropped.
+    """
+
+    def __init__(self, replaceUnderscores: str = "-", replaceDots: str = ".", replaceColons: str = "-", replaceSymbols: str = "",
+                 hostnameLabel: Optional[str] = HOSTNAME_LABEL, composeTemplate: Optional[str] = None,
+                 rfc1123: bool = False, maxLength: int = MAX_NAME_LENGTH):
+        """
+        Args:
+            hostnameLabel: Container label whose value is used as the name, None to ignore labels
+            composeTemplate: Name for compose containers, from {project}, {service}, {number} and {name}
+            rfc1123: Lowercase names and fix anything a DNS name can't hold, skipping names that end up empty
+            maxLength: Longest name rfc1123 lets through, leaving room for the domain
+
+        Raises:
+            ValueError: If composeTemplate uses a field that does not exist
+        """
+        self._table = compileTable(replaceUnderscores, replaceDots, replaceColons, replaceSymbols)
+        self._bytesTable = compileBytesTable(self._table)
+        self._hostnameLabel = hostnameLabel
+        self._composeTemplate = composeTemplate
+        self._rfc1123 = rfc1123
+        self._maxLength = maxLength
+
+        if composeTemplate is not None:
+            unknown = [name for name in templateFields(composeTemplate) if name not in ("project", "service", "number", "name")]
+            if len(unknown) > 0:
+                raise ValueError(f"Unknown field {{{unknown[0]}}} in compose template '{composeTemplate}'")
+
+        # Only the rules that are turned on, in the order they are tried
+        self._sources: List[Callable[[ContainerRecord], Optional[str]]] = []
+        if hostnameLabel is not None:
+            self._sources.append(self.fromLabel)
+        if composeTemplate is not None:
+            self._sources.append(self.fromCompose)
+
+    # -------------
+    # --- Rules ---
+    # -------------
+    def fromLabel(self, record: ContainerRecord) -> Optional[str]:
+        return record.labels.get(self._hostnameLabel or "") or None
+
+    def fromCompose(self, record: ContainerRecord) -> Optional[str]:
+        labels = record.labels
+        service = labels.get(COMPOSE_SERVICE_LABEL)
+        if not service or self._composeTemplate is None:
+            return None
+        return self._composeTemplate.format(project=labels.get(COMPOSE_PROJECT_LABEL, ""), service=service,
+                                            number=labels.get(COMPOSE_NUMBER_LABEL, "1"), name=record.name)
+
+    def translate(self, name: str) -> str:
+        """The character replacements alone"""
+        if self._bytesTable is not None and name.isascii():
+            # Docker only allows ASCII container names, so this is nearly always the way
+            return name.encode().translate(*self._bytesTable).decode()
+        return name.translate(self._table)
+
+    def enforce(self, name: str) -> str:
+        """name as a valid RFC 1123 hostname, or '' if nothing valid is left of it"""
+        name = name.lower()
+        if len(name) <= self._maxLength and re_rfc1123_name.fullmatch(name) is not None:
+            return name
+        labels = []
+        for label in re_not_rfc1123.sub("-", name).split("."):
+            label = label[:MAX_LABEL_LENGTH].strip("-")
+            if len(label) > 0:
+                labels.append(label)
+        name = ".".join(labels)
+        if len(name) > self._maxLength:
+            name = name[:self._maxLength].rstrip("-.")
+        return name
+
+    def nameFor(self, record: ContainerRecord) -> Optional[str]:
+        """The hostname for record (without the domain), None if it has no usable one"""
+        name = record.name
+        for source in self._sources:
+            picked = source(record)
+            if picked is not None:
+                name = picked
+                break
+        name = self.translate(name)
+        if self._rfc1123:
+            name = self.enforce(name)
+        return name if len(name) > 0 else None
+
+    def assign(self, records: Iterable[ContainerRecord]) -> Tuple[Dict[str, str], List[NameCollision]]:
+        """Name every container with an address, mapping it to its first ip
+
+        Two containers that end up with the same name and different ips
+        collide. The container whose own name sorts first keeps the name, so
+        the result does not depend on listing order.
+
+        Returns:
+            Tuple[Dict[str, str], List[NameCollision]]: name -> ip, and every name more than one container wanted
+        """
+        claims: Dict[str, Tuple[str, str]] = {}
+        collisions: Dict[str, NameCollision] = {}
+        nameFor = self.nameFor
+        for record in records:
+            ips = record.ips
+            if len(ips) == 0:
+                continue
+            name = nameFor(record)
+            if name is None:
+                stderr.write(f"WARNING: No usable hostname for container {record.name}, skipping it\n")
+                continue
+            claim = (record.name, ips[0])
+            held = claims.setdefault(name, claim)
+            if held is not claim and held[1] != claim[1]:
+                collisions.setdefault(name, NameCollision(name, [held])).claims.append(claim)
+                if claim[0] < held[0]:
+                    claims[name] = claim
+
+        for collision in collisions.values():
+            collision.claims.sort()
+            stderr.write(f"WARNING: {collision.name} is wanted by containers {', '.join(container for container, ip in collision.claims)}, "
+                         f"giving it to {collision.claims[0][0]}\n")
+        return {name: ip for name, (container, ip) in claims.items()}, list(collisions.values())
+
+    # ------------------
+    # --- Properties ---
+    # ------------------
+    @property
+    def HostnameLabel(self) -> Optional[str]:
+        return self._hostnameLabel
+
+    @property
+    def ComposeTemplate(self) -> Optional[str]:
+        return self._composeTemplate
+
+    @property
+    def RFC1123(self) -> bool:
+        return self._rfc1123
@@ -0,0 +1,169 @@
+from dataclasses import dataclass, field
+from typing import Callable, Dict, FrozenSet, Iterable, List, Optional, Tuple
+
+from bpe_docker_to_openwrt.MappingRecord import IpKey, MappingRecord, ipKey
+from bpe_docker_to_openwrt.MappingTable import MappingTable
+
+
+@dataclass
+class Change:
+    # "remove", "add" or "replace"
+    action: str
+    oldDefinition: str = ""
+    newDefinition: str = ""
+
+    def __str__(self) -> str:
+        if self.action == "remove":
+            return f"- {self.oldDefinition}"
+        if self.action == "add":
+            return f"+ {self.newDefinition}"
+        return f"~ {self.oldDefinition} -> {self.newDefinition}"
+
+
+@dataclass
+class Plan:
+    changes: List[Change] = field(default_factory=list)
+    # Managed definitions that are already right
+    unchanged: int = 0
+
+    def isEmpty(self) -> bool:
+        return len(self.changes) == 0
+
+    def counts(self) -> Dict[str, int]:
+        counts = {"add": 0, "remove": 0, "replace": 0, "unchanged": self.unchanged}
+        for change in self.changes:
+            counts[change.action] += 1
+        return counts
+
+
+def definitionFor(names: List[str], ip: str) -> str:
+    return "/" + "/".join(names) + "/" + ip
+
+
+def planChanges(desired: Dict[str, str], current: MappingTable,
+                owned: Optional[Callable[[str], bool]] = None,
+                scope: Optional[Iterable[str]] = None,
+                merge: bool = True) -> Plan:
+    """Work out the smallest set of definition changes that turns current into desired
+
+    Args:
+        desired: name -> ip for every name that should exist
+        current: The router's definitions
+        owned: Names this tool manages. Others are never removed or changed. Defaults to every name.
+        scope: Only plan for these names, leaving everything else as it is (incremental updates)
+        merge: Put names that share an ip into one '/name1/name2/ip' definition
+
+    Returns:
+        Plan: Removes first, then in-place replacements, then adds
+    """
+    scoped: Optional[Dict[str, None]] = None
+    if scope is not None:
+        scoped = {name.lower(): None for name in scope}
+
+    def managed(name: str) -> bool:
+        if scoped is not None and name.lower() not in scoped:
+            return False
+        return owned is None or owned(name)
+
+    # lowercase name -> (name, ip)
+    wanted: Dict[str, Tuple[str, str]] = {}
+    for name, ip in desired.items():
+        if managed(name):
+            wanted[name.lower()] = (name, ip)
+
+    def sameIp(name: str, record: MappingRecord, recordIp: str) -> bool:
+        want = wanted.get(name)
+        if want is None:
+            return False
+        # Text matches nearly always; packing catches other spellings of the same address
+        return want[1] == recordIp or ipKey(want[1]) == record.ipKey
+
+    # Definitions worth looking at: those holding a managed name. With a
+    # scope that is only the definitions of the scoped names.
+    if scoped is not None:
+        candidates: Dict[MappingRecord, None] = {}
+        for name in scoped:
+            for record in current.recordsWithName(name):
+                candidates[record] = None
+        records: Iterable[MappingRecord] = list(candidates)
+    else:
+        records = current.records()
+
+    plan = Plan()
+    removed: List[MappingRecord] = []
+    replaced: List[Change] = []
+    # new definition -> (its replace change, names), for merging more names into it
+    replacing: Dict[str, Tuple[Change, List[str]]] = {}
+    # lowercase names already served by a definition that stays
+    satisfied: Dict[str, None] = {}
+    # packed ip -> (definition we manage and keep, its names), so new names can join it
+    mergeInto: Dict[IpKey, Tuple[str, List[str]]] = {}
+
+    for record in records:
+        recordNames = record.names
+        if len(recordNames) == 0 or not any(managed(name) for name in recordNames):
+            continue
+
+        # The packed ip, as ipKey() gives for a text one
+        recordKey = record.ipKey
+        recordIp = record.ip
+        keep = [name for name, key in zip(recordNames, record.keys) if not managed(name) or sameIp(key, record, recordIp)]
+        if len(keep) == len(recordNames):
+            plan.unchanged += 1
+            for key in record.keys:
+                satisfied[key] = None
+            mergeInto.setdefault(recordKey, (record.text, list(recordNames)))
+        elif len(keep) == 0:
+            removed.append(record)
+        else:
+            change = Change("replace", record.text, definitionFor(keep, recordIp))
+            replaced.append(change)
+            replacing[change.newDefinition] = (change, keep)
+            for name in keep:
+                satisfied[name.lower()] = None
+            mergeInto.setdefault(recordKey, (change.newDefinition, keep))
+
+    # Names that still need a home, grouped by ip in desired order
+    missing: Dict[IpKey, Tuple[str, List[str]]] = {}
+    for lowered, (name, ipText) in wanted.items():
+        if lowered not in satisfied:
+            missing.setdefault(ipKey(ipText), (ipText, []))[1].append(name)
+
+    # (definition, its names)
+    added: List[Tuple[str, List[str]]] = []
+    if merge:
+        for packed, (ipText, names) in missing.items():
+            target = mergeInto.get(packed)
+            if target is None:
+                added.append((definitionFor(names, ipText), names))
+                continue
+            # Extend a definition we already manage instead of adding a second one for the ip
+            text, baseNames = target
+            extended = definitionFor(baseNames + names, ipText)
+            pending = replacing.get(text)
+            if pending is not None:
+                pending[0].newDefinition = extended
+            else:
+                replaced.append(Change("replace", text, extended))
+                plan.unchanged -= 1
+    else:
+        for packed, (ipText, names) in missing.items():
+            added.extend((definitionFor([name], ipText), [name]) for name in names)
+
+    # A definition that went away and comes back with the same names on a new ip is one replacement
+    byNames: Dict[FrozenSet[str], str] = {}
+    for record in removed:
+        byNames.setdefault(frozenset(record.keys), record.text)
+    adds: List[Change] = []
+    for definition, names in added:
+        old = byNames.pop(frozenset(name.lower() for name in names), None)
+        if old is not None:
+            replaced.append(Change("replace", old, definition))
+        else:
+            adds.append(Change("add", newDefinition=definition))
+    paired = set(change.oldDefinition for change in replaced)
+
+    plan.changes.extend(Change("remove", oldDefinition=record.text) for record in removed if record.text not in paired)
+    plan.changes.extend(replaced)
+    plan.changes.extend(adds)
+    return plan
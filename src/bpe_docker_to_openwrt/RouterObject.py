@@ -1,19 +1,74 @@
-from subprocess import run as runprocess
+from subprocess import TimeoutExpired
 from sys import stderr
 #from os import stdout
 import pathlib
+import re
+import shlex
+import time
 
 from dataclasses import dataclass
-from typing import List, Optional, Dict
+from functools import lru_cache
+from typing import Callable, List, Optional, Dict, Tuple, TYPE_CHECKING
 from subprocess import CalledProcessError, CompletedProcess
-from os import access, X_OK
+from os import access, X_OK, getuid
 from shutil import which as shellwhich
 
+from bpe_docker_to_openwrt.Deadline import backoffDelays, runBounded, runDeadline
+from bpe_docker_to_openwrt.MappingTable import MappingTable
+from bpe_docker_to_openwrt.Metrics import metrics
+from bpe_docker_to_openwrt.ReconcilePlan import Plan, planChanges
+from bpe_docker_to_openwrt.StateCache import StateCache
+from bpe_docker_to_openwrt.UciParser import UciConfig, UciSection, UciParseError, parseUci
+
+# UbusClient pulls in http.client (and ssl), so it is imported when ubus is used
+if TYPE_CHECKING:
+    from bpe_docker_to_openwrt.UbusClient import UbusClient
+
+# Directory made on the router while a run holds its lock (mkdir is atomic, even on busybox)
+ROUTER_LOCK_PATH = "/tmp/bpe-docker-to-openwrt.lock"
+# Exit status of the lock script when another run holds the lock (EX_TEMPFAIL)
+ROUTER_LOCK_HELD = 75
+# Exit status of the fingerprint guard when the config has changed (EX_DATAERR), apart from ssh's 255 and timeouts' 124
+FINGERPRINT_CHANGED = 65
+
+# First line of every hosts file written, and all there is in one with no mappings
+HOSTS_HEADER = "# Managed by bpe-docker-to-openwrt, changes will be overwritten\n"
+
+
+# '[user@]host[:port]', where host is a name, an ipv4 or an ipv6 address. Nothing may start with '-'.
+re_router_spec = re.compile(r"(?:[A-Za-z0-9_][A-Za-z0-9_.-]*@)?(?:[A-Za-z0-9_][A-Za-z0-9_.-]*|[0-9A-Fa-f:]*:[0-9A-Fa-f:.]*)(?::[0-9]{1,5})?")
+
+
+def isRouterSpec(spec: str) -> bool:
+    return re_router_spec.fullmatch(spec) is not None
+
+
+@lru_cache(maxsize=None)
+def resolveExecutable(cmdname: str) -> Optional[str]:
+    """Full path of an executable given as a path or a name on PATH, looked up once per process"""
+    path = pathlib.Path(cmdname).expanduser().resolve()
+    if path.exists() and path.is_file() and access(str(path), X_OK):
+        return str(path)
+    return shellwhich(cmdname, mode=X_OK)
+
+def md5hex(text: str) -> str:
+    # hashlib loads OpenSSL, which is noticeable at startup, so import it on first use
+    import hashlib
+    return hashlib.md5(text.encode()).hexdigest()
+
+@dataclass
+class BatchResult:
+    command: str
+    returncode: int
+    output: str
+
+
 @dataclass
 class RouterObject:
 
     def __init__(self, hostname: str, port: Optional[int] = None, identity_file: Optional[str] = None, username: Optional[str] = None, cmdname: Optional[str] = None):
         self._hostname = hostname
+        self._sshexe: str = ""
         self.setSSHcmd(cmdname)
         self._port: int
         self.setPort(port)
@@ -22,24 +77,95 @@ class RouterObject:
         self._username: str
         self.setUsername(username)
 
-        self._lastDefinedExtraDNS: List[str] = []
-        self._lastDefinedMappings: Dict[str, str] = {}
-        self._sshexe: str = ""
-        self.setSSHcmd(cmdname)
+        # Parsed and indexed copy of the router's address list
+        self._table: MappingTable = MappingTable()
+        # The whole dhcp config as last read, None until read over ssh
+        self._dhcpConfig: Optional[UciConfig] = None
+        self._lastQueryOk: bool = False
 
-        self._cmd_showDns: str = "uci show dhcp.@dnsmasq[0].address"
+        # The whole dhcp config in one go, every dnsmasq section included
+        self._cmd_showDns: str = "uci export dhcp"
         self._cmd_addDns: str = "uci add_list dhcp.@dnsmasq[0].address='{definition}'"
         self._cmd_delDns: str = "uci del_list dhcp.@dnsmasq[0].address='{definition}'"
         self._cmd_commit: str = "uci commit dhcp"
-        self._cmd_reload: str = "service dnsmasq reload"      
+        self._cmd_revert: str = "uci revert dhcp"
+        self._cmd_hup: str = "killall -HUP dnsmasq"
+        self._cmd_reload: str = "service dnsmasq reload"
+        self._cmd_runScript: str = "sh -s"
+        # Changes whenever the dhcp config does, committed or not
+        self._cmd_fingerprint: str = "cat /etc/config/dhcp /tmp/.uci/dhcp 2>/dev/null | md5sum | cut -d ' ' -f 1"
+        self._fingerprintMarker: str = "@@bpe-fingerprint"
+        # Precedes each hosts file when several are read at once
+        self._shardMarker: str = "@@bpe-shard"
+
+        # dnsmasq hosts file holding every mapping instead of the uci address list. None for the uci list.
+        self._hostsFile: Optional[str] = None
+        # Domains that get a hosts file of their own (the hosts file path plus '.domain'). Empty for one file.
+        self._hostsShards: List[str] = []
+        # md5 of each hosts file as last read or written, "" if it was read and is empty or missing, absent if unknown
+        self._hostsHashes: Dict[str, str] = {}
+        # Queued upload not yet applied: (index in the batch, md5 it writes to each file)
+        self._pendingHostsWrite: Optional[Tuple[int, Dict[str, str]]] = None
+
+        # rpcd JSON-RPC transport for the uci list, ssh is the fallback. None for ssh only.
+        self._ubus: Optional["UbusClient"] = None
+        self._ubusFallback: bool = True
+        self._ubusSection: Optional[str] = None
+        self._pendingUbusWrite: bool = False
+
+        # Local copy of the last address list read, skipped when the fingerprint has moved on. None when disabled.
+        self._stateCache: Optional[StateCache] = None
+        self._invalidateOnCommit: bool = False
+        self._cacheHits: int = 0
+
+        # Lock on the router shared by every host running against it. None when not locking.
+        self._routerLock: Optional[str] = None
+        self._routerLockTTL: int = 600
+        self._routerLockHeld: bool = False
+        self._rerunRequested: bool = False
+
+        # Commands queued while a batch is open. None when not batching.
+        self._batch: Optional[List[str]] = None
+        self._batchAtomic: bool = False
+        self._batchCommits: bool = False
+        self._batchMarker: str = "@@bpe-batch"
+
+        # OpenSSH connection multiplexing. None when every call does its own handshake.
+        self._controlPath: Optional[str] = None
+        self._controlPersist: int = 60
+        self._keepMaster: bool = False
+        self._sshHandshakes: int = 0
+        self._sshCommands: int = 0
+
+        # Limits on each ssh call, so an unreachable router can't hang a run. None for no limit.
+        self._timeout: Optional[float] = 60.0
+        self._connectTimeout: Optional[int] = 10
+        # Retries after ssh itself failed (exit 255 before the command printed anything)
+        self._retries: int = 2
+        self._retryBackoff: float = 1.0
+        self._sleep: Callable[[float], None] = time.sleep
+
+    @classmethod
+    def fromSpec(cls, spec: str, identity_file: Optional[str] = None, cmdname: Optional[str] = None) -> "RouterObject":
+        """Build a router from a '[user@]host[:port]' string
+
+        Raises:
+            ValueError: If spec is not one (it goes on the ssh command line)
+        """
+        if not isRouterSpec(spec):
+            raise ValueError(f"Not a router '[user@]host[:port]': '{spec}'")
+        username: Optional[str] = None
+        port: Optional[int] = None
+        if "@" in spec:
+            username, spec = spec.split("@", 1)
+        if spec.count(":") == 1:
+            spec, portText = spec.split(":", 1)
+            port = int(portText)
+        return cls(spec, port=port, identity_file=identity_file, username=username, cmdname=cmdname)
 
     def setSSHcmd(self, cmdnamein: str | None, beQuiet: bool = False):
         if cmdnamein is not None and len(cmdnamein) > 0:
-            cmdname = str(pathlib.Path(cmdnamein).expanduser().resolve())
-            if pathlib.Path(cmdname).exists() and pathlib.Path(cmdname).is_file() and access(cmdname, X_OK):
-                self._sshexe = cmdname
-                return
-            found = shellwhich(cmdnamein, mode=X_OK)
+            found = resolveExecutable(cmdnamein)
             if found is not None:
                 self._sshexe = found
                 return
@@ -48,7 +174,7 @@ class RouterObject:
         if not beQuiet:
             stderr.write("WARNING: Could not find ssh command, using 'ssh'\n")
 
-        found = shellwhich("ssh", mode=X_OK)
+        found = resolveExecutable("ssh")
         if found is not None:
             self._sshexe = found
             return
@@ -77,22 +203,32 @@ class RouterObject:
 
         self._identity_file = truepath
 
+    def setTimeouts(self, timeout: Optional[float] = 60.0, connectTimeout: Optional[int] = 10, retries: int = 2, retryBackoff: float = 1.0):
+        """Bound every ssh call
+
+        Args:
+            timeout: Seconds one call may take before ssh and everything it started are killed, None for no limit
+            connectTimeout: Seconds ssh may take to connect (ConnectTimeout), None for ssh's default
+            retries: Attempts after the first when ssh fails to connect
+            retryBackoff: Seconds before the first retry, doubling for each one after it
+        """
+        self._timeout = timeout
+        self._connectTimeout = connectTimeout
+        self._retries = max(0, retries)
+        self._retryBackoff = retryBackoff
+
     def setUsername(self, username: Optional[str]):
         if username is not None and len(username) > 0:
             self._username = username
         else:
             self._username = "root"
 
-    def doSSHcmd(self, cmd: str | List[str], doTest: bool = False, testRunReturn: CompletedProcess[str] = CompletedProcess(args=[], returncode=255)) -> CompletedProcess[str]:
+    def sshBaseCmd(self, options: List[str] | Tuple[str, ...] = ()) -> List[str]:
+        """ssh with this router's options, then options, then the destination, ready for a command to be appended"""
         if self._sshexe is None:
             raise FileNotFoundError("ssh not found")
-        
+
         shellcmd = [self._sshexe]
-        if len(self._username) > 0:
-            shellcmd.append(f"{self._username}@{self._hostname}")
-        else:
-            shellcmd.append(self._hostname)
-            
         if self._port is not None and self._port > 0:
             shellcmd.append("-p")
             shellcmd.append(f"{self._port}")
@@ -101,6 +237,34 @@ class RouterObject:
             shellcmd.append("-i")
             shellcmd.append(self._identity_file)
 
+        if self._connectTimeout is not None:
+            shellcmd.extend(["-o", f"ConnectTimeout={self._connectTimeout}"])
+
+        if self._controlPath is not None:
+            shellcmd.extend(["-S", self._controlPath,
+                             "-o", "ControlMaster=auto",
+                             "-o", f"ControlPersist={self._controlPersist}"])
+        shellcmd.extend(options)
+
+        # '--' so the destination can never be read as an option
+        shellcmd.append("--")
+        if len(self._username) > 0:
+            shellcmd.append(f"{self._username}@{self._hostname}")
+        else:
+            shellcmd.append(self._hostname)
+        return shellcmd
+
+    def doSSHcmd(self, cmd: str | List[str], doTest: bool = False, testRunReturn: CompletedProcess[str] = CompletedProcess(args=[], returncode=255), inputText: Optional[str] = None) -> CompletedProcess[str]:
+        shellcmd = self.sshBaseCmd()
+
+        self._sshCommands += 1
+        metrics.count("ssh_commands", router=self.Target)
+        if self._controlPath is None or not pathlib.Path(self._controlPath).exists():
+            # No master to ride on, so this call authenticates from scratch
+            # (and with ControlMaster=auto becomes the master for later calls)
+            self._sshHandshakes += 1
+            metrics.count("ssh_handshakes", router=self.Target)
+
         if isinstance(cmd, str):
             # Try appending the string as a single list entry
             shellcmd.append(cmd)
@@ -109,7 +273,7 @@ class RouterObject:
 
         try:
             if not doTest:
-                result = runprocess(shellcmd, capture_output=True, text=True)
+                result = self.runSSH(shellcmd, inputText)
             else:
                 stderr.write(f"Test: cmd[{shellcmd}]\n")
                 result = testRunReturn
@@ -124,107 +288,783 @@ class RouterObject:
 
         return result
 
+    @staticmethod
+    def sshFailed(result: CompletedProcess[str]) -> bool:
+        """True if ssh itself failed (it exits 255) before the remote command printed anything, so it is safe to retry"""
+        return result.returncode == 255 and len(result.stdout or "") == 0
+
+    def runSSH(self, shellcmd: List[str], inputText: Optional[str] = None) -> CompletedProcess[str]:
+        """Run an ssh command line within the call timeout and the run's deadline, retrying failed connections
+
+        A call that times out is killed with everything it started and
+        reported as exit status 124. It is not retried, as the command may
+        have run.
+
+        Raises:
+            DeadlineExceeded: If the run is out of time before ssh could be started
+        """
+        delays = backoffDelays(self._retries, self._retryBackoff)
+        for attempt in range(self._retries + 1):
+            timeout = runDeadline.timeoutFor(self._timeout, f"ssh to {self.Target}")
+            try:
+                with metrics.span("ssh", router=self.Target):
+                    result = runBounded(shellcmd, inputText, timeout)
+            except TimeoutExpired:
+                metrics.count("ssh_timeouts", router=self.Target)
+                return CompletedProcess(shellcmd, 124, "", f"Timed out after {timeout:g}s\n")
+            if not self.sshFailed(result) or attempt == len(delays):
+                return result
+
+            remaining = runDeadline.remaining()
+            if remaining is not None and remaining < delays[attempt]:
+                return result
+            metrics.count("ssh_retries", router=self.Target)
+            stderr.write(f"WARNING: ssh to {self.Target} failed ({result.stderr.strip()}), retrying in {delays[attempt]:.1f}s\n")
+            self._sleep(delays[attempt])
+        return result
+
+    def runSSHControl(self, args: List[str]) -> CompletedProcess[str]:
+        """Run an ssh command line that manages the master connection, within the connect limits"""
+        try:
+            return runBounded(self.sshBaseCmd(args), timeout=runDeadline.timeoutFor(self._timeout, f"ssh to {self.Target}"))
+        except TimeoutExpired as e:
+            return CompletedProcess(e.cmd, 124, "", f"Timed out after {e.timeout:g}s\n")
+
     def getDefinedExtraDNS(self, doTest: bool = False, testRunReturn: CompletedProcess[str] = CompletedProcess(args=[], returncode=255)) -> List[str] | None:
+        with metrics.span("router_read", router=self.Target):
+            if self.ubusActive():
+                from bpe_docker_to_openwrt.UbusClient import UbusError
+                from http.client import HTTPException
+                try:
+                    return self.getDefinedExtraDNSUbus()
+                except (UbusError, HTTPException, OSError, ValueError) as e:
+                    if not self._ubusFallback:
+                        stderr.write(f"Error querying router for DNS mappings over ubus: {e}\n")
+                        self._lastQueryOk = False
+                        self._lastDefinedExtraDNS = []
+                        return None
+                    stderr.write(f"WARNING: ubus query failed ({e}), falling back to ssh\n")
+
+            if self._stateCache is not None:
+                return self.getDefinedExtraDNSCached(doTest=doTest, testRunReturn=testRunReturn)
 
-        result = self.doSSHcmd(self._cmd_showDns, doTest=doTest, testRunReturn=testRunReturn)
+            result = self.doSSHcmd(self._cmd_showDns, doTest=doTest, testRunReturn=testRunReturn)
+            return self.parseShowDns(result)
 
+    def parseShowDns(self, result: CompletedProcess[str]) -> List[str] | None:
+        self._lastQueryOk = result.returncode == 0
         if result.returncode != 0:
-            stderr.write("Error querying router for DNS mappings: {result.stderr}\n")
+            stderr.write(f"Error querying router for DNS mappings: {result.stderr}\n")
             self._lastDefinedExtraDNS = []
             return None
         
         output = result.stdout
 
-        if output is not None and len(output) > 0:        
-            if output.strip().startswith("uci: Entry not found"):
-                self._lastDefinedExtraDNS = []
-                return []
-            configfile, definitions = output.strip().split("=",1)
-            if definitions is not None and len(definitions) > 0:
-                mappings = definitions.split(" ")
-                self._lastDefinedExtraDNS = mappings
-                return mappings
-        self._lastDefinedExtraDNS = []
-        return None
-    
+        if self._hostsFile is not None:
+            return self.parseHostsFile(output)
+
+        if output is None or len(output.strip()) == 0:
+            self._lastDefinedExtraDNS = []
+            return None
+        if output.strip().startswith("uci: Entry not found"):
+            self._lastDefinedExtraDNS = []
+            return []
+
+        try:
+            self._dhcpConfig = parseUci(output).get("dhcp")
+        except UciParseError as e:
+            stderr.write(f"Error parsing DNS mappings from router: {e}\n")
+            self._lastQueryOk = False
+            self._lastDefinedExtraDNS = []
+            return None
+
+        section = self.dnsmasqSection()
+        definitions = section.getList("address") if section is not None else []
+        self._lastDefinedExtraDNS = definitions
+        return definitions
+
+    def dnsmasqSection(self) -> Optional[UciSection]:
+        """The dnsmasq section the address commands edit (dhcp.@dnsmasq[0])"""
+        if self._dhcpConfig is None:
+            return None
+        sections = self._dhcpConfig.sectionsOfType("dnsmasq")
+        if len(sections) > 0:
+            return sections[0]
+        # 'uci show' of a single option prints no section line, so its type is unknown
+        untyped = self._dhcpConfig.sectionsOfType("")
+        return untyped[0] if len(untyped) > 0 else None
+
+    @staticmethod
+    def shellQuoted(definition: str) -> str:
+        """definition escaped for use inside the single quotes of the uci commands"""
+        return definition.replace("'", "'\\''")
+
+    # ------------------
+    # --- StateCache ---
+    # ------------------
+    def enableStateCache(self, cache: Optional[StateCache] = None, invalidateOnCommit: bool = False):
+        """Answer getDefinedExtraDNS from a local cache while the router's dhcp config is unchanged
+
+        Args:
+            cache: Where to keep the cache. Defaults to a StateCache in the user's cache directory.
+            invalidateOnCommit: Drop the entry after our own commits instead of updating it
+        """
+        self._stateCache = cache if cache is not None else StateCache()
+        self._invalidateOnCommit = invalidateOnCommit
+
+    def disableStateCache(self):
+        self._stateCache = None
+
+    def fingerprintScript(self, knownFingerprint: str = "") -> str:
+        """Print the config fingerprint, then the address list only if the fingerprint is not knownFingerprint"""
+        lines = [f'fp=$({self._cmd_fingerprint})', f'echo "{self._fingerprintMarker}:$fp"']
+        if len(knownFingerprint) > 0:
+            # Read back from the cache file, so quoted like any other value put in a script
+            lines.append(f'[ "$fp" = {shlex.quote(knownFingerprint)} ] && exit 0')
+        lines.append(self._cmd_showDns)
+        return "\n".join(lines) + "\n"
+
+    def splitFingerprint(self, output: Optional[str]) -> Tuple[str, str]:
+        """Pull the fingerprint marker out of output. Returns the fingerprint ("" if missing) and the rest."""
+        fingerprint = ""
+        rest: List[str] = []
+        prefix = self._fingerprintMarker + ":"
+        for line in (output or "").splitlines():
+            if line.startswith(prefix):
+                fingerprint = line[len(prefix):].strip()
+            else:
+                rest.append(line)
+        return fingerprint, "\n".join(rest) + ("\n" if len(rest) > 0 else "")
+
+    def getDefinedExtraDNSCached(self, doTest: bool = False, testRunReturn: CompletedProcess[str] = CompletedProcess(args=[], returncode=255)) -> List[str] | None:
+        """getDefinedExtraDNS that only transfers the address list if the router's config changed"""
+        assert self._stateCache is not None
+        cached = self._stateCache.load(self.Target)
+        known = cached.fingerprint if cached is not None else ""
+
+        result = self.doSSHcmd(self._cmd_runScript, doTest=doTest, testRunReturn=testRunReturn, inputText=self.fingerprintScript(known))
+        fingerprint, rest = self.splitFingerprint(result.stdout)
+
+        if cached is not None and result.returncode == 0 and len(fingerprint) > 0 and fingerprint == cached.fingerprint:
+            self._cacheHits += 1
+            self._lastQueryOk = True
+            self._lastDefinedExtraDNS = cached.definitions
+            if self._hostsFile is not None and len(self._hostsShards) == 0:
+                # The fingerprint of a hosts file is its md5
+                self._hostsHashes = {self._hostsFile: fingerprint}
+            elif self._hostsFile is not None:
+                # We wrote every shard, so what we would write is what is there
+                self._hostsHashes = {path: md5hex(self.renderHostsFile(path)) for path in self.hostsFiles()}
+            return list(cached.definitions)
+
+        definitions = self.parseShowDns(CompletedProcess(args=result.args, returncode=result.returncode, stdout=rest, stderr=result.stderr))
+        if self._lastQueryOk and len(fingerprint) > 0:
+            self._stateCache.save(self.Target, fingerprint, self._lastDefinedExtraDNS)
+        return definitions
+
+    def getDefinedExtraDNSWithFingerprint(self, doTest: bool = False, testRunReturn: CompletedProcess[str] = CompletedProcess(args=[], returncode=255)) -> Tuple[List[str] | None, str]:
+        """The address list and the config fingerprint it was read at, in one ssh session
+
+        Returns:
+            Tuple[List[str] | None, str]: The definitions (None on failure) and the fingerprint ("" if missing)
+        """
+        result = self.doSSHcmd(self._cmd_runScript, doTest=doTest, testRunReturn=testRunReturn, inputText=self.fingerprintScript())
+        fingerprint, rest = self.splitFingerprint(result.stdout)
+        definitions = self.parseShowDns(CompletedProcess(args=result.args, returncode=result.returncode, stdout=rest, stderr=result.stderr))
+        return definitions, fingerprint
+
+    def fingerprintGuard(self, expected: str) -> str:
+        """Command that fails with FINGERPRINT_CHANGED unless the router's config fingerprint is still expected"""
+        return f'[ "$({self._cmd_fingerprint})" = {shlex.quote(expected)} ] || (exit {FINGERPRINT_CHANGED})'
+
     def findDefinitionWithDNS(self,dns: str, definitions: List[str] = []) -> str:
         if definitions is None or len(definitions) == 0:
-            if self._lastDefinedExtraDNS is None:
-                self._lastDefinedExtraDNS = self.getDefinedExtraDNS()
-            definitions = self._lastDefinedExtraDNS
-        
-        if definitions is None or len(definitions) == 0:
-            return ""
-        
-        for mapping in definitions:
-            if mapping[0] == "'":
-                mapping = mapping[1:]
-            if mapping[-1] == "'":
-                mapping = mapping[:-1]
-            sections = mapping.split("/")
-            if len(sections) > 2:
-                #ip = 
-                sections.pop()
-                for addr in sections:
-                    if str(addr).lower() == str(dns).lower():
-                        return mapping
-        return ""
+            return self._table.findByName(dns)
+        return MappingTable(definitions).findByName(dns)
 
     def mappingsFromDefinitions(self, definitions: Optional[List[str]] = None) -> Dict[str, str]:
-        outDict: Dict[str, str] = {}
+        if definitions is None or len(definitions) == 0 or definitions == self._lastDefinedExtraDNS:
+            return self._table.mappings()
+        return MappingTable(definitions).mappings()
 
-        if definitions is None or len(definitions) == 0:
-            if self._lastDefinedExtraDNS is None:
-                self._lastDefinedExtraDNS = self.getDefinedExtraDNS()
-            definitions = self._lastDefinedExtraDNS
-
-        if definitions is None or len(definitions) == 0:
-            self._lastDefinedMappings = outDict
-            return outDict
-        
-        for mapping in definitions:
-            if mapping[0] == "'":
-                mapping = mapping[1:]
-            if mapping[-1] == "'":
-                mapping = mapping[:-1]
-            sections = mapping.split("/")
-            if len(sections) > 2:
-                ip = sections.pop()
-                for addr in sections:
-                    if len(addr) > 0:
-                        outDict[addr] = ip
-
-        self._lastDefinedMappings = outDict
-
-        return outDict
+    def mappedIP(self, dns: str) -> Optional[str]:
+        """The ip dns currently points at on the router (any case), None if unmapped"""
+        return self._table.ipFor(dns)
 
     def addDNSMapping(self, dns: str, ip: str, doTest: bool = False, testRunReturn: CompletedProcess[str] = CompletedProcess(args=[], returncode=255)):
-        existingDefinition = self.findDefinitionWithDNS(dns)
-
-        if existingDefinition is not None and len(existingDefinition) > 0:
-            print(f"TODO:  Updating mapping {dns} -> {ip}")
-            # TODO: Update the existing mapping
+        plan = planChanges({dns: ip}, self._table, scope=[dns])
+        if plan.isEmpty():
+            return
 
+        current = self._table.ipFor(dns)
+        if current is not None:
+            print(f"Updating mapping {dns} {current} -> {ip}")
         else:
             print(f"Adding mapping {dns} -> {ip}")
-            definition = f"/{dns}/{ip}"
-            print("DEBUG:  ", self._cmd_addDns.format(definition=definition))
-            #self.doSSHcmd(self._cmd_addDns.format(definition=definition), doTest=doTest, testRunReturn=testRunReturn)
-            self._lastDefinedExtraDNS.append(definition)
+        self.queuePlan(plan, doTest=doTest, testRunReturn=testRunReturn)
     
     def removeDNSMapping(self, dns: str, doTest: bool = False, testRunReturn: CompletedProcess[str] = CompletedProcess(args=[], returncode=255)):
-        print(f"Removing mapping {dns} -> {self._lastDefinedMappings[dns]}")
+        plan = planChanges({}, self._table, scope=[dns])
+        if plan.isEmpty():
+            stderr.write(f"WARNING: No mapping for {dns} to remove\n")
+            return
+
+        print(f"Removing mapping {dns} -> {self._table.ipFor(dns)}")
+        self.queuePlan(plan, doTest=doTest, testRunReturn=testRunReturn)
+
+    def queuePlan(self, plan: Plan, doTest: bool = False, testRunReturn: CompletedProcess[str] = CompletedProcess(args=[], returncode=255)):
+        """Run (or queue, inside a batch) the uci commands for a plan, keeping the mapping table in step"""
+        for change in plan.changes:
+            # With a hosts file or ubus only the table changes here, commit() writes it out
+            if change.action in ("remove", "replace"):
+                if self.editsUciList():
+                    self.runOrQueue(self._cmd_delDns.format(definition=self.shellQuoted(change.oldDefinition)), doTest=doTest, testRunReturn=testRunReturn)
+                self._table.remove(change.oldDefinition)
+            if change.action in ("add", "replace"):
+                if self.editsUciList():
+                    self.runOrQueue(self._cmd_addDns.format(definition=self.shellQuoted(change.newDefinition)), doTest=doTest, testRunReturn=testRunReturn)
+                self._table.add(change.newDefinition)
+
+    def undoPlan(self, plan: Plan):
+        """Put the mapping table back the way it was before queuePlan"""
+        for change in reversed(plan.changes):
+            if change.action in ("add", "replace"):
+                self._table.remove(change.newDefinition)
+            if change.action in ("remove", "replace"):
+                self._table.add(change.oldDefinition)
 
-        #definition = findDefinitionWithDNS(mapp, definedDNS)
-        definition = self.findDefinitionWithDNS(dns)
-        print("DEBUG:  ", self._cmd_delDns.format(definition=definition))
-        #self.doSSHcmd(self._cmd_addDns.format(definition=definition)self._cmd_delDns.format(definition=definition), doTest=doTest, testRunReturn=testRunReturn)
-        self._lastDefinedExtraDNS.remove(definition)
+    def applyPlan(self, plan: Plan, expectFingerprint: Optional[str] = None, doTest: bool = False, testRunReturn: CompletedProcess[str] = CompletedProcess(args=[], returncode=255)) -> List[BatchResult]:
+        """Apply a plan all or nothing, in one ssh session with one commit and reload
+
+        If any command fails the router's pending uci changes are reverted
+        and nothing is committed.
+
+        Args:
+            plan: The changes
+            expectFingerprint: Refuse to change anything unless the router's config still has this
+                fingerprint. Checked first, in the same session as the changes.
+
+        Returns:
+            List[BatchResult]: One result per command sent, the fingerprint check first if there is one
+        """
+        if plan.isEmpty():
+            return []
+
+        self.beginBatch(atomic=True)
+        if expectFingerprint is not None:
+            self.runOrQueue(self.fingerprintGuard(expectFingerprint))
+        self.queuePlan(plan)
+        self.commit()
+        try:
+            results = self.applyBatch(doTest=doTest, testRunReturn=testRunReturn)
+        except BaseException:
+            # Out of time, or ssh could not be run: keep the table in line with a router that did not change
+            self.undoPlan(plan)
+            raise
+
+        if any(res.returncode != 0 for res in results):
+            self.undoPlan(plan)
+        return results
 
     def commit(self, doTest: bool = False, testRunReturn: CompletedProcess[str] = CompletedProcess(args=[], returncode=255)):
+        if self._hostsFile is not None:
+            self.writeHostsFile(doTest=doTest, testRunReturn=testRunReturn)
+            return
+        if self.ubusActive():
+            if self._batch is not None:
+                self._pendingUbusWrite = True
+            else:
+                self.writeUbus(doTest=doTest, testRunReturn=testRunReturn)
+            return
         print("Committing changes")
-        self.doSSHcmd(self._cmd_commit, doTest=doTest, testRunReturn=testRunReturn)
-        self.doSSHcmd(self._cmd_reload, doTest=doTest, testRunReturn=testRunReturn)
+        if self._batch is not None:
+            self._batchCommits = True
+        self.runOrQueue(self._cmd_commit, doTest=doTest, testRunReturn=testRunReturn)
+        self.runOrQueue(self._cmd_reload, doTest=doTest, testRunReturn=testRunReturn)
+
+    def editsUciList(self) -> bool:
+        """True if changes are sent as uci add_list/del_list commands over ssh"""
+        return self._hostsFile is None and self._ubus is None
+
+    # ------------
+    # --- ubus ---
+    # ------------
+    def useUbus(self, client: Optional["UbusClient"], fallback: bool = True):
+        """Read and write the uci address list through rpcd's JSON-RPC API instead of ssh
+
+        Args:
+            client: Logged in lazily on first use. None goes back to ssh.
+            fallback: Use ssh for an operation when ubus fails, instead of failing it
+        """
+        self._ubus = client
+        self._ubusFallback = fallback
+        self._ubusSection = None
+
+    def ubusActive(self) -> bool:
+        # A hosts file is written over ssh, so it takes precedence
+        return self._ubus is not None and self._hostsFile is None
+
+    def ubusDnsmasqSection(self) -> Dict[str, object]:
+        assert self._ubus is not None
+        sections = self._ubus.uciSections("dhcp", "dnsmasq")
+        if len(sections) == 0:
+            from bpe_docker_to_openwrt.UbusClient import UbusError
+            raise UbusError("No dnsmasq section in the dhcp config")
+        self._ubusSection = str(sections[0].get(".name"))
+        return sections[0]
+
+    def getDefinedExtraDNSUbus(self) -> List[str]:
+        # A list option with one value may come back as a plain string
+        address = self.ubusDnsmasqSection().get("address")
+        if isinstance(address, str):
+            definitions = [address]
+        elif isinstance(address, list):
+            definitions = [str(definition) for definition in address]
+        else:
+            definitions = []
+        self._lastQueryOk = True
+        self._lastDefinedExtraDNS = definitions
+        return definitions
+
+    def fullListCommands(self) -> List[str]:
+        """ssh commands that replace the whole address list with the table"""
+        commands = ["uci -q delete dhcp.@dnsmasq[0].address; true"]
+        commands.extend(self._cmd_addDns.format(definition=self.shellQuoted(text)) for text in self._table.keys())
+        commands.extend([self._cmd_commit, self._cmd_reload])
+        return commands
+
+    def writeUbus(self, doTest: bool = False, testRunReturn: CompletedProcess[str] = CompletedProcess(args=[], returncode=255)) -> List[BatchResult]:
+        """Set the whole address list and commit it in one ubus request, falling back to ssh"""
+        assert self._ubus is not None
+        from bpe_docker_to_openwrt.UbusClient import UbusError
+        from http.client import HTTPException
+        definitions = self._table.keys()
+        try:
+            if self._ubusSection is None:
+                self.ubusDnsmasqSection()
+            self._ubus.uciSetAndCommit("dhcp", str(self._ubusSection), {"address": definitions})
+        except (UbusError, HTTPException, OSError, ValueError) as e:
+            if not self._ubusFallback:
+                stderr.write(f"Error updating {self.Target} over ubus: {e}\n")
+                return [BatchResult(self.ubusWriteDescription(len(definitions)), 1, str(e))]
+            stderr.write(f"WARNING: ubus update failed ({e}), falling back to ssh\n")
+            self.beginBatch(atomic=True)
+            for cmd in self.fullListCommands():
+                self.runOrQueue(cmd)
+            self._batchCommits = True
+            return self.applyBatch(doTest=doTest, testRunReturn=testRunReturn)
+
+        if self._stateCache is not None:
+            # The new fingerprint can only be read over ssh
+            self._stateCache.invalidate(self.Target)
+        return [BatchResult(self.ubusWriteDescription(len(definitions)), 0, "")]
+
+    def ubusWriteDescription(self, count: int) -> str:
+        return f"ubus uci set dhcp.{self._ubusSection}.address ({count} entries); ubus uci commit dhcp"
+
+    # ------------------
+    # --- Hosts file ---
+    # ------------------
+    def useHostsFile(self, path: Optional[str] = "/tmp/hosts/bpe-docker", shards: Optional[List[str]] = None):
+        """Keep the mappings in a dnsmasq hosts file instead of the uci address list
+
+        dnsmasq on OpenWrt already reads every file in /tmp/hosts. Updates
+        rewrite the file and send dnsmasq a SIGHUP, which re-reads hosts files
+        without the restart 'service dnsmasq reload' does. Pass None to go back
+        to the uci list.
+
+        Args:
+            path: The hosts file
+            shards: Domains whose names go in a file of their own, path plus '.domain'. Only
+                those files (and path, for anything else) are read, and a change only rewrites
+                the files it touches. Other files in the directory are never looked at.
+        """
+        self._hostsFile = path
+        self._hostsShards = sorted(set(shards or []), key=len, reverse=True)
+        self._hostsHashes = {}
+        self._pendingHostsWrite = None
+        self._table = MappingTable()
+        if path is None:
+            self._hostsShards = []
+            self._cmd_showDns = "uci export dhcp"
+            self._cmd_fingerprint = "cat /etc/config/dhcp /tmp/.uci/dhcp 2>/dev/null | md5sum | cut -d ' ' -f 1"
+            return
+        quoted = " ".join(shlex.quote(hostsPath) for hostsPath in self.hostsFiles())
+        if len(self._hostsShards) == 0:
+            self._cmd_showDns = f"cat {quoted} 2>/dev/null || true"
+        else:
+            self._cmd_showDns = f'for f in {quoted}; do echo "{self._shardMarker}:$f"; cat "$f" 2>/dev/null; done; true'
+        self._cmd_fingerprint = f"cat {quoted} 2>/dev/null | md5sum | cut -d ' ' -f 1"
+
+    def hostsFiles(self) -> List[str]:
+        """Every hosts file this router manages, the unsharded one first"""
+        if self._hostsFile is None:
+            return []
+        return [self._hostsFile] + [self.shardPath(domain) for domain in sorted(self._hostsShards)]
+
+    def shardPath(self, domain: str) -> str:
+        return f"{self._hostsFile}.{domain}"
+
+    def hostsFileFor(self, name: str) -> str:
+        """The hosts file a name belongs in: its most specific shard domain's, or the unsharded one"""
+        key = name.lower()
+        for domain in self._hostsShards:
+            if key == domain or key.endswith("." + domain):
+                return self.shardPath(domain)
+        return self._hostsFile or ""
+
+    def renderHostsFile(self, path: Optional[str] = None) -> str:
+        """Content of one hosts file, the unsharded one by default"""
+        if path is None:
+            path = self._hostsFile
+        lines = [HOSTS_HEADER]
+        for record in self._table.records():
+            names = record.names
+            if len(names) > 0 and (len(self._hostsShards) == 0 or self.hostsFileFor(names[0]) == path):
+                lines.append(f"{record.ip} {' '.join(names)}\n")
+        return "".join(lines)
+
+    def parseHostsFile(self, content: Optional[str]) -> List[str]:
+        """Read the hosts file, or with shards each file in turn behind a marker line"""
+        files: Dict[str, List[str]] = {}
+        if len(self._hostsShards) == 0:
+            files[self._hostsFile or ""] = (content or "").splitlines()
+        else:
+            prefix = self._shardMarker + ":"
+            lines: List[str] = []
+            for line in (content or "").splitlines():
+                if line.startswith(prefix):
+                    lines = files.setdefault(line[len(prefix):], [])
+                else:
+                    lines.append(line)
+
+        definitions: List[str] = []
+        self._hostsHashes = {}
+        for path, lines in files.items():
+            for line in lines:
+                fields = line.split("#", 1)[0].split()
+                if len(fields) >= 2:
+                    definitions.append("/" + "/".join(fields[1:]) + "/" + fields[0])
+            if len(lines) == 0:
+                self._hostsHashes[path] = ""
+            else:
+                self._hostsHashes[path] = md5hex(content or "") if len(self._hostsShards) == 0 else md5hex("\n".join(lines) + "\n")
+        self._lastDefinedExtraDNS = definitions
+        return definitions
+
+    def hostsUploadCommand(self, content: str, digest: str, path: Optional[str] = None) -> str:
+        """One line of shell that replaces the hosts file with content and signals dnsmasq
+
+        Does nothing if the file on the router already has this content.
+        """
+        return self.hostsUploadScript([(path or self._hostsFile or "", content, digest)])
+
+    def hostsUploadScript(self, files: List[Tuple[str, str, str]]) -> str:
+        """One line of shell that replaces each (path, content, md5) file that differs, then signals dnsmasq once
+
+        Fails if any file could not be written, after trying them all.
+        """
+        steps = ["rc=0", "changed="]
+        for path, content, digest in files:
+            quoted = shlex.quote(path)
+            tmpname = shlex.quote(path + ".tmp")
+            directory = shlex.quote(str(pathlib.PurePosixPath(path).parent))
+            lines = " ".join(shlex.quote(line) for line in content.splitlines())
+            steps.append(f'{{ [ "$(md5sum {quoted} 2>/dev/null | cut -d \' \' -f 1)" = "{digest}" ] || '
+                         f"{{ mkdir -p {directory} && printf '%s\\n' {lines} > {tmpname} && mv {tmpname} {quoted} && changed=1; }}; }} || rc=1")
+        steps.append(f'{{ [ -z "$changed" ] || {self._cmd_hup}; }} || rc=1')
+        # A subshell, so the exit status can be set without ending a batch script
+        return "( " + "; ".join(steps) + "; exit $rc )"
+
+    def writeHostsFile(self, doTest: bool = False, testRunReturn: CompletedProcess[str] = CompletedProcess(args=[], returncode=255)):
+        """Upload every hosts file that differs from what the router has, then SIGHUP dnsmasq"""
+        files: List[Tuple[str, str, str]] = []
+        for path in self.hostsFiles():
+            content = self.renderHostsFile(path)
+            digest = md5hex(content)
+            known = self._hostsHashes.get(path)
+            # No need to create a file just to say it has nothing in it
+            if digest != known and not (known == "" and content == HOSTS_HEADER):
+                files.append((path, content, digest))
+        if len(files) == 0:
+            return
+        print(f"Writing {len(self._table)} mappings to {', '.join(path for path, content, digest in files)}")
+        command = self.hostsUploadScript(files)
+        digests = {path: digest for path, content, digest in files}
+        if self._batch is not None:
+            self._batchCommits = True
+            self._pendingHostsWrite = (len(self._batch), digests)
+            self._batch.append(command)
+            return
+        # On stdin, as a big table is more than one command line argument may hold
+        result = self.doSSHcmd(self._cmd_runScript, doTest=doTest, testRunReturn=testRunReturn, inputText=command + "\n")
+        self.recordHostsWrite(digests, result.returncode == 0)
+
+    def recordHostsWrite(self, digests: Dict[str, str], ok: bool):
+        for path, digest in digests.items():
+            if ok:
+                self._hostsHashes[path] = digest
+            else:
+                # Some files may have been written, so none of them are known
+                self._hostsHashes.pop(path, None)
+
+    # ------------------------
+    # --- Connection reuse ---
+    # ------------------------
+    def enableConnectionReuse(self, controlPath: str | pathlib.Path | None = None, persist: int = 60, keepMaster: bool = False):
+        """Share one authenticated ssh connection between calls
+
+        Args:
+            controlPath: Socket for the OpenSSH master. Defaults to a per user/host path in the temp dir
+            persist: Seconds the master lingers after its last client (ControlPersist)
+            keepMaster: Leave the master running on close so later runs in this process reuse it
+        """
+        if controlPath is None:
+            target = f"{self._username}@{self._hostname}:{self._port}"
+            import hashlib
+            import tempfile
+            digest = hashlib.sha1(target.encode()).hexdigest()[:12]
+            # Unix socket paths are limited to ~100 bytes, so keep this short
+            controlPath = pathlib.Path(tempfile.gettempdir()) / f"bpe-d2o-{getuid()}-{digest}"
+        self._controlPath = str(controlPath)
+        self._controlPersist = persist
+        self._keepMaster = keepMaster
+
+    def disableConnectionReuse(self):
+        self.closeConnection(force=True)
+        self._controlPath = None
+
+    def masterAlive(self) -> bool:
+        if self._controlPath is None or not pathlib.Path(self._controlPath).exists():
+            return False
+        return self.runSSHControl(["-O", "check"]).returncode == 0
+
+    def openConnection(self) -> bool:
+        """Start the shared master connection, unless one is already up
+
+        Returns:
+            bool: True if a master connection is available
+        """
+        if self._controlPath is None:
+            self.enableConnectionReuse()
+
+        if self.masterAlive():
+            return True
+
+        # -f backgrounds ssh once authentication is done, -N runs no command
+        self._sshHandshakes += 1
+        result = self.runSSHControl(["-M", "-N", "-f"])
+        if result.returncode != 0:
+            stderr.write(f"WARNING: Could not start shared ssh connection: {result.stderr}\n")
+            return False
+        return True
+
+    def closeConnection(self, force: bool = False):
+        if self._controlPath is None or (self._keepMaster and not force):
+            return
+        if pathlib.Path(self._controlPath).exists():
+            self.runSSHControl(["-O", "exit"])
+
+    def __enter__(self) -> "RouterObject":
+        self.openConnection()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.closeConnection()
+
+    # -------------------
+    # --- Router lock ---
+    # -------------------
+    def useRouterLock(self, path: str = ROUTER_LOCK_PATH, ttl: int = 600):
+        """Take a lock on the router itself around each reconcile, for runs from several hosts
+
+        Args:
+            path: Directory made on the router to hold the lock
+            ttl: Seconds after which a lock is taken to be left by a run that died, and broken
+        """
+        self._routerLock = path
+        self._routerLockTTL = ttl
+
+    def routerLockScript(self) -> str:
+        """Make the lock directory, or, if another run has it, leave a rerun flag and exit ROUTER_LOCK_HELD"""
+        lock = shlex.quote(self._routerLock or ROUTER_LOCK_PATH)
+        flag = shlex.quote((self._routerLock or ROUTER_LOCK_PATH) + ".rerun")
+        return (f'now=$(date +%s); '
+                f'if ! mkdir {lock} 2>/dev/null; then '
+                # Not written yet means it was only just taken
+                f'at=$(cat {lock}/at 2>/dev/null || echo "$now"); '
+                f'if [ $((now - at)) -lt {int(self._routerLockTTL)} ]; then touch {flag}; exit {ROUTER_LOCK_HELD}; fi; '
+                f'rm -rf {lock}; mkdir {lock} || {{ touch {flag}; exit {ROUTER_LOCK_HELD}; }}; '
+                f'fi; echo "$now" > {lock}/at')
+
+    def routerUnlockScript(self) -> str:
+        """Remove the lock directory, printing 'rerun' if another run asked for one while it was held"""
+        lock = shlex.quote(self._routerLock or ROUTER_LOCK_PATH)
+        flag = shlex.quote((self._routerLock or ROUTER_LOCK_PATH) + ".rerun")
+        return f'rm -rf {lock}; if [ -e {flag} ]; then rm -f {flag}; echo rerun; fi'
+
+    def acquireRouterLock(self, doTest: bool = False, testRunReturn: CompletedProcess[str] = CompletedProcess(args=[], returncode=255)) -> bool:
+        """Take the router lock. False if another run holds it, which has then been asked to go again.
+
+        Raises:
+            RuntimeError: If the router could not be asked
+        """
+        if self._routerLock is None or self._routerLockHeld:
+            return True
+        result = self.doSSHcmd(self.routerLockScript(), doTest=doTest, testRunReturn=testRunReturn)
+        if result.returncode == ROUTER_LOCK_HELD:
+            return False
+        if result.returncode != 0:
+            raise RuntimeError(f"Could not take the router lock on {self.Target}: {(result.stderr or '').strip()}")
+        self._routerLockHeld = True
+        return True
+
+    def releaseRouterLock(self, doTest: bool = False, testRunReturn: CompletedProcess[str] = CompletedProcess(args=[], returncode=255)):
+        """Let go of the router lock, noting whether another run asked for a rerun while it was held"""
+        if not self._routerLockHeld:
+            return
+        self._routerLockHeld = False
+        result = self.doSSHcmd(self.routerUnlockScript(), doTest=doTest, testRunReturn=testRunReturn)
+        if result.returncode != 0:
+            stderr.write(f"WARNING: Could not release the router lock on {self.Target}, it lapses after {self._routerLockTTL}s\n")
+        elif "rerun" in (result.stdout or "").split():
+            self._rerunRequested = True
+
+    def takeRerunRequest(self) -> bool:
+        """True once for every time another run asked this router's lock holder to go again"""
+        requested = self._rerunRequested
+        self._rerunRequested = False
+        return requested
+
+    # ---------------
+    # --- Batches ---
+    # ---------------
+    def beginBatch(self, atomic: bool = False):
+        """Start collecting commands instead of running them one ssh call at a time
+
+        Args:
+            atomic: Stop at the first failing command and revert the uncommitted uci changes
+        """
+        if self._batch is not None:
+            raise RuntimeError("A batch is already open")
+        self._batch = []
+        self._batchAtomic = atomic
+        self._batchCommits = False
+        self._pendingHostsWrite = None
+        self._pendingUbusWrite = False
+
+    def cancelBatch(self):
+        self._batch = None
+        self._pendingHostsWrite = None
+        self._pendingUbusWrite = False
+
+    def runOrQueue(self, cmd: str, doTest: bool = False, testRunReturn: CompletedProcess[str] = CompletedProcess(args=[], returncode=255)) -> Optional[CompletedProcess[str]]:
+        if self._batch is not None:
+            self._batch.append(cmd)
+            return None
+        return self.doSSHcmd(cmd, doTest=doTest, testRunReturn=testRunReturn)
+
+    def batchScript(self, commands: List[str], atomic: bool = False) -> str:
+        """Render queued commands as one shell script.
+
+        Every command is followed by a marker line carrying its index and exit
+        status, so the output of a single ssh session can be split back into
+        per-command results.
+        """
+        # A hosts file batch never stages uci changes, so has none of its own to revert
+        revert = f"{self._cmd_revert} >/dev/null 2>&1; " if self._hostsFile is None else ""
+        lines = []
+        for index, cmd in enumerate(commands):
+            if atomic:
+                lines.append(f'{cmd} 2>&1; rc=$?; echo "{self._batchMarker}:{index}:$rc"; '
+                             f'[ $rc -eq 0 ] || {{ {revert}exit $rc; }}')
+            else:
+                lines.append(f'{cmd} 2>&1; echo "{self._batchMarker}:{index}:$?"')
+        return "\n".join(lines) + "\n"
+
+    def parseBatchOutput(self, commands: List[str], output: Optional[str]) -> List[BatchResult]:
+        results: List[BatchResult] = []
+        collected: List[str] = []
+        prefix = self._batchMarker + ":"
+
+        if output is not None:
+            for line in output.splitlines():
+                if line.startswith(prefix):
+                    try:
+                        index, returncode = (int(part) for part in line[len(prefix):].split(":", 1))
+                    except ValueError:
+                        collected.append(line)
+                        continue
+                    if index == len(results) and index < len(commands):
+                        results.append(BatchResult(commands[index], returncode, "\n".join(collected)))
+                        collected = []
+                        continue
+                collected.append(line)
+
+        # Commands without a marker never ran (the session died part way through)
+        for cmd in commands[len(results):]:
+            results.append(BatchResult(cmd, 255, "\n".join(collected)))
+            collected = []
+
+        return results
+
+    def applyBatch(self, doTest: bool = False, testRunReturn: CompletedProcess[str] = CompletedProcess(args=[], returncode=255)) -> List[BatchResult]:
+        """Send every queued command to the router over a single ssh session
+
+        Returns:
+            List[BatchResult]: One result per queued command, in queue order
+        """
+        if self._batch is None:
+            raise RuntimeError("No batch is open")
+
+        with metrics.span("router_apply", router=self.Target):
+            commands = self._batch
+            self._batch = None
+            writeUbus = self._pendingUbusWrite
+            self._pendingUbusWrite = False
+
+            results: List[BatchResult] = []
+            if len(commands) > 0:
+                results = self.runCommands(commands, doTest=doTest, testRunReturn=testRunReturn)
+            if writeUbus and all(res.returncode == 0 for res in results):
+                results.extend(self.writeUbus(doTest=doTest, testRunReturn=testRunReturn))
+            return results
+
+    def runCommands(self, commands: List[str], doTest: bool = False, testRunReturn: CompletedProcess[str] = CompletedProcess(args=[], returncode=255)) -> List[BatchResult]:
+        """Run commands as one script over a single ssh session"""
+        script = self.batchScript(commands, self._batchAtomic)
+        committing = self._stateCache is not None and self._batchCommits
+        if committing and not self._invalidateOnCommit:
+            # Read the new fingerprint in the same session so the cache can follow our own commit
+            script += f'echo "{self._fingerprintMarker}:$({self._cmd_fingerprint})"\n'
+
+        try:
+            result = self.doSSHcmd(self._cmd_runScript, doTest=doTest, testRunReturn=testRunReturn, inputText=script)
+        except BaseException:
+            if self._pendingHostsWrite is not None:
+                # It may or may not have been written
+                self.recordHostsWrite(self._pendingHostsWrite[1], False)
+                self._pendingHostsWrite = None
+            raise
+        fingerprint, output = self.splitFingerprint(result.stdout)
+        results = self.parseBatchOutput(commands, output)
+
+        for res in results:
+            if res.returncode != 0:
+                stderr.write(f"Error running command '{res.command}': {res.output}\n")
+
+        if self._pendingHostsWrite is not None:
+            index, digests = self._pendingHostsWrite
+            self.recordHostsWrite(digests, results[index].returncode == 0)
+            self._pendingHostsWrite = None
+
+        if committing and self._stateCache is not None:
+            if len(fingerprint) > 0 and all(res.returncode == 0 for res in results):
+                self._stateCache.save(self.Target, fingerprint, self._lastDefinedExtraDNS)
+            else:
+                self._stateCache.invalidate(self.Target)
+
+        return results
 
     # ------------------
     # --- Properties ---
@@ -232,3 +1072,63 @@ class RouterObject:
     @property
     def ShellCmd(self) -> str:
         return self._sshexe
+
+    @property
+    def _lastDefinedExtraDNS(self) -> List[str]:
+        return self._table.definitions()
+
+    @_lastDefinedExtraDNS.setter
+    def _lastDefinedExtraDNS(self, definitions: Optional[List[str]]):
+        self._table = MappingTable(definitions)
+
+    @property
+    def _lastDefinedMappings(self) -> Dict[str, str]:
+        return self._table.mappings()
+
+    @property
+    def Mappings(self) -> MappingTable:
+        return self._table
+
+    @property
+    def Hostname(self) -> str:
+        return self._hostname
+
+    @property
+    def Target(self) -> str:
+        return f"{self._username}@{self._hostname}:{self._port}"
+
+    @property
+    def LastQueryOk(self) -> bool:
+        return self._lastQueryOk
+
+    @property
+    def SSHStats(self) -> Dict[str, int]:
+        return {"handshakes": self._sshHandshakes, "commands": self._sshCommands}
+
+    @property
+    def DhcpConfig(self) -> Optional[UciConfig]:
+        return self._dhcpConfig
+
+    @property
+    def Ubus(self) -> Optional["UbusClient"]:
+        return self._ubus
+
+    @property
+    def HostsFile(self) -> Optional[str]:
+        return self._hostsFile
+
+    @property
+    def HostsShards(self) -> List[str]:
+        return list(self._hostsShards)
+
+    @property
+    def RouterLock(self) -> Optional[str]:
+        return self._routerLock
+
+    @property
+    def CacheHits(self) -> int:
+        return self._cacheHits
+
+    @property
+    def InBatch(self) -> bool:
+        return self._batch is not None
@@ -0,0 +1,65 @@
+from sys import stderr
+
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional
+
+from bpe_docker_to_openwrt.RouterObject import RouterObject, BatchResult
+
+
+@dataclass
+class RouterResult:
+    target: str
+    ok: bool
+    error: str = ""
+    results: List[BatchResult] = field(default_factory=list)
+
+    @property
+    def failed(self) -> List[BatchResult]:
+        return [res for res in self.results if res.returncode != 0]
+
+
+def duplicateTargets(routers: List[RouterObject]) -> List[str]:
+    """Targets shared by more than one of routers"""
+    targets = [router.Target for router in routers]
+    return sorted(set(target for target in targets if targets.count(target) > 1))
+
+
+def runOnRouters(routers: List[RouterObject], action: Callable[[RouterObject], Optional[List[BatchResult]]],
+                 maxWorkers: int = 4) -> Dict[str, RouterResult]:
+    """Run action against every router at once, at most maxWorkers at a time
+
+    A router that raises or reports a failed command is marked as failed
+    without affecting the others.
+
+    Returns:
+        Dict[str, RouterResult]: Outcome per router, keyed by RouterObject.Target
+
+    Raises:
+        ValueError: If two routers have the same Target, as one's outcome would hide the other's
+    """
+    duplicates = duplicateTargets(routers)
+    if len(duplicates) > 0:
+        raise ValueError(f"Router given more than once: {', '.join(duplicates)}")
+
+    def runOne(router: RouterObject) -> RouterResult:
+        try:
+            results = action(router) or []
+        except Exception as e:
+            stderr.write(f"ERROR: {router.Target}: {e}\n")
+            return RouterResult(router.Target, False, str(e))
+        outcome = RouterResult(router.Target, True, results=results)
+        if len(outcome.failed) > 0:
+            outcome.ok = False
+            outcome.error = f"{len(outcome.failed)} of {len(results)} commands failed"
+        return outcome
+
+    if len(routers) == 1:
+        # No point paying for a thread
+        outcome = runOne(routers[0])
+        return {outcome.target: outcome}
+
+    # Only needed with several routers, so kept out of startup
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=max(1, min(maxWorkers, len(routers))), thread_name_prefix="router") as pool:
+        outcomes = list(pool.map(runOne, routers))
+    return {outcome.target: outcome for outcome in outcomes}
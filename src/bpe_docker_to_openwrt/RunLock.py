@@ -0,0 +1,114 @@
+import os
+import pathlib
+
+from typing import Callable, Optional
+
+# Times the run holding the lock goes again for runs that asked it to, before leaving the rest to the next run
+MAX_RERUNS = 3
+
+
+class RunLock:
+    """Keeps runs from overlapping, folding a run that would overlap into the one in progress
+
+    The lock is an flock on path, so it goes away with the process holding
+    it, even one that was killed. A run that finds it held leaves a rerun
+    flag (path.rerun) and gives up at once. The run holding the lock clears
+    the flag before each pass and goes again while it is set, so whatever
+    changed while it was busy is picked up once, however many runs asked.
+
+    With path None nothing is locked, and only requestRerun() from within
+    this process causes another pass.
+    """
+
+    def __init__(self, path: Optional[str | pathlib.Path] = None, maxReruns: int = MAX_RERUNS):
+        self._path = pathlib.Path(path).expanduser() if path is not None else None
+        self._maxReruns = maxReruns
+        self._fd: Optional[int] = None
+        self._rerun = False
+
+    def acquire(self) -> bool:
+        """Take the lock without waiting. False if another process holds it."""
+        if self._path is None or self._fd is not None:
+            return True
+        import fcntl
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        # Who holds it, for the runs that find it held
+        os.ftruncate(fd, 0)
+        os.write(fd, f"{os.getpid()}\n".encode())
+        self._fd = fd
+        return True
+
+    def release(self):
+        if self._fd is not None:
+            # Closing drops the flock
+            os.close(self._fd)
+            self._fd = None
+
+    def holder(self) -> str:
+        """pid of the process holding the lock, as it wrote it, '' if unknown"""
+        try:
+            return self._path.read_text().strip() if self._path is not None else ""
+        except OSError:
+            return ""
+
+    # --------------
+    # --- Reruns ---
+    # --------------
+    def requestRerun(self):
+        """Ask the run holding the lock (this one, or another process's) for another pass"""
+        self._rerun = True
+        if self.RerunPath is not None:
+            self.RerunPath.touch()
+
+    def rerunRequested(self) -> bool:
+        return self._rerun or (self.RerunPath is not None and self.RerunPath.exists())
+
+    def clearRerun(self):
+        self._rerun = False
+        if self.RerunPath is not None:
+            self.RerunPath.unlink(missing_ok=True)
+
+    def run(self, action: Callable[[], bool]) -> Optional[bool]:
+        """action under the lock, and again for as long as reruns are asked for
+
+        Returns:
+            Optional[bool]: What the last pass of action returned, None if another run holds the lock and will do it
+        """
+        if not self.acquire():
+            self.requestRerun()
+            # The holder may have checked for reruns and let go in the meantime, then nobody would see the flag
+            if not self.acquire():
+                return None
+
+        passes = 0
+        try:
+            while True:
+                # Whatever asked before now is covered by the pass about to start
+                self.clearRerun()
+                ok = action()
+                passes += 1
+                if self.rerunRequested() and passes <= self._maxReruns:
+                    continue
+                self.release()
+                # A run that found the lock held just before it was let go
+                if passes > self._maxReruns or not self.rerunRequested() or not self.acquire():
+                    return ok
+        finally:
+            self.release()
+
+    # ------------------
+    # --- Properties ---
+    # ------------------
+    @property
+    def Path(self) -> Optional[pathlib.Path]:
+        return self._path
+
+    @property
+    def RerunPath(self) -> Optional[pathlib.Path]:
+        return self._path.with_name(self._path.name + ".rerun") if self._path is not None else None
@@ -0,0 +1,107 @@
+import json
+import pathlib
+import re
+import time
+
+from dataclasses import dataclass, field
+from typing import Any, Dict, List
+
+from bpe_docker_to_openwrt.AtomicWrite import writeAtomic
+from bpe_docker_to_openwrt.ReconcilePlan import Change, Plan
+from bpe_docker_to_openwrt.RouterObject import isRouterSpec
+
+PLAN_FORMAT = 1
+
+re_fingerprint = re.compile(r"[0-9a-f]{32}")
+
+
+class PlanError(ValueError):
+    pass
+
+
+def desiredFingerprint(mappings: Dict[str, str], domains: List[str], frozenDomains: List[str]) -> str:
+    """Fingerprint of a desired state, the same whatever order containers were listed in"""
+    import hashlib
+    data = json.dumps({"mappings": sorted(mappings.items()), "domains": sorted(domains), "frozenDomains": sorted(frozenDomains)})
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+@dataclass
+class RouterPlan:
+    target: str
+    # Router config fingerprint the plan was computed against
+    fingerprint: str
+    plan: Plan = field(default_factory=Plan)
+
+    def toDict(self) -> Dict[str, Any]:
+        return {
+            "target": self.target,
+            "fingerprint": self.fingerprint,
+            "unchanged": self.plan.unchanged,
+            "changes": [{"action": c.action, "old": c.oldDefinition, "new": c.newDefinition} for c in self.plan.changes],
+        }
+
+    @classmethod
+    def fromDict(cls, data: Dict[str, Any]) -> "RouterPlan":
+        target = str(data["target"])
+        if not isRouterSpec(target):
+            # It ends up on the ssh command line
+            raise PlanError(f"Bad router target '{target}'")
+        fingerprint = str(data["fingerprint"])
+        if re_fingerprint.fullmatch(fingerprint) is None:
+            # It ends up in a shell command on the router
+            raise PlanError(f"Bad router fingerprint '{fingerprint}'")
+        changes = []
+        for c in data["changes"]:
+            if c["action"] not in ("add", "remove", "replace"):
+                raise PlanError(f"Unknown change '{c['action']}'")
+            changes.append(Change(str(c["action"]), str(c.get("old", "")), str(c.get("new", ""))))
+        return cls(target, fingerprint, Plan(changes, int(data.get("unchanged", 0))))
+
+
+@dataclass
+class SavedPlan:
+    """Changes for each router, with fingerprints of the docker and router state they were computed from"""
+    dockerFingerprint: str
+    routers: List[RouterPlan] = field(default_factory=list)
+    createdAt: float = field(default_factory=time.time)
+
+    def toJson(self) -> str:
+        return json.dumps({
+            "format": PLAN_FORMAT,
+            "createdAt": self.createdAt,
+            "dockerFingerprint": self.dockerFingerprint,
+            "routers": [router.toDict() for router in self.routers],
+        }, indent=2)
+
+    @classmethod
+    def fromJson(cls, text: str) -> "SavedPlan":
+        """
+        Raises:
+            PlanError: If text is not a plan this version can apply
+        """
+        try:
+            data = json.loads(text)
+            if data.get("format") != PLAN_FORMAT:
+                raise PlanError(f"Unsupported plan format {data.get('format')!r}")
+            routers = [RouterPlan.fromDict(r) for r in data["routers"]]
+            targets = [router.target for router in routers]
+            if len(set(targets)) < len(targets):
+                raise PlanError("A router appears more than once")
+            return cls(str(data["dockerFingerprint"]), routers, float(data["createdAt"]))
+        except PlanError:
+            raise
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            raise PlanError(f"Not a valid plan: {e}")
+
+    def save(self, path: str | pathlib.Path):
+        writeAtomic(path, self.toJson() + "\n")
+
+    @classmethod
+    def load(cls, path: str | pathlib.Path) -> "SavedPlan":
+        """
+        Raises:
+            OSError: If the file could not be read
+            PlanError: If it is not a valid plan
+        """
+        return cls.fromJson(pathlib.Path(path).expanduser().read_text())
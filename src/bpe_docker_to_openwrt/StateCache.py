@@ -0,0 +1,73 @@
+import json
+import os
+import pathlib
+import re
+import time
+
+from dataclasses import dataclass, field
+from typing import Callable, List, Optional
+
+from bpe_docker_to_openwrt.AtomicWrite import writeAtomic
+
+
+def defaultCacheDir() -> pathlib.Path:
+    base = os.environ.get("XDG_CACHE_HOME")
+    if base is None or len(base) == 0:
+        base = str(pathlib.Path("~/.cache").expanduser())
+    return pathlib.Path(base) / "bpe-docker-to-openwrt"
+
+
+@dataclass
+class CachedState:
+    fingerprint: str
+    definitions: List[str] = field(default_factory=list)
+    savedAt: float = 0.0
+
+
+class StateCache:
+    """Last address list read from each router, keyed by the router's config fingerprint
+
+    One small json file per router. An entry older than ttl seconds is not
+    used, so the router is read in full at least that often.
+    """
+
+    def __init__(self, directory: Optional[str | pathlib.Path] = None, ttl: float = 3600.0,
+                 clock: Callable[[], float] = time.time):
+        self._directory = pathlib.Path(directory).expanduser() if directory is not None else defaultCacheDir()
+        self._ttl = ttl
+        self._clock = clock
+
+    def pathFor(self, target: str) -> pathlib.Path:
+        return self._directory / (re.sub(r"[^A-Za-z0-9._-]", "_", target) + ".json")
+
+    def load(self, target: str) -> Optional[CachedState]:
+        """The cached state for target, None if there is none or it has expired"""
+        try:
+            with open(self.pathFor(target), "r") as f:
+                data = json.load(f)
+            state = CachedState(str(data["fingerprint"]), [str(d) for d in data["definitions"]], float(data["savedAt"]))
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        if self._ttl >= 0 and self._clock() - state.savedAt > self._ttl:
+            return None
+        return state
+
+    def save(self, target: str, fingerprint: str, definitions: List[str]):
+        path = self.pathFor(target)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        data = {"fingerprint": fingerprint, "definitions": list(definitions), "savedAt": self._clock()}
+        writeAtomic(path, json.dumps(data))
+
+    def invalidate(self, target: str):
+        self.pathFor(target).unlink(missing_ok=True)
+
+    # ------------------
+    # --- Properties ---
+    # ------------------
+    @property
+    def Directory(self) -> pathlib.Path:
+        return self._directory
+
+    @property
+    def TTL(self) -> float:
+        return self._ttl
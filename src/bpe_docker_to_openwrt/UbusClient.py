@@ -0,0 +1,181 @@
+from http.client import HTTPConnection, HTTPSConnection
+from urllib.parse import urlsplit
+import json
+import threading
+
+from typing import Any, Dict, List, Optional, Tuple
+
+from bpe_docker_to_openwrt.KeepAlive import requestKeepAlive
+from bpe_docker_to_openwrt.Metrics import metrics
+
+# Session id used for the login call itself
+ANONYMOUS_SESSION = "00000000000000000000000000000000"
+
+# ubus status codes (result[0] of a call)
+UBUS_STATUS_OK = 0
+UBUS_STATUS_NOT_FOUND = 4
+UBUS_STATUS_PERMISSION_DENIED = 6
+
+# JSON-RPC error uhttpd returns for an unknown or expired session
+RPC_ACCESS_DENIED = -32002
+
+
+class UbusError(Exception):
+    def __init__(self, message: str, code: Optional[int] = None):
+        super().__init__(message)
+        self.code = code
+
+
+class UbusClient:
+    """Minimal client for OpenWrt's ubus JSON-RPC endpoint (uhttpd-mod-ubus + rpcd)
+
+    Logs in once and reuses the session token and one keep-alive HTTP
+    connection for every call. The login user needs an rpcd ACL that allows
+    reading and writing the dhcp config.
+    """
+
+    def __init__(self, url: str, username: str = "root", password: str = "", timeout: Optional[float] = 10.0):
+        self._url = url
+        self._username = username
+        self._password = password
+        self._timeout = timeout
+        self._conn: Optional[HTTPConnection] = None
+        self._session: Optional[str] = None
+        self._nextId: int = 1
+        # One connection, so calls from several threads take turns
+        self._lock = threading.Lock()
+
+        self._requests: int = 0
+        self._logins: int = 0
+
+    @classmethod
+    def forHost(cls, hostname: str, username: str = "root", password: str = "", https: bool = False, timeout: Optional[float] = 10.0) -> "UbusClient":
+        scheme = "https" if https else "http"
+        return cls(f"{scheme}://{hostname}/ubus", username=username, password=password, timeout=timeout)
+
+    def newConnection(self) -> HTTPConnection:
+        url = urlsplit(self._url)
+        if url.scheme == "https":
+            return HTTPSConnection(url.hostname or "localhost", url.port or 443, timeout=self._timeout)
+        if url.scheme == "http":
+            return HTTPConnection(url.hostname or "localhost", url.port or 80, timeout=self._timeout)
+        raise UbusError(f"Unsupported ubus url '{self._url}'")
+
+    def connection(self) -> HTTPConnection:
+        """The kept-alive connection, opened if there is none"""
+        if self._conn is None:
+            self._conn = self.newConnection()
+        return self._conn
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def __enter__(self) -> "UbusClient":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def post(self, payload: Any) -> Any:
+        """Send one JSON-RPC request (or a list of them) and return the decoded reply"""
+        body = json.dumps(payload).encode()
+        path = urlsplit(self._url).path or "/ubus"
+
+        with self._lock, metrics.span("ubus", url=self._url):
+            response, data = requestKeepAlive(self.connection, self.close, "POST", path, body=body,
+                                              headers={"Content-Type": "application/json"})
+            self._requests += 1
+
+        if response.status >= 400:
+            raise UbusError(f"POST {path} failed with {response.status}: {data.decode(errors='replace').strip()}")
+        return json.loads(data)
+
+    def request(self, session: str, obj: str, method: str, args: Dict[str, Any]) -> Dict[str, Any]:
+        request = {"jsonrpc": "2.0", "id": self._nextId, "method": "call", "params": [session, obj, method, args]}
+        self._nextId += 1
+        return request
+
+    @staticmethod
+    def resultOf(reply: Dict[str, Any]) -> Any:
+        """The data of a call reply
+
+        Raises:
+            UbusError: If the call failed, with the JSON-RPC error or ubus status as code
+        """
+        error = reply.get("error")
+        if error is not None:
+            raise UbusError(f"ubus call failed: {error.get('message', error)}", error.get("code"))
+        result = reply.get("result") or [None]
+        if result[0] != UBUS_STATUS_OK:
+            raise UbusError(f"ubus call failed with status {result[0]}", result[0])
+        return result[1] if len(result) > 1 else None
+
+    def login(self):
+        reply = self.post(self.request(ANONYMOUS_SESSION, "session", "login", {"username": self._username, "password": self._password}))
+        try:
+            data = self.resultOf(reply)
+        except UbusError as e:
+            raise UbusError(f"ubus login as {self._username} failed: {e}", e.code)
+        self._session = (data or {}).get("ubus_rpc_session")
+        if not self._session:
+            raise UbusError(f"ubus login as {self._username} returned no session")
+        self._logins += 1
+
+    def callMany(self, calls: List[Tuple[str, str, Dict[str, Any]]]) -> List[Any]:
+        """Make several calls in one HTTP request, in order
+
+        Logs in first if needed, and once more if the session has expired.
+
+        Returns:
+            List[Any]: The data of each call
+        """
+        for attempt in range(2):
+            if self._session is None:
+                self.login()
+            session = self._session or ANONYMOUS_SESSION
+            replies = self.post([self.request(session, obj, method, args) for obj, method, args in calls])
+            if not isinstance(replies, list):
+                replies = [replies]
+            expired = any((reply.get("error") or {}).get("code") == RPC_ACCESS_DENIED for reply in replies)
+            if expired and attempt == 0:
+                self._session = None
+                continue
+            break
+        return [self.resultOf(reply) for reply in replies]
+
+    def call(self, obj: str, method: str, args: Optional[Dict[str, Any]] = None) -> Any:
+        return self.callMany([(obj, method, args or {})])[0]
+
+    # -----------
+    # --- uci ---
+    # -----------
+    def uciSections(self, config: str, sectionType: str) -> List[Dict[str, Any]]:
+        """Sections of one type in config order"""
+        data = self.call("uci", "get", {"config": config, "type": sectionType}) or {}
+        sections = list((data.get("values") or {}).values())
+        sections.sort(key=lambda section: section.get(".index", 0))
+        return sections
+
+    def uciSetAndCommit(self, config: str, section: str, values: Dict[str, Any]):
+        """Set options and commit them in one request
+
+        rpcd announces the commit to procd, which reloads the services using
+        config, so no separate reload is needed.
+        """
+        self.callMany([
+            ("uci", "set", {"config": config, "section": section, "values": values}),
+            ("uci", "commit", {"config": config}),
+        ])
+
+    # ------------------
+    # --- Properties ---
+    # ------------------
+    @property
+    def Url(self) -> str:
+        return self._url
+
+    @property
+    def Stats(self) -> Dict[str, int]:
+        return {"requests": self._requests, "logins": self._logins}
@@ -0,0 +1,181 @@
+import re
+
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+# One piece of a word: a quoted run, an escaped character or plain text.
+# Whitespace ends a word and # outside quotes starts a comment.
+re_uci_piece = re.compile(r"""'([^']*)'|"((?:[^"\\]|\\.)*)"|\\(.)|([^\s'"\\#]+)|(\s+)|(#.*)""", re.S)
+re_double_escape = re.compile(r"\\(.)", re.S)
+re_anonymous_ref = re.compile(r"@([^\[\]]+)\[(-?\d+)\]")
+
+
+class UciParseError(ValueError):
+    pass
+
+
+def tokenize(text: str) -> List[str]:
+    """Split a line into words the way uci quotes them (and a shell reads them)
+
+    Handles 'single' and "double" quotes, backslash escapes and quote
+    concatenation such as 'it'\\''s'. Runs in one pass over the line.
+
+    Raises:
+        UciParseError: On an unterminated quote
+    """
+    words: List[str] = []
+    current: List[str] = []
+    inWord = False
+    pos = 0
+    for match in re_uci_piece.finditer(text):
+        if match.start() != pos:
+            # Only a quote without its closing partner is left unmatched
+            break
+        pos = match.end()
+        single, double, escaped, plain, space, comment = match.groups()
+        if space is not None or comment is not None:
+            if inWord:
+                words.append("".join(current))
+                current = []
+                inWord = False
+            continue
+        inWord = True
+        if single is not None:
+            current.append(single)
+        elif double is not None:
+            current.append(re_double_escape.sub(r"\1", double))
+        elif escaped is not None:
+            current.append(escaped)
+        else:
+            current.append(plain)
+    if pos != len(text):
+        raise UciParseError(f"Unterminated quote in: {text}")
+    if inWord:
+        words.append("".join(current))
+    return words
+
+
+@dataclass
+class UciSection:
+    type: str
+    # Section name, or '@type[index]' for an anonymous section that was not shown with its cfg name
+    name: str
+    index: int = 0
+    options: Dict[str, str] = field(default_factory=dict)
+    lists: Dict[str, List[str]] = field(default_factory=dict)
+
+    def get(self, key: str) -> Optional[str]:
+        return self.options.get(key)
+
+    def getList(self, key: str) -> List[str]:
+        """Values of a list, or a one item list for an option (uci show cannot tell them apart)"""
+        if key in self.lists:
+            return list(self.lists[key])
+        if key in self.options:
+            return [self.options[key]]
+        return []
+
+
+@dataclass
+class UciConfig:
+    name: str
+    sections: List[UciSection] = field(default_factory=list)
+    # Lookup indexes, kept in step by addSection
+    _byName: Dict[str, UciSection] = field(default_factory=dict, repr=False, compare=False)
+    _byType: Dict[str, List[UciSection]] = field(default_factory=dict, repr=False, compare=False)
+
+    def sectionsOfType(self, sectionType: str) -> List[UciSection]:
+        return list(self._byType.get(sectionType, ()))
+
+    def section(self, name: str) -> Optional[UciSection]:
+        """Find a section by name or by '@type[index]' reference"""
+        found = self._byName.get(name)
+        if found is not None:
+            return found
+        match = re_anonymous_ref.fullmatch(name)
+        if match is not None:
+            ofType = self._byType.get(match.group(1), [])
+            index = int(match.group(2))
+            if -len(ofType) <= index < len(ofType):
+                return ofType[index]
+        return None
+
+    def addSection(self, sectionType: str, name: Optional[str] = None) -> UciSection:
+        ofType = self._byType.setdefault(sectionType, [])
+        section = UciSection(sectionType, name or f"@{sectionType}[{len(ofType)}]", len(ofType))
+        self.sections.append(section)
+        ofType.append(section)
+        self._byName[section.name] = section
+        return section
+
+
+def parseExport(text: str) -> Dict[str, UciConfig]:
+    """Parse 'uci export' output (or a config file) into configs by name"""
+    configs: Dict[str, UciConfig] = {}
+    config: Optional[UciConfig] = None
+    section: Optional[UciSection] = None
+
+    for lineno, line in enumerate(text.splitlines(), 1):
+        words = tokenize(line)
+        if len(words) == 0:
+            continue
+        keyword = words[0]
+        if keyword == "package" and len(words) == 2:
+            config = configs.setdefault(words[1], UciConfig(words[1]))
+            section = None
+        elif keyword == "config" and len(words) in (2, 3):
+            if config is None:
+                # A bare config file has no package line
+                config = configs.setdefault("", UciConfig(""))
+            section = config.addSection(words[1], words[2] if len(words) == 3 else None)
+        elif keyword in ("option", "list") and len(words) == 3 and section is not None:
+            if keyword == "option":
+                section.options[words[1]] = words[2]
+            else:
+                section.lists.setdefault(words[1], []).append(words[2])
+        else:
+            raise UciParseError(f"Line {lineno}: unexpected '{line.strip()}'")
+    return configs
+
+
+def parseShow(text: str) -> Dict[str, UciConfig]:
+    """Parse 'uci show' output (config.section=type and config.section.option=values lines)"""
+    configs: Dict[str, UciConfig] = {}
+
+    for lineno, line in enumerate(text.splitlines(), 1):
+        if len(line.strip()) == 0:
+            continue
+        key, sep, value = line.partition("=")
+        parts = key.strip().split(".")
+        if sep == "" or len(parts) not in (2, 3):
+            raise UciParseError(f"Line {lineno}: unexpected '{line.strip()}'")
+        config = configs.setdefault(parts[0], UciConfig(parts[0]))
+        words = tokenize(value)
+
+        if len(parts) == 2:
+            if config.section(parts[1]) is None and len(words) == 1:
+                config.addSection(words[0], parts[1])
+            continue
+
+        section = config.section(parts[1])
+        if section is None:
+            # An option shown without its section line
+            match = re_anonymous_ref.fullmatch(parts[1])
+            section = config.addSection(match.group(1) if match else "", parts[1])
+        if len(words) == 1:
+            section.options[parts[2]] = words[0]
+        else:
+            section.lists[parts[2]] = words
+    return configs
+
+
+def parseUci(text: str) -> Dict[str, UciConfig]:
+    """Parse either 'uci export' or 'uci show' output"""
+    for line in text.splitlines():
+        words = line.split(None, 1)
+        if len(words) == 0:
+            continue
+        if words[0] in ("package", "config"):
+            return parseExport(text)
+        return parseShow(text)
+    return {}
@@ -0,0 +1,6 @@
+# SPDX-FileCopyrightText: 2025-present Doc1979 <lastdoc39@gmail.com>
+#
+# SPDX-License-Identifier: MIT
+from bpe_docker_to_openwrt.main import run
+
+raise SystemExit(run())
@@ -1,15 +1,44 @@
-#from typing import List
-#from typing import Optional
+from typing import List
 from typing import Dict
 from typing import Any
-from subprocess import CalledProcessError, CompletedProcess
-from subprocess import run as runprocess
+from typing import Optional
+from typing import Callable
+from typing import Tuple
+from typing import Iterable
+from typing import Iterator
+from typing import TYPE_CHECKING
+from subprocess import CalledProcessError, CompletedProcess, TimeoutExpired
+from subprocess import Popen, PIPE
 from sys import stderr
 #from os import stdout
+import builtins
+import importlib
+import io
+import ipaddress
+import os
 import pathlib
+import argparse
 import re
 
-from bpe_docker_to_openwrt.RouterObject import RouterObject
+from functools import lru_cache, partial
+
+from dataclasses import dataclass, field
+
+from bpe_docker_to_openwrt.RouterObject import FINGERPRINT_CHANGED, RouterObject, BatchResult
+from bpe_docker_to_openwrt.RouterPool import RouterResult, duplicateTargets, runOnRouters
+from bpe_docker_to_openwrt.ReconcilePlan import Plan, planChanges
+from bpe_docker_to_openwrt.StateCache import StateCache, defaultCacheDir
+from bpe_docker_to_openwrt.RunLock import RunLock
+from bpe_docker_to_openwrt.ContainerRecord import ContainerRecord
+from bpe_docker_to_openwrt.Deadline import DeadlineExceeded, killGroup, runDeadline
+from bpe_docker_to_openwrt.Metrics import metrics
+from bpe_docker_to_openwrt.NamingRules import HOSTNAME_LABEL, MAX_NAME_LENGTH, NamingRules
+from bpe_docker_to_openwrt.SavedPlan import PlanError, RouterPlan, SavedPlan, desiredFingerprint
+
+# The docker and ubus clients pull in http.client (and ssl), so they are
+# imported where they are used
+if TYPE_CHECKING:
+    from bpe_docker_to_openwrt.DockerClient import DockerClient
 
 from bpe_docker_to_openwrt.__about__ import __version__
 from bpe_docker_to_openwrt.__about__ import __title__, __description__, __url__, __author__  # noqa: F401
@@ -17,130 +46,720 @@ from bpe_docker_to_openwrt.__about__ import __title__, __description__, __url__,
 # ---------------------------
 # --- Conditional imports ---
 # ---------------------------
-# If rich is installed, use pretty print, otherwise use standard print
-try:
-    from rich.pretty import pprint as original_pprint
-    def pprint(*args: Any, **kwargs: Any) -> Any:
-        return original_pprint(*args, **kwargs)
-except ImportError:
-    def pprint(*args: Any, **kwargs: Any) -> Any:
-        return print(*args, **kwargs)
-
-# If rich is installed, use the color enhanced print from rich
-try:
-    from rich import print
-except ImportError:
-    pass
-
-# If rich is installed, install rich traceback for nicer looking exceptions
-try:
-    from rich.traceback import install
-    install()
-except ImportError:
-    pass
+# rich is optional and slow to import, so it is only loaded the first time
+# output is rendered, never at import time
+@lru_cache(maxsize=None)
+def richAttr(module: str, name: str) -> Any:
+    """rich's module.name, or None if rich is not installed"""
+    try:
+        return getattr(importlib.import_module(module), name)
+    except (ImportError, AttributeError):
+        return None
+
+def print(*args: Any, **kwargs: Any) -> Any:
+    # If rich is installed, use the color enhanced print from rich
+    richPrint = richAttr("rich", "print")
+    if richPrint is not None:
+        return richPrint(*args, **kwargs)
+    return builtins.print(*args, **kwargs)
+
+def pprint(*args: Any, **kwargs: Any) -> Any:
+    # If rich is installed, use pretty print, otherwise use standard print
+    richPprint = richAttr("rich.pretty", "pprint")
+    if richPprint is not None:
+        return richPprint(*args, **kwargs)
+    return builtins.print(*args, **kwargs)
 # ---------------------------
 
-def getContainerIPs(replaceUnderscores: str = "-", replaceDots: str = ".", replaceColons: str = "-", replaceSymbols: str = "", doTest: bool = False, testRunReturn: CompletedProcess[str] = CompletedProcess(args=[], returncode=255)) -> Dict[str, str]:
-    """Get a dictionary of docker container names and their IP addresses
-    
-    Uses the shell command: docker ps -q | xargs docker inspect --format '{{.Name}} {{range .NetworkSettings.Networks}}{{.IPAddress}}{{end}}' | sed 's/\\///'
+@lru_cache(maxsize=16)
+def namingRules(replaceUnderscores: str = "-", replaceDots: str = ".", replaceColons: str = "-", replaceSymbols: str = "") -> NamingRules:
+    """Rules with just these replacements, compiled once per combination"""
+    return NamingRules(replaceUnderscores, replaceDots, replaceColons, replaceSymbols)
+
+def sanitizeContainerName(name: str, replaceUnderscores: str = "-", replaceDots: str = ".", replaceColons: str = "-", replaceSymbols: str = "") -> str:
+    return namingRules(replaceUnderscores, replaceDots, replaceColons, replaceSymbols).translate(name)
+
+def namedContainers(rules: NamingRules, records: Iterable[ContainerRecord], source: str) -> Dict[str, str]:
+    mappings, collisions = rules.assign(records)
+    metrics.count("name_collisions", len(collisions), source=source)
+    return mappings
+
+re_container_name = re.compile(r"[a-zA-Z0-9_\-\.\@\#\$\:\%]+")
+
+# One line per container: its name, then network=ipv4,ipv6 for each network it is on.
+# xargs -r: with nothing running, 'docker inspect' without arguments would fail the listing.
+containerListCmd = (r"docker ps -q | xargs -r docker inspect --format "
+                    r"'{{.Name}}{{range $net, $cfg := .NetworkSettings.Networks}} {{$net}}={{$cfg.IPAddress}},{{$cfg.GlobalIPv6Address}}{{end}}'")
+
+def parseContainerLine(line: str) -> Optional[ContainerRecord]:
+    """Tokenize one line of container listing output
+
+    Takes 'name net=ip[,ip] ...' as well as the older 'name ip ...' form.
+    Works in a single pass over the tokens, so a long malformed line costs
+    no more than a long good one.
 
     Returns:
-        Dict[str, str]: A dictionary of container names and their IP addresses
+        Optional[ContainerRecord]: The container, or None if the line is malformed
+    """
+    fields = line.split()
+    if len(fields) < 2:
+        return None
+    name = fields[0].lstrip("/")
+    if re_container_name.fullmatch(name) is None:
+        return None
+
+    networks: Dict[str, List[str]] = {}
+    for token in fields[1:]:
+        netname, sep, addrs = token.rpartition("=")
+        for addr in addrs.split(","):
+            if len(addr) == 0:
+                continue
+            try:
+                ipaddress.ip_address(addr)
+            except ValueError:
+                return None
+            networks.setdefault(netname, []).append(addr)
+    return ContainerRecord(name=name, networks=networks)
+
+def iterContainerRecords(doTest: bool = False, testRunReturn: CompletedProcess[str] = CompletedProcess(args=[], returncode=255),
+                         timeout: Optional[float] = 60.0) -> Iterator[ContainerRecord]:
+    """Yield containers as the docker cli reports them, without holding its whole output
+
+    The cli and everything it starts are killed if it runs past timeout
+    (or the run's deadline), or if the caller stops reading early.
+
+    Raises:
+        CalledProcessError: If the listing command fails (after the records it did produce)
+        TimeoutExpired: If it was killed for taking too long
+        DeadlineExceeded: If the run is out of time before it could start
     """
+    timer = None
+    if doTest:
+        stderr.write(f"Test: cmd[{containerListCmd}]\n")
+        lines: Iterable[str] = io.StringIO(testRunReturn.stdout or "")
+        proc = None
+    else:
+        import tempfile
+        import threading
+        timeout = runDeadline.timeoutFor(timeout, "listing containers")
+        errors = tempfile.TemporaryFile(mode="w+")
+        proc = Popen(['bash', '-c', containerListCmd], stdout=PIPE, stderr=errors, text=True, start_new_session=True)
+        lines = proc.stdout or []
+        if timeout is not None:
+            # Reading blocks for as long as docker is silent, so the kill has to come from elsewhere
+            timer = threading.Timer(timeout, killGroup, args=(proc,))
+            timer.daemon = True
+            timer.start()
 
-    # Note: regex is proving difficult to match, and capture multipe ips
+    try:
+        for line in lines:
+            if len(line.strip()) == 0:
+                continue
+            record = parseContainerLine(line)
+            if record is None:
+                stderr.write(f"WARNING: Could not parse line '{line.rstrip()}'\n")
+                continue
+            yield record
+    finally:
+        if proc is not None:
+            if timer is not None:
+                timer.cancel()
+            if proc.poll() is None:
+                # The caller stopped early or something went wrong, so don't leave docker running
+                killGroup(proc)
+            if proc.stdout is not None:
+                proc.stdout.close()
+            returncode = proc.wait()
+            errors.seek(0)
+            errorText = errors.read()
+            errors.close()
+        else:
+            returncode = testRunReturn.returncode
+            errorText = testRunReturn.stderr or ""
+
+    if timer is not None and timer.finished.is_set() and returncode < 0:
+        raise TimeoutExpired(containerListCmd, timeout or 0, stderr=errorText)
+    if returncode != 0:
+        raise CalledProcessError(returncode, containerListCmd, stderr=errorText)
+
+def getContainerIPs(replaceUnderscores: str = "-", replaceDots: str = ".", replaceColons: str = "-", replaceSymbols: str = "", doTest: bool = False, testRunReturn: CompletedProcess[str] = CompletedProcess(args=[], returncode=255),
+                    timeout: Optional[float] = 60.0, rules: Optional[NamingRules] = None, raiseErrors: bool = False) -> Dict[str, str]:
+    """Get a dictionary of docker container names and their IP addresses
 
-    querryCmd = r"docker ps -q | xargs docker inspect --format '{{.Name}} {{range .NetworkSettings.Networks}}{{.IPAddress}}{{end}}' | sed 's/\///'"
-    #re_valid_name_followed_by_ips = re.compile(r"^([a-zA-Z0-9_\-\.\@\#\$\%]+)(?:\s+([0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}|[0-9a-fA-F:]+))+$", re.M | re.S)
-    #re_valid_name_followed_by_ips = re.compile(r"^([a-zA-Z0-9_\-\.\@\#\$\%]+)(\s*[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}|\s*[0-9a-fA-F:]+)+$", re.M | re.S)
+    Reads the docker cli's output line by line (see iterContainerRecords).
+    The cli does not report labels, so only rules that work from the
+    container name apply. rules replaces the replace* arguments.
 
-    # I was strugling with capturing multiple ips. It would match those lines, but only capture one ip. I finally asked copilot for help and it gave me this regex
-    re_valid_name_followed_by_ips = re.compile(r"^([a-zA-Z0-9_\-\.\@\#\$\:\%]+)((?:\s+[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}|\s+[0-9a-fA-F:]+)+)$", re.M | re.S)
-    re_match_symbol = re.compile(r"[\@\#\$\%\\]")
-        
-    #print(querryCmd)
-    if not doTest:
+    Args:
+        raiseErrors: Raise when the cli fails instead of reporting no containers, for callers
+            that must not mistake a failed listing for an empty one
+
+    Raises:
+        TimeoutExpired, DeadlineExceeded: If the cli ran out of time. Unlike other
+            failures this is not reported as no containers, as the listing may be cut short.
+        CalledProcessError, OSError: With raiseErrors, if the cli failed
+
+    Returns:
+        Dict[str, str]: A dictionary of container names and their first IP address
+    """
+    if rules is None:
+        rules = namingRules(replaceUnderscores, replaceDots, replaceColons, replaceSymbols)
+    # The docker cli runs for as long as its output is being read, so this times the subprocess too
+    with metrics.span("docker_discovery", source="cli"):
         try:
-            result = runprocess(['bash', '-c', querryCmd], capture_output=True, text=True)
-        except CalledProcessError as e:
-            stderr.write(f"Error running command '{str(querryCmd)}': {e}\n")
+            outDict = namedContainers(rules, iterContainerRecords(doTest=doTest, testRunReturn=testRunReturn, timeout=timeout), "cli")
+        except (TimeoutExpired, DeadlineExceeded):
+            raise
+        except (CalledProcessError, OSError) as e:
+            stderr.write(f"ERROR: Error querying docker containers: {getattr(e, 'stderr', None) or e}\n")
+            if raiseErrors:
+                raise
             return {}
-    else:
-        stderr.write(f"Test: cmd[{querryCmd}]\n")
-        result = testRunReturn
-
-    if result.returncode != 0:
-        stderr.write("ERROR: Error querying docker containers: {result.stderr}\n")
-        return {}
-
-    outDict = {}
-    # TODO: Consider replacing the for loop with just the findall
-    for line in result.stdout.split("\n"):
-        if len(line) > 0:
-            # Redo this area to a regex match
-            match = re_valid_name_followed_by_ips.findall(line)
-            
-            if match is not None and len(match) > 0:
-                for m in match:
-                    name: str = m[0]
-                    ips = m[1].strip().split(" ")
-                    # TODO: Consider only adding ipv4 addresses
-                    if len(name) > 0:
-                        name = name.replace(r"_", replaceUnderscores).replace(r".", replaceDots).replace(r":", replaceColons)
-                        name = re_match_symbol.sub(replaceSymbols, name)
-                        # take only the first ip
-                        outDict[name] = ips[0]
-            else:
-                stderr.write(f"WARNING: Could not parse line '{line}'\n")
 
+    metrics.count("containers_discovered", len(outDict), source="cli")
     return outDict
 
-def main():
-
-    identity_file = pathlib.Path(__file__).resolve().parent.parent / ".secrets" / "openwrt_id_rsa"
-    base_domain = "docker.ardite.lan"
-
-    router: RouterObject = RouterObject("openwrt.lan", identity_file=identity_file)
-
-    container_listing: Dict[str, str] = getContainerIPs()
-
-    definedDNS = router.getDefinedExtraDNS()
-    if definedDNS is not None:
-        pprint(definedDNS)
-        mappings = router.mappingsFromDefinitions(definedDNS)
-        pprint(mappings)
-    
-    # Determine if any of the mappings may be old containers
-    dns2remove: Dict[str, str] = {}
-    for mapp in mappings:
-        if mapp.endswith(base_domain):
-            # This might be an old container
-            container = mapp[:-len(base_domain)]
-            if container not in container_listing:
-                dns2remove[mapp] = mappings[mapp]
-
-    # Determine if any of the containers are not in the mappings
-    dns2add: Dict[str, str] = {}
-    for container in container_listing:
-        wanted_name = f"{container}.{base_domain}"
-        if wanted_name not in mappings:
-            print(f"Could not find mapping for {container}")
-            dns2add[wanted_name] = container_listing[container]
+def getContainerIPsFromDocker(client: Optional["DockerClient"] = None, replaceUnderscores: str = "-", replaceDots: str = ".", replaceColons: str = "-", replaceSymbols: str = "",
+                              rules: Optional[NamingRules] = None) -> Dict[str, str]:
+    """Get a dictionary of docker container names and their IP addresses from the Docker Engine API
+
+    Same result as getContainerIPs, but asks the engine directly over its socket
+    instead of running the docker cli.
+
+    Raises:
+        DockerError, OSError: If the engine could not be queried
+
+    Returns:
+        Dict[str, str]: A dictionary of container names and their IP addresses
+    """
+    if client is None:
+        from bpe_docker_to_openwrt.DockerClient import DockerClient
+        client = DockerClient()
+
+    if rules is None:
+        rules = namingRules(replaceUnderscores, replaceDots, replaceColons, replaceSymbols)
+    with metrics.span("docker_discovery", source="api"):
+        outDict = namedContainers(rules, client.listContainers(), "api")
+
+    metrics.count("containers_discovered", len(outDict), source="api")
+    return outDict
+
+def getContainerIPsFromSwarm(client: Optional["DockerClient"] = None, rules: Optional[NamingRules] = None) -> Dict[str, str]:
+    """Get a dictionary of swarm service and task names and their IP addresses, for the whole cluster
+
+    client has to be connected to a manager. See DockerClient.swarmRecordsFromJSON
+    for which address each service and task gets.
+
+    Raises:
+        DockerError, OSError: If the swarm could not be queried
+
+    Returns:
+        Dict[str, str]: A dictionary of service and task names and their IP addresses
+    """
+    if client is None:
+        from bpe_docker_to_openwrt.DockerClient import DockerClient
+        client = DockerClient()
+
+    if rules is None:
+        rules = namingRules()
+    with metrics.span("docker_discovery", source="swarm"):
+        outDict = namedContainers(rules, client.listSwarm(), "swarm")
+
+    metrics.count("containers_discovered", len(outDict), source="swarm")
+    return outDict
+
+@dataclass
+class DockerEndpoint:
+    url: Optional[str]
+    domain: str
+
+    @classmethod
+    def fromSpec(cls, spec: Optional[str], defaultDomain: str) -> "DockerEndpoint":
+        """Parse 'URL[,DOMAIN]', where a missing URL means $DOCKER_HOST or the local socket"""
+        if spec is None:
+            return cls(None, defaultDomain)
+        url, _, domain = spec.partition(",")
+        return cls(url if len(url) > 0 else None, domain if len(domain) > 0 else defaultDomain)
+
+    @property
+    def label(self) -> str:
+        return self.url if self.url is not None else "local"
+
+
+@dataclass
+class MappingConflict:
+    name: str
+    # (endpoint label, ip) for every host that wants the name
+    claims: List[Tuple[str, str]]
+
+
+@dataclass
+class DesiredState:
+    # fully qualified name -> ip
+    mappings: Dict[str, str] = field(default_factory=dict)
+    # Domains of endpoints that answered
+    domains: List[str] = field(default_factory=list)
+    # Domains of endpoints that did not. Records under them are left alone.
+    frozenDomains: List[str] = field(default_factory=list)
+    conflicts: List[MappingConflict] = field(default_factory=list)
+    errors: Dict[str, str] = field(default_factory=dict)
+
+
+def listingFromEndpoint(endpoint: DockerEndpoint, timeout: Optional[float] = 60.0, rules: Optional[NamingRules] = None, swarm: bool = False) -> Dict[str, str]:
+    from bpe_docker_to_openwrt.DockerClient import DockerClient, DockerError
+    with DockerClient(endpoint.url, timeout=runDeadline.timeoutFor(timeout, f"listing containers on {endpoint.label}")) as client:
+        if swarm:
+            # The cli can't stand in here, it would only list this node's containers
+            return getContainerIPsFromSwarm(client, rules=rules)
+        try:
+            return getContainerIPsFromDocker(client, rules=rules)
+        except (DockerError, OSError) as e:
+            if endpoint.url is not None:
+                raise
+            stderr.write(f"WARNING: Docker API unavailable ({e}), falling back to the docker cli\n")
+    # An empty listing would remove every mapping under the domain, so a failure has to freeze it instead
+    return getContainerIPs(timeout=timeout, rules=rules, raiseErrors=True)
+
+def collectContainers(endpoints: List[DockerEndpoint], maxWorkers: int = 4,
+                      listing: Callable[[DockerEndpoint], Dict[str, str]] = listingFromEndpoint) -> DesiredState:
+    """Query every docker endpoint at once and merge the results into one desired state
+
+    A name claimed by more than one endpoint with different ips is reported
+    as a conflict and left out, rather than letting the endpoints fight
+    over it.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    def fetch(endpoint: DockerEndpoint) -> Tuple[DockerEndpoint, Optional[Dict[str, str]], str]:
+        try:
+            return endpoint, listing(endpoint), ""
+        except Exception as e:
+            return endpoint, None, str(e)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(maxWorkers, len(endpoints))), thread_name_prefix="docker") as pool:
+        fetched = list(pool.map(fetch, endpoints))
+
+    state = DesiredState()
+    claims: Dict[str, List[Tuple[str, str]]] = {}
+    for endpoint, containers, error in fetched:
+        if containers is None:
+            stderr.write(f"ERROR: Could not list containers on {endpoint.label}: {error}\n")
+            state.errors[endpoint.label] = error
+            state.frozenDomains.append(endpoint.domain)
+            continue
+        state.domains.append(endpoint.domain)
+        for container, ip in containers.items():
+            claims.setdefault(f"{container}.{endpoint.domain}", []).append((endpoint.label, ip))
+
+    for name, nameClaims in claims.items():
+        if len(set(ip for label, ip in nameClaims)) > 1:
+            stderr.write(f"WARNING: {name} is claimed with different ips by {', '.join(label for label, ip in nameClaims)}, skipping it\n")
+            state.conflicts.append(MappingConflict(name, nameClaims))
         else:
-            print(f"Found mapping for {container}: {mappings[wanted_name]}")
+            state.mappings[name] = nameClaims[0][1]
+
+    # A domain that is also served by a failed endpoint can't be trusted to be complete
+    state.domains = [domain for domain in dict.fromkeys(state.domains) if domain not in state.frozenDomains]
+    return state
+
+def ownerDomain(name: str, domains: List[str]) -> Optional[str]:
+    """The most specific domain that name falls under"""
+    owner: Optional[str] = None
+    for domain in domains:
+        if name.endswith(f".{domain}") and (owner is None or len(domain) > len(owner)):
+            owner = domain
+    return owner
+
+def planFor(router: RouterObject, desired: Dict[str, str], domains: List[str], frozenDomains: List[str] = []) -> Plan:
+    """The changes that bring the router's mappings (as last read) under domains in line with desired"""
+    allDomains = list(domains) + list(frozenDomains)
+    with metrics.span("plan", router=router.Target):
+        plan = planChanges(desired, router.Mappings, owned=lambda name: ownerDomain(name, allDomains) in domains)
+    for action, count in plan.counts().items():
+        metrics.count("mappings", count, action=action, router=router.Target)
+    return plan
+
+def reconcile(router: RouterObject, desired: Dict[str, str], domains: List[str], frozenDomains: List[str] = []) -> List[BatchResult]:
+    """Bring the router's mappings under domains in line with desired
+
+    Mappings that belong to frozenDomains (or to no managed domain) are
+    never removed.
+
+    Raises:
+        RuntimeError: If the router's current mappings could not be read
+
+    Returns:
+        List[BatchResult]: The router commands that were run
+    """
+
+    router.getDefinedExtraDNS()
+    if not router.LastQueryOk:
+        # Carrying on would re-add every container as if the router were empty
+        raise RuntimeError(f"Could not read current mappings from {router.Target}")
+
+    plan = planFor(router, desired, domains, frozenDomains)
+    if plan.isEmpty():
+        print(f"No changes needed ({plan.unchanged} mappings up to date)")
+        return []
+
+    for change in plan.changes:
+        print(change)
+
+    # The whole plan goes out in one ssh session and is reverted on the router if any step fails
+    results = router.applyPlan(plan)
+    failed = [res for res in results if res.returncode != 0]
+    print(f"Applied {len(results) - len(failed)} of {len(results)} router commands")
+    return results
+
+def reconcileRouters(routers: List[RouterObject], state: DesiredState, maxWorkers: int = 4) -> Dict[str, RouterResult]:
+    """Reconcile several routers against the same desired state at the same time
+
+    Each router is read and diffed on its own, so one that is behind (or
+    unreachable) does not hold up or affect the others.
+    """
+
+    def reconcileOne(router: RouterObject) -> List[BatchResult]:
+        with router:
+            if not router.acquireRouterLock():
+                print(f"{router.Target}: another run holds the router lock and will reconcile it again")
+                return []
+            try:
+                return reconcile(router, state.mappings, state.domains, state.frozenDomains)
+            finally:
+                router.releaseRouterLock()
+
+    return runOnRouters(routers, reconcileOne, maxWorkers)
+
+def saveRouterPlans(routers: List[RouterObject], state: DesiredState, path: str, maxWorkers: int = 4) -> bool:
+    """Work out every router's changes and write them to path without applying any
+
+    Each router's address list is read together with its config
+    fingerprint, so applySavedPlan can tell if it has changed since.
+    """
+
+    def planOne(router: RouterObject) -> RouterPlan:
+        with router:
+            definitions, fingerprint = router.getDefinedExtraDNSWithFingerprint()
+        if definitions is None or len(fingerprint) == 0:
+            raise RuntimeError(f"Could not read current mappings from {router.Target}")
+        return RouterPlan(router.Target, fingerprint, planFor(router, state.mappings, state.domains, state.frozenDomains))
+
+    saved = SavedPlan(desiredFingerprint(state.mappings, state.domains, state.frozenDomains))
+    # runOnRouters hands back batch results, so collect the plans on the side
+    plans: Dict[str, RouterPlan] = {}
+
+    def record(router: RouterObject) -> List[BatchResult]:
+        plans[router.Target] = planOne(router)
+        return []
 
-    # remove old mappings
-    if len(dns2remove) > 0:
-        for mapp in dns2remove:
-            router.removeDNSMapping(mapp)
+    outcomes = runOnRouters(routers, record, maxWorkers)
+    for router in routers:
+        outcome = outcomes[router.Target]
+        if not outcome.ok:
+            print(f"{router.Target}: FAILED: {outcome.error}")
+            continue
+        routerPlan = plans[router.Target]
+        saved.routers.append(routerPlan)
+        print(f"{router.Target}: {len(routerPlan.plan.changes)} changes ({routerPlan.plan.unchanged} mappings up to date)")
+        for change in routerPlan.plan.changes:
+            print(f"  {change}")
 
+    if len(saved.routers) < len(routers):
+        # A partial plan would later look like a complete one
+        return False
+    saved.save(path)
+    print(f"Plan written to {path}")
+    return True
+
+def applySavedPlan(saved: SavedPlan, routers: List[RouterObject], state: Optional[DesiredState] = None, maxWorkers: int = 4) -> bool:
+    """Apply a saved plan, one ssh session per router, without reading the routers first
+
+    Refuses everything if state (docker as it is now) no longer matches
+    the plan. Each router checks its own config fingerprint in the same
+    session as the changes and refuses them if it has moved on.
+    """
+    if state is not None and desiredFingerprint(state.mappings, state.domains, state.frozenDomains) != saved.dockerFingerprint:
+        print("REFUSED: the docker containers have changed since the plan was made")
+        return False
+
+    byTarget = {router.Target: router for router in routers}
+    plans = {routerPlan.target: routerPlan for routerPlan in saved.routers}
+
+    def applyOne(router: RouterObject) -> List[BatchResult]:
+        routerPlan = plans[router.Target]
+        with router:
+            if not router.acquireRouterLock():
+                raise RuntimeError("another run holds the router lock, nothing applied")
+            try:
+                results = router.applyPlan(routerPlan.plan, expectFingerprint=routerPlan.fingerprint)
+            finally:
+                router.releaseRouterLock()
+        if len(results) > 0 and results[0].returncode == FINGERPRINT_CHANGED:
+            raise RuntimeError("REFUSED: the router's config has changed since the plan was made")
+        if len(results) > 0 and results[0].returncode != 0:
+            # ssh could not connect, timed out, or the session died before the check ran
+            raise RuntimeError(f"Could not run the plan on the router (exit status {results[0].returncode}), nothing applied")
+        return results
+
+    outcomes = runOnRouters([byTarget[target] for target in plans], applyOne, maxWorkers)
+    for target, outcome in outcomes.items():
+        if outcome.ok:
+            print(f"{target}: ok ({len(plans[target].plan.changes)} changes)")
+        else:
+            print(f"{target}: FAILED: {outcome.error}")
+    return all(outcome.ok for outcome in outcomes.values())
+
+def parseArgs(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog=__title__, description=__description__)
+    parser.add_argument("--router", action="append", dest="routers", metavar="[USER@]HOST[:PORT]",
+                        help="Router to update, repeat for several (default: openwrt.lan)")
+    parser.add_argument("--max-workers", type=int, default=4, help="Routers updated at the same time (default: %(default)s)")
+    parser.add_argument("--identity-file", default=str(pathlib.Path(__file__).resolve().parent.parent / ".secrets" / "openwrt_id_rsa"),
+                        help="ssh private key for the router")
+    parser.add_argument("--domain", default="docker.ardite.lan", help="Domain appended to container names (default: %(default)s)")
+    parser.add_argument("--docker-host", action="append", dest="docker_hosts", metavar="URL[,DOMAIN]",
+                        help="Docker engine to query (unix://, tcp:// or ssh://), optionally with its own domain. "
+                             "Repeat for several (default: $DOCKER_HOST or the local socket)")
+    parser.add_argument("--swarm", action="store_true",
+                        help="List the services and tasks of the whole swarm, through a manager, instead of one engine's containers")
+    parser.add_argument("--watch", action="store_true", help="Keep running and follow docker events instead of a one-shot scan")
+    parser.add_argument("--resync-interval", type=float, default=300.0, help="Seconds between full rescans in watch mode (default: %(default)s)")
+    parser.add_argument("--quiet-window", type=float, default=2.0, help="Seconds without new events before changes are sent in watch mode (default: %(default)s)")
+    parser.add_argument("--max-latency", type=float, default=10.0, help="Longest a change waits before being sent in watch mode (default: %(default)s)")
+    parser.add_argument("--hosts-file", nargs="?", const="/tmp/hosts/bpe-docker", default=None, metavar="PATH",
+                        help="Keep mappings in a dnsmasq hosts file on the router (default path: %(const)s) and SIGHUP dnsmasq "
+                             "instead of editing the uci address list and restarting it")
+    parser.add_argument("--hosts-shards", action="store_true",
+                        help="With --hosts-file, give each docker domain its own file (PATH.DOMAIN), so a change only rewrites the files of the domains it touches")
+    parser.add_argument("--ubus", action="store_true", help="Read and write the routers' uci address list through rpcd's JSON-RPC API (http://ROUTER/ubus), "
+                                                               "falling back to ssh if that fails")
+    parser.add_argument("--ubus-https", action="store_true", help="Use https for --ubus")
+    parser.add_argument("--ubus-user", default="root", help="rpcd login for --ubus (default: %(default)s)")
+    parser.add_argument("--ubus-password-file", default=None, help="File holding the rpcd password for --ubus (default: $BPE_UBUS_PASSWORD)")
+    parser.add_argument("--no-state-cache", action="store_true", help="Always read the full address list from the router")
+    parser.add_argument("--state-cache-dir", default=None, help="Where router state is cached (default: $XDG_CACHE_HOME/bpe-docker-to-openwrt)")
+    parser.add_argument("--state-cache-ttl", type=float, default=3600.0, help="Seconds a cached router state is trusted, negative for no limit (default: %(default)s)")
+    parser.add_argument("--invalidate-cache-on-commit", action="store_true", help="Drop a router's cached state after changing it instead of updating it")
+    parser.add_argument("--save-plan", default=None, metavar="PATH",
+                        help="Work out the changes for every router and write them, with fingerprints of the docker and router state, to PATH instead of applying them")
+    parser.add_argument("--apply-plan", default=None, metavar="PATH",
+                        help="Apply a plan written by --save-plan, refusing any router whose config has changed since, without reading the routers first")
+    parser.add_argument("--skip-docker-check", action="store_true", help="With --apply-plan, do not list the containers again to check the plan is still current")
+    parser.add_argument("--hostname-label", default=HOSTNAME_LABEL, metavar="LABEL",
+                        help="Container label that sets a container's hostname, '' to ignore labels (default: %(default)s)")
+    parser.add_argument("--compose-template", default=None, metavar="TEMPLATE",
+                        help="Hostname for compose containers, from {project}, {service}, {number} and {name}, e.g. '{service}-{project}'")
+    parser.add_argument("--rfc1123", action="store_true", help="Lowercase hostnames and fix or skip any that are not valid DNS names")
+    parser.add_argument("--ssh-timeout", type=float, default=60.0, help="Seconds one ssh call may take before it is killed, 0 for no limit (default: %(default)s)")
+    parser.add_argument("--ssh-connect-timeout", type=int, default=10, help="Seconds ssh may take to connect to a router (default: %(default)s)")
+    parser.add_argument("--ssh-retries", type=int, default=2, help="Retries when ssh fails to connect to a router (default: %(default)s)")
+    parser.add_argument("--retry-backoff", type=float, default=1.0, help="Seconds before the first ssh retry, doubling after that (default: %(default)s)")
+    parser.add_argument("--docker-timeout", type=float, default=60.0, help="Seconds listing the containers may take, 0 for no limit (default: %(default)s)")
+    parser.add_argument("--deadline", type=float, default=None, metavar="SECONDS",
+                        help="Give up on whatever is still running this long after a run starts, leaving those routers unchanged")
+    parser.add_argument("--lock-file", default=None, metavar="PATH",
+                        help=f"Lock that lets one run at a time reconcile (default: {defaultCacheDir() / 'run.lock'}). A run that "
+                             "finds another in progress asks it to go again once it is done, and exits")
+    parser.add_argument("--no-lock", action="store_true", help="Don't take the lock, so runs may overlap")
+    parser.add_argument("--router-lock", action="store_true",
+                        help="Also lock each router while reconciling it, for runs from several hosts. A run that finds a router "
+                             "locked leaves it to the run holding the lock, which goes again")
+    parser.add_argument("--router-lock-ttl", type=int, default=600, help="Seconds after which a router lock is taken to be left by a run that died (default: %(default)s)")
+    parser.add_argument("--metrics-json", default=None, metavar="PATH", help="Write phase timings and counters as json after each run ('-' for stdout)")
+    parser.add_argument("--metrics-prometheus", default=None, metavar="PATH",
+                        help="Write phase timings and counters for node_exporter's textfile collector (a .prom file) after each run")
+    return parser.parse_args(argv)
+
+def writeMetrics(args: argparse.Namespace):
+    """Export the metrics collected so far where the command line asked for them"""
+    try:
+        if args.metrics_json == "-":
+            builtins.print(metrics.toJson())
+        elif args.metrics_json is not None:
+            metrics.writeJson(args.metrics_json)
+        if args.metrics_prometheus is not None:
+            metrics.writePrometheus(args.metrics_prometheus)
+    except OSError as e:
+        stderr.write(f"WARNING: Could not write metrics: {e}\n")
+
+def main(argv: Optional[List[str]] = None) -> int:
+
+    args = parseArgs(argv)
+    identity_file = args.identity_file
+    base_domain = args.domain
+    if args.metrics_json is not None or args.metrics_prometheus is not None:
+        metrics.enable()
+
+    endpoints = [DockerEndpoint.fromSpec(spec, base_domain) for spec in (args.docker_hosts or [None])]
+    try:
+        # Leave room for the longest domain a name is put under
+        rules = NamingRules(hostnameLabel=args.hostname_label or None, composeTemplate=args.compose_template, rfc1123=args.rfc1123,
+                            maxLength=MAX_NAME_LENGTH - 1 - max(len(endpoint.domain) for endpoint in endpoints))
+    except ValueError as e:
+        stderr.write(f"ERROR: {e}\n")
+        return 2
+    listing = partial(listingFromEndpoint, timeout=args.docker_timeout or None, rules=rules, swarm=args.swarm)
+    if args.swarm and args.watch:
+        stderr.write("ERROR: --watch follows one engine's containers and can't be combined with --swarm\n")
+        return 2
+
+    def bound(routers: List[RouterObject]):
+        for router in routers:
+            router.setTimeouts(args.ssh_timeout or None, args.ssh_connect_timeout or None, args.ssh_retries, args.retry_backoff)
+
+    if args.lock_file is not None and (args.watch or args.save_plan is not None or args.apply_plan is not None or args.no_lock):
+        stderr.write("ERROR: --lock-file is for one-shot runs and can't be combined with --watch, --save-plan, --apply-plan or --no-lock\n")
+        return 2
+
+    if args.apply_plan is not None:
+        if args.save_plan is not None or args.watch or args.ubus or args.hosts_file is not None:
+            stderr.write("ERROR: --apply-plan works on the uci address list over ssh and can't be combined with --save-plan, --watch, --ubus or --hosts-file\n")
+            return 2
+        try:
+            saved = SavedPlan.load(args.apply_plan)
+        except (OSError, PlanError) as e:
+            stderr.write(f"ERROR: Could not load plan {args.apply_plan}: {e}\n")
+            return 2
+        # The routers are the ones the plan was made for
+        planRouters = [RouterObject.fromSpec(routerPlan.target, identity_file=identity_file) for routerPlan in saved.routers]
+        bound(planRouters)
+        if args.router_lock:
+            for router in planRouters:
+                router.useRouterLock(ttl=args.router_lock_ttl)
+        runDeadline.start(args.deadline)
+        try:
+            state = None if args.skip_docker_check else collectContainers(endpoints, args.max_workers, listing)
+            ok = applySavedPlan(saved, planRouters, state, args.max_workers)
+        finally:
+            runDeadline.clear()
+        writeMetrics(args)
+        return 0 if ok else 1
+
+    try:
+        routers: List[RouterObject] = [RouterObject.fromSpec(spec, identity_file=identity_file) for spec in (args.routers or ["openwrt.lan"])]
+    except ValueError as e:
+        stderr.write(f"ERROR: {e}\n")
+        return 2
+    duplicates = duplicateTargets(routers)
+    if len(duplicates) > 0:
+        # Results, cached state and plans are all kept per target
+        stderr.write(f"ERROR: Router given more than once: {', '.join(duplicates)}\n")
+        return 2
+    bound(routers)
+    if args.ubus:
+        from bpe_docker_to_openwrt.UbusClient import UbusClient
+        password = os.environ.get("BPE_UBUS_PASSWORD", "")
+        if args.ubus_password_file is not None:
+            password = pathlib.Path(args.ubus_password_file).expanduser().read_text().strip()
+        for router in routers:
+            router.useUbus(UbusClient.forHost(router.Hostname, username=args.ubus_user, password=password, https=args.ubus_https))
+    if args.hosts_shards and args.hosts_file is None:
+        stderr.write("ERROR: --hosts-shards needs --hosts-file\n")
+        return 2
+    if args.hosts_file is not None:
+        shards = [endpoint.domain for endpoint in endpoints] if args.hosts_shards else None
+        for router in routers:
+            router.useHostsFile(args.hosts_file, shards=shards)
+    if args.router_lock:
+        for router in routers:
+            router.useRouterLock(ttl=args.router_lock_ttl)
+    if not args.no_state_cache:
+        cache = StateCache(args.state_cache_dir, ttl=args.state_cache_ttl)
+        for router in routers:
+            router.enableStateCache(cache, invalidateOnCommit=args.invalidate_cache_on_commit)
+
+    def fullReconcile() -> bool:
+        # Each run, including every rescan in watch mode, gets the whole deadline
+        runDeadline.start(args.deadline)
+        try:
+            with metrics.span("run"):
+                with metrics.span("collect"):
+                    state = collectContainers(endpoints, args.max_workers, listing)
+                outcomes = reconcileRouters(routers, state, args.max_workers)
+        finally:
+            runDeadline.clear()
+        for target, outcome in outcomes.items():
+            metrics.count("router_runs", result="ok" if outcome.ok else "failed", router=target)
+            if outcome.ok:
+                print(f"{target}: ok ({len(outcome.results)} commands)")
+            else:
+                print(f"{target}: FAILED: {outcome.error}")
+        # In watch mode this refreshes the exported files after every full rescan
+        writeMetrics(args)
+        return all(outcome.ok for outcome in outcomes.values()) and len(state.errors) == 0
+
+    if args.save_plan is not None:
+        if args.ubus or args.hosts_file is not None:
+            stderr.write("ERROR: --save-plan works on the uci address list over ssh and can't be combined with --ubus or --hosts-file\n")
+            return 2
+        runDeadline.start(args.deadline)
+        try:
+            state = collectContainers(endpoints, args.max_workers, listing)
+            if len(state.errors) > 0:
+                stderr.write("ERROR: Not saving a plan made without every docker endpoint\n")
+                return 1
+            ok = saveRouterPlans(routers, state, args.save_plan, args.max_workers)
+        finally:
+            runDeadline.clear()
+        writeMetrics(args)
+        return 0 if ok else 1
+
+    if not args.watch:
+        lock = RunLock(None if args.no_lock else (args.lock_file or defaultCacheDir() / "run.lock"))
+
+        def once() -> bool:
+            ok = fullReconcile()
+            # Runs from other hosts that found a router locked
+            if any([router.takeRerunRequest() for router in routers]):
+                lock.requestRerun()
+            return ok
+
+        result = lock.run(once)
+        if result is None:
+            # Not a failure: the run holding the lock picks up whatever this one would have done
+            print(f"Another run (pid {lock.holder() or 'unknown'}) is in progress and will reconcile again when it is done")
+            return 0
+        return 0 if result else 1
+
+    if len(endpoints) > 1:
+        stderr.write("ERROR: --watch follows a single docker engine\n")
+        return 2
+    from bpe_docker_to_openwrt.DockerClient import DockerClient
+    client = DockerClient(endpoints[0].url)
+    base_domain = endpoints[0].domain
+
+    with client:
+        from bpe_docker_to_openwrt.ContainerWatcher import ContainerWatcher
+        from bpe_docker_to_openwrt.ChangeScheduler import ChangeScheduler
+        scheduler = ChangeScheduler(routers, quietWindow=args.quiet_window, maxLatency=args.max_latency, maxWorkers=args.max_workers)
+        watcher = ContainerWatcher(routers[0], client, base_domain, resyncInterval=args.resync_interval,
+                                   fullResync=fullReconcile, scheduler=scheduler, naming=rules)
+        # Keep one ssh connection per router open for the life of the watcher
+        for router in routers:
+            router.enableConnectionReuse(keepMaster=True)
+        try:
+            watcher.run()
+        except KeyboardInterrupt:
+            watcher.stop()
+        finally:
+            for router in routers:
+                router.disableConnectionReuse()
+        print(f"Changes: {scheduler.Stats}")
+    writeMetrics(args)
+    return 0
 
-    # add new mappings
-    if len(dns2add) > 0:
-        for wanted_name in dns2add:
-            router.addDNSMapping(wanted_name, dns2add[wanted_name])
+def run(argv: Optional[List[str]] = None) -> int:
+    """Command line entry point: main() with rich tracebacks if rich is installed"""
+    # Plain print, so a run with nothing else to show never loads rich
+    builtins.print(f"bpe-docker-to-openwrt {__version__}")
+    try:
+        return main(argv)
+    except Exception:
+        console = richAttr("rich.console", "Console")
+        if console is None:
+            raise
+        console(stderr=True).print_exception()
+        return 1
 
 if __name__ == "__main__":
-    print(f"bpe-docker-to-openwrt {__version__}")
-    main()
+    raise SystemExit(run())
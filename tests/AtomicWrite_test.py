@@ -0,0 +1,26 @@
+import pytest
+
+from bpe_docker_to_openwrt.AtomicWrite import writeAtomic
+
+
+def test_writeAtomic(tmp_path):
+    path = tmp_path / "metrics.prom"
+    path.write_text("old\n")
+
+    writeAtomic(path, "new\n")
+
+    assert path.read_text() == "new\n"
+    assert [p.name for p in tmp_path.iterdir()] == ["metrics.prom"]
+
+def test_writeAtomic_failure_keeps_the_old_file(tmp_path, monkeypatch):
+    path = tmp_path / "plan.json"
+    path.write_text("old\n")
+
+    def failReplace(src, dst):
+        raise OSError("disk full")
+    monkeypatch.setattr("os.replace", failReplace)
+
+    with pytest.raises(OSError):
+        writeAtomic(path, "new\n")
+    assert path.read_text() == "old\n"
+    assert [p.name for p in tmp_path.iterdir()] == ["plan.json"]
@@ -0,0 +1,117 @@
+import pytest
+
+from bpe_docker_to_openwrt.ChangeScheduler import ChangeScheduler
+
+from tests.fakes import RecordingRouter
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+# 'desc, changes, expected'
+testData_ChangeScheduler_netChanges = [
+    ("add then remove of a new name cancels", [("new", "1.1.1.1"), ("new", None)], {}),
+    ("remove then re-add with the same ip cancels", [("old", None), ("old", "10.0.0.1")], {}),
+    ("remove then add with a new ip is an update", [("old", None), ("old", "10.0.0.2")], {"old": "10.0.0.2"}),
+    ("last change wins", [("new", "1.1.1.1"), ("new", "2.2.2.2")], {"new": "2.2.2.2"}),
+    ("removing an unknown name is nothing", [("ghost", None)], {}),
+    ("plain remove", [("old", None)], {"old": None}),
+]
+
+@pytest.mark.parametrize('desc, changes, expected', testData_ChangeScheduler_netChanges)
+def test_ChangeScheduler_netChanges(desc, changes, expected):
+    scheduler = ChangeScheduler(RecordingRouter({"old": "10.0.0.1"}))
+    for dns, ip in changes:
+        scheduler.schedule(dns, ip)
+
+    assert scheduler.netChanges() == expected
+
+def test_ChangeScheduler_quietWindow_and_maxLatency():
+    clock = FakeClock()
+    scheduler = ChangeScheduler(RecordingRouter({}), quietWindow=2, maxLatency=5, clock=clock)
+    assert scheduler.nextDeadline() is None
+    assert not scheduler.due()
+
+    scheduler.scheduleAdd("a", "1.1.1.1")
+    assert scheduler.nextDeadline() == 102
+
+    # Steady trickle of changes keeps pushing the quiet window out, up to the latency bound
+    for i in range(4):
+        clock.now += 1
+        scheduler.scheduleAdd(f"b{i}", "1.1.1.2")
+        assert not scheduler.due()
+    assert scheduler.nextDeadline() == 105
+
+    clock.now = 105
+    assert scheduler.due()
+
+def test_ChangeScheduler_flush():
+    clock = FakeClock()
+    router = RecordingRouter({"old": "10.0.0.1", "moved": "10.0.0.5"})
+    scheduler = ChangeScheduler(router, quietWindow=1, clock=clock)
+
+    for i in range(40):
+        scheduler.scheduleAdd(f"svc{i}", f"172.18.0.{i + 2}")
+    scheduler.scheduleRemove("old")
+    scheduler.scheduleAdd("moved", "10.0.0.6")
+    scheduler.scheduleAdd("svc39", "172.18.0.99")
+    scheduler.scheduleRemove("svc38")
+
+    assert scheduler.poll() == 0
+    clock.now += 1
+    assert scheduler.poll() == 41
+
+    assert len(router.applied) == 1
+    batch = router.applied[0]
+    assert batch[-2:] == ["uci commit dhcp", "service dnsmasq reload"]
+    assert "uci del_list dhcp.@dnsmasq[0].address='/moved/10.0.0.5'" in batch
+    assert "uci add_list dhcp.@dnsmasq[0].address='/moved/10.0.0.6'" in batch
+    assert "uci add_list dhcp.@dnsmasq[0].address='/svc39/172.18.0.99'" in batch
+    assert not any("svc38" in cmd for cmd in batch)
+    assert scheduler.Stats == {"received": 44, "flushed": 41, "reloads": 1}
+    assert scheduler.Pending == 0
+
+    # Nothing pending means no reload
+    assert scheduler.flush() == 0
+    assert scheduler.Stats["reloads"] == 1
+
+def test_ChangeScheduler_failed_apply_is_requeued():
+    clock = FakeClock()
+    good = RecordingRouter({"old": "10.0.0.1"}, hostname="good")
+    bad = RecordingRouter({"old": "10.0.0.1"}, hostname="bad", failApply=True)
+    scheduler = ChangeScheduler([good, bad], quietWindow=1, clock=clock)
+
+    scheduler.scheduleAdd("new", "10.0.0.2")
+    scheduler.scheduleRemove("old")
+    clock.now += 1
+    assert scheduler.poll() == 2
+
+    # Only the router that took them is counted, the other one gets them again next time
+    assert scheduler.Stats == {"received": 2, "flushed": 2, "reloads": 1}
+    assert scheduler.Pending == 2
+    assert scheduler.netChanges(good) == {}
+    assert scheduler.netChanges(bad) == {"new": "10.0.0.2", "old": None}
+    assert not scheduler.due()
+
+    bad.failApply = False
+    clock.now += 1
+    assert scheduler.poll() == 2
+    assert len(good.applied) == 1 and len(bad.applied) == 1
+    assert scheduler.Stats == {"received": 2, "flushed": 4, "reloads": 2}
+    assert scheduler.Pending == 0
+
+def test_ChangeScheduler_takeRerunRequests():
+    first, second = RecordingRouter({}, hostname="r1"), RecordingRouter({}, hostname="r2")
+    scheduler = ChangeScheduler([first, second])
+    # Left by runs that found the routers locked
+    first._rerunRequested = second._rerunRequested = True
+
+    assert scheduler.takeRerunRequests()
+    # Every router's request was taken, not just the first
+    assert not second.takeRerunRequest()
+    assert not scheduler.takeRerunRequests()
@@ -0,0 +1,197 @@
+import pytest
+import threading
+
+from bpe_docker_to_openwrt.DockerClient import DockerClient
+from bpe_docker_to_openwrt.ContainerWatcher import ContainerWatcher
+from bpe_docker_to_openwrt.ChangeScheduler import ChangeScheduler
+from bpe_docker_to_openwrt.NamingRules import HOSTNAME_LABEL, NamingRules
+from bpe_docker_to_openwrt.main import sanitizeContainerName
+
+from tests.fakes import RecordingRouter
+
+
+def inspected(name: str, ip: str, running: bool = True):
+    return {
+        "Name": f"/{name}",
+        "State": {"Running": running},
+        "Config": {"Labels": {}},
+        "NetworkSettings": {"Networks": {"bridge": {"IPAddress": ip, "GlobalIPv6Address": ""}}},
+    }
+
+def event(kind: str, action: str, actorId: str, **attributes):
+    return {"Type": kind, "Action": action, "Actor": {"ID": actorId, "Attributes": attributes}, "time": 1700000000}
+
+
+@pytest.fixture
+def engine(docker_server):
+    return docker_server({
+        "/containers/aaa/json": inspected("web_app", "172.18.0.5"),
+        "/containers/bbb/json": inspected("db", "172.18.0.9"),
+        "/containers/ccc/json": inspected("new.name", "172.18.0.7"),
+        "/containers/ddd/json": inspected("stopped", "", running=False),
+    })
+
+# 'desc, event, expected'
+testData_ContainerWatcher_handleEvent = [
+    ("start adds",
+        event("container", "start", "aaa", name="web_app"),
+        ["uci add_list dhcp.@dnsmasq[0].address='/web-app.docker.lan/172.18.0.5'"]),
+    ("start of a known container is a no-op",
+        event("container", "start", "bbb", name="db"),
+        None),
+    ("die removes",
+        event("container", "die", "bbb", name="db"),
+        ["uci del_list dhcp.@dnsmasq[0].address='/db.docker.lan/172.18.0.1'"]),
+    ("die of an unknown container is a no-op",
+        event("container", "die", "zzz", name="other"),
+        None),
+    ("rename moves the mapping",
+        event("container", "rename", "ccc", name="new.name", oldName="/old"),
+        ["uci del_list dhcp.@dnsmasq[0].address='/old.docker.lan/172.18.0.3'",
+         "uci add_list dhcp.@dnsmasq[0].address='/new.name.docker.lan/172.18.0.7'"]),
+    ("network connect updates a changed ip",
+        event("network", "connect", "net1", container="bbb", name="bridge"),
+        ["uci del_list dhcp.@dnsmasq[0].address='/db.docker.lan/172.18.0.1'",
+         "uci add_list dhcp.@dnsmasq[0].address='/db.docker.lan/172.18.0.9'"]),
+    ("disconnect leaving no address removes",
+        event("network", "disconnect", "net1", container="ddd", name="bridge"),
+        ["uci del_list dhcp.@dnsmasq[0].address='/stopped.docker.lan/172.18.0.4'"]),
+]
+
+@pytest.mark.parametrize('desc, ev, expected', testData_ContainerWatcher_handleEvent)
+def test_ContainerWatcher_handleEvent(engine, desc, ev, expected):
+    router = RecordingRouter({
+        "db.docker.lan": "172.18.0.1" if desc != "start of a known container is a no-op" else "172.18.0.9",
+        "old.docker.lan": "172.18.0.3",
+        "stopped.docker.lan": "172.18.0.4",
+    })
+    watcher = ContainerWatcher(router, DockerClient(engine.server_address), "docker.lan", nameFilter=sanitizeContainerName)
+
+    watcher.handleEvent(ev)
+    flushed = watcher.Scheduler.flush()
+
+    if expected is None:
+        assert flushed == 0
+        assert router.applied == []
+    else:
+        assert flushed > 0
+        assert router.applied == [expected + ["uci commit dhcp", "service dnsmasq reload"]]
+    assert not router.InBatch
+
+def test_ContainerWatcher_naming_rules(docker_server):
+    labelled = inspected("web_app", "172.18.0.5")
+    labelled["Config"]["Labels"] = {HOSTNAME_LABEL: "front"}
+    server = docker_server({"/containers/aaa/json": labelled})
+    router = RecordingRouter({"front.docker.lan": "172.18.0.1"})
+    watcher = ContainerWatcher(router, DockerClient(server.server_address), "docker.lan", naming=NamingRules())
+
+    # The engine puts the container's labels in the event, so a stopped container still finds its name
+    watcher.handleEvent(event("container", "start", "aaa", name="web_app"))
+    watcher.handleEvent(event("container", "die", "aaa", name="web_app", **{HOSTNAME_LABEL: "front"}))
+    watcher.Scheduler.flush()
+
+    assert router.applied == [["uci del_list dhcp.@dnsmasq[0].address='/front.docker.lan/172.18.0.1'",
+                               "uci commit dhcp", "service dnsmasq reload"]]
+
+def test_ContainerWatcher_run(docker_server, event_route):
+    build, release = event_route
+    events = [
+        event("container", "start", "aaa", name="web_app"),
+        event("container", "die", "aaa", name="web_app"),
+    ]
+    server = docker_server({
+        "/containers/aaa/json": inspected("web_app", "172.18.0.5"),
+        "/events": build(events),
+    })
+    router = RecordingRouter({})
+    resyncs = []
+    watcher = ContainerWatcher(router, DockerClient(server.server_address), "docker.lan",
+                               resyncInterval=60, fullResync=lambda: resyncs.append(1) or True,
+                               scheduler=ChangeScheduler(router, quietWindow=60))
+
+    watcher.run(maxEvents=2)
+
+    assert resyncs == [1]
+    assert watcher.EventsSeen == 2
+    assert server.requests_seen[0].startswith("/events?")
+    # The container came and went before the quiet window ran out, so the router is never touched
+    assert router.applied == []
+    assert watcher.Scheduler.Stats == {"received": 2, "flushed": 0, "reloads": 0}
+
+def test_ContainerWatcher_run_flushes_when_quiet(docker_server, event_route):
+    build, release = event_route
+    server = docker_server({
+        "/containers/aaa/json": inspected("web_app", "172.18.0.5"),
+        "/containers/bbb/json": inspected("db", "172.18.0.9"),
+        "/events": build([
+            event("container", "start", "aaa", name="web_app"),
+            event("container", "start", "bbb", name="db"),
+        ]),
+    })
+    router = RecordingRouter({})
+    scheduler = ChangeScheduler(router, quietWindow=0.05)
+    watcher = ContainerWatcher(router, DockerClient(server.server_address), "docker.lan", scheduler=scheduler)
+
+    def stopWhenFlushed(doTest=False, testRunReturn=None):
+        results = RecordingRouter.applyBatch(router)
+        watcher.stop()
+        return results
+    router.applyBatch = stopWhenFlushed
+
+    runner = threading.Thread(target=watcher.run)
+    runner.start()
+    runner.join(5)
+
+    assert not runner.is_alive()
+    assert router.applied == [[
+        "uci add_list dhcp.@dnsmasq[0].address='/web_app.docker.lan/172.18.0.5'",
+        "uci add_list dhcp.@dnsmasq[0].address='/db.docker.lan/172.18.0.9'",
+        "uci commit dhcp",
+        "service dnsmasq reload",
+    ]]
+    assert scheduler.Stats == {"received": 2, "flushed": 2, "reloads": 1}
+
+def test_ContainerWatcher_periodic_resync(docker_server, event_route):
+    build, release = event_route
+    server = docker_server({"/events": build([])})
+    router = RecordingRouter({})
+    resyncs = []
+    watcher = ContainerWatcher(router, DockerClient(server.server_address), "docker.lan", resyncInterval=0.05)
+
+    def fullResync() -> bool:
+        resyncs.append(1)
+        if len(resyncs) == 3:
+            watcher.stop()
+        return True
+    watcher._fullResync = fullResync
+
+    runner = threading.Thread(target=watcher.run)
+    runner.start()
+    runner.join(5)
+
+    assert not runner.is_alive()
+    assert len(resyncs) == 3
+    assert watcher.Resyncs == 3
+
+def test_ContainerWatcher_failed_resync_retried(docker_server, event_route):
+    build, release = event_route
+    server = docker_server({"/events": build([])})
+    router = RecordingRouter({})
+    outcomes = [False, False, True]
+
+    def fullResync() -> bool:
+        ok = outcomes.pop(0)
+        if ok:
+            watcher.stop()
+        return ok
+    # Only the retry delay, not the hour between resyncs, gets it to the third one
+    watcher = ContainerWatcher(router, DockerClient(server.server_address), "docker.lan", resyncInterval=3600,
+                               fullResync=fullResync, retryDelay=0.05)
+
+    runner = threading.Thread(target=watcher.run)
+    runner.start()
+    runner.join(5)
+
+    assert not runner.is_alive()
+    assert outcomes == []
+    assert watcher.Resyncs == 3
@@ -0,0 +1,86 @@
+import os
+import time
+import pytest
+
+from subprocess import TimeoutExpired
+
+from bpe_docker_to_openwrt.Deadline import Deadline, DeadlineExceeded, backoffDelays, runBounded
+
+
+def isRunning(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    # Killed but not reaped yet (its parent is gone, so that is up to init)
+    stat = f"/proc/{pid}/stat"
+    return not (os.path.exists(stat) and open(stat).read().rpartition(")")[2].split()[0] == "Z")
+
+class FakeClock:
+    def __init__(self, now: float = 100.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+def test_Deadline_unbounded():
+    deadline = Deadline()
+
+    assert deadline.remaining() is None
+    assert not deadline.expired()
+    assert deadline.timeoutFor(60.0) == 60.0
+    assert deadline.timeoutFor(None) is None
+
+def test_Deadline_cuts_timeouts():
+    clock = FakeClock()
+    deadline = Deadline(30.0, clock=clock)
+
+    assert deadline.timeoutFor(60.0) == 30.0
+    assert deadline.timeoutFor(10.0) == 10.0
+    assert deadline.timeoutFor(None) == 30.0
+
+    clock.now += 25
+    assert deadline.remaining() == 5.0
+    assert deadline.timeoutFor(60.0) == 5.0
+
+    clock.now += 5
+    assert deadline.expired()
+    with pytest.raises(DeadlineExceeded, match="ssh to r1"):
+        deadline.timeoutFor(60.0, "ssh to r1")
+
+    deadline.clear()
+    assert deadline.timeoutFor(60.0) == 60.0
+
+def test_runBounded():
+    res = runBounded(["sh", "-c", "cat; echo oops >&2; exit 3"], inputText="hello")
+
+    assert (res.returncode, res.stdout, res.stderr) == (3, "hello", "oops\n")
+
+def test_runBounded_kills_the_whole_group(tmp_path):
+    pidfile = tmp_path / "pid"
+    start = time.monotonic()
+    # The sleep is a grandchild that would keep the pipes open if only sh were killed
+    with pytest.raises(TimeoutExpired):
+        runBounded(["sh", "-c", f"sleep 30 & echo $! > {pidfile}; wait"], timeout=0.5)
+    assert time.monotonic() - start < 10
+
+    pid = int(pidfile.read_text())
+    for i in range(50):
+        if not isRunning(pid):
+            break
+        time.sleep(0.1)
+    else:
+        pytest.fail("sleep outlived the timeout")
+
+@pytest.mark.parametrize('retries, base, cap', [
+    (0, 1.0, 30.0),
+    (3, 1.0, 30.0),
+    (8, 2.0, 10.0),
+])
+def test_backoffDelays(retries, base, cap):
+    delays = backoffDelays(retries, base, cap)
+
+    assert len(delays) == retries
+    for attempt, delay in enumerate(delays):
+        ceiling = min(cap, base * 2 ** attempt)
+        assert ceiling / 2 <= delay <= ceiling
@@ -0,0 +1,205 @@
+import pytest
+
+from bpe_docker_to_openwrt.DockerClient import DockerClient, DockerError, ContainerRecord
+from bpe_docker_to_openwrt.main import getContainerIPsFromDocker
+
+# Trimmed down /containers/json response from a real engine
+testData_containers = [
+    {
+        "Id": "aaa111",
+        "Names": ["/traefik"],
+        "Labels": {"com.docker.compose.project": "edge"},
+        "NetworkSettings": {"Networks": {
+            "proxy": {"IPAddress": "172.21.0.2", "GlobalIPv6Address": ""},
+        }},
+    },
+    {
+        "Id": "bbb222",
+        "Names": ["/subdomain_service"],
+        "Labels": {},
+        "NetworkSettings": {"Networks": {
+            "bridge": {"IPAddress": "172.18.0.52", "GlobalIPv6Address": "2001:db8::52"},
+            "backend": {"IPAddress": "10.0.0.5", "GlobalIPv6Address": ""},
+        }},
+    },
+    {
+        "Id": "ccc333",
+        "Names": ["/hostnet"],
+        "Labels": {},
+        "NetworkSettings": {"Networks": {
+            "host": {"IPAddress": "", "GlobalIPv6Address": ""},
+        }},
+    },
+]
+
+
+def test_DockerClient_listContainers(docker_server):
+    server = docker_server({"/containers/json": testData_containers})
+    client = DockerClient(f"unix://{server.server_address}")
+
+    records = client.listContainers()
+
+    assert records == [
+        ContainerRecord("traefik", "aaa111", {"proxy": ["172.21.0.2"]}, {"com.docker.compose.project": "edge"}),
+        ContainerRecord("subdomain_service", "bbb222",
+                        {"bridge": ["172.18.0.52", "2001:db8::52"], "backend": ["10.0.0.5"]}, {}),
+        ContainerRecord("hostnet", "ccc333", {}, {}),
+    ]
+    assert records[1].ips == ["172.18.0.52", "2001:db8::52", "10.0.0.5"]
+
+def test_DockerClient_keepalive(docker_server):
+    server = docker_server({"/containers/json": testData_containers})
+    client = DockerClient(server.server_address)
+
+    for i in range(3):
+        client.listContainers()
+    client.close()
+
+    assert server.requests_seen == ["/containers/json"] * 3
+    assert server.connections == 1
+
+def test_DockerClient_docker_host_env(docker_server, monkeypatch):
+    server = docker_server({"/containers/json": []})
+    monkeypatch.setenv("DOCKER_HOST", f"unix://{server.server_address}")
+
+    client = DockerClient()
+    assert client.Host == f"unix://{server.server_address}"
+    assert client.listContainers() == []
+
+def test_DockerClient_errors(docker_server, tmp_path):
+    server = docker_server({})
+    client = DockerClient(f"unix://{server.server_address}")
+    with pytest.raises(DockerError):
+        client.request("GET", "/nothere")
+
+    with pytest.raises(OSError):
+        DockerClient(f"unix://{tmp_path / 'missing.sock'}").listContainers()
+
+    with pytest.raises(DockerError):
+        DockerClient("gopher://host").listContainers()
+
+# Trimmed down /services, /tasks and /nodes responses from a three node swarm
+testData_swarm_nodes = [
+    {"ID": "n1", "Description": {"Hostname": "mgr"}, "Status": {"State": "ready", "Addr": "0.0.0.0"}, "ManagerStatus": {"Addr": "192.168.1.10:2377"}},
+    {"ID": "n2", "Description": {"Hostname": "worker-a"}, "Status": {"State": "ready", "Addr": "192.168.1.11"}},
+    {"ID": "n3", "Description": {"Hostname": "worker-b"}, "Status": {"State": "down", "Addr": "192.168.1.12"}},
+]
+testData_swarm_services = [
+    {"ID": "s-web", "Spec": {"Name": "web", "Labels": {"bpe-docker-to-openwrt.hostname": "www"}},
+     "Endpoint": {"Ports": [{"PublishMode": "ingress", "PublishedPort": 80}], "VirtualIPs": [{"NetworkID": "ing", "Addr": "10.0.0.5/24"}]}},
+    {"ID": "s-db", "Spec": {"Name": "db"}, "Endpoint": {"VirtualIPs": [{"NetworkID": "ov1", "Addr": "10.0.1.2/24"}]}},
+    {"ID": "s-agent", "Spec": {"Name": "agent", "Mode": {"Global": {}}}, "Endpoint": {"Ports": [{"PublishMode": "host", "PublishedPort": 9100}]}},
+    {"ID": "s-idle", "Spec": {"Name": "idle"}, "Endpoint": {"VirtualIPs": [{"NetworkID": "ov1", "Addr": "10.0.1.9/24"}]}},
+]
+ingress = {"Network": {"ID": "ing", "Spec": {"Name": "ingress", "Ingress": True}}, "Addresses": ["10.0.0.7/24"]}
+def overlay(addr: str):
+    return {"Network": {"ID": "ov1", "Spec": {"Name": "backend"}}, "Addresses": [addr]}
+testData_swarm_tasks = [
+    {"ID": "t-web2", "ServiceID": "s-web", "NodeID": "n2", "Slot": 2, "Status": {"State": "running"}, "NetworksAttachments": [ingress, overlay("10.0.1.4/24")]},
+    {"ID": "t-web1", "ServiceID": "s-web", "NodeID": "n1", "Slot": 1, "Status": {"State": "running"}, "NetworksAttachments": [ingress, overlay("10.0.1.3/24")]},
+    {"ID": "t-web3", "ServiceID": "s-web", "NodeID": "n3", "Slot": 3, "Status": {"State": "starting"}, "NetworksAttachments": [overlay("10.0.1.8/24")]},
+    {"ID": "t-db1", "ServiceID": "s-db", "NodeID": "n2", "Slot": 1, "Status": {"State": "running"}, "NetworksAttachments": [overlay("10.0.1.5/24")]},
+    {"ID": "t-agent", "ServiceID": "s-agent", "NodeID": "n2", "Status": {"State": "running"}, "NetworksAttachments": []},
+]
+
+def test_DockerClient_swarmRecordsFromJSON():
+    records = DockerClient.swarmRecordsFromJSON(testData_swarm_services, testData_swarm_tasks, testData_swarm_nodes)
+
+    assert records == [
+        # Published through the mesh: the first node running it, the manager by its manager address
+        ContainerRecord("web", "s-web", {"ingress": ["192.168.1.10"]}, {"bpe-docker-to-openwrt.hostname": "www"}),
+        ContainerRecord("web-1", "t-web1", {"backend": ["10.0.1.3"]}),
+        ContainerRecord("web-2", "t-web2", {"backend": ["10.0.1.4"]}),
+        ContainerRecord("db", "s-db", {"backend": ["10.0.1.2"]}),
+        ContainerRecord("db-1", "t-db1", {"backend": ["10.0.1.5"]}),
+        # Global and published on the host: named after and reached at its node
+        ContainerRecord("agent", "s-agent", {"host": ["192.168.1.11"]}),
+        ContainerRecord("agent-worker-a", "t-agent", {}),
+    ]
+
+def test_getContainerIPsFromSwarm(docker_server):
+    from bpe_docker_to_openwrt.main import getContainerIPsFromSwarm
+    server = docker_server({"/services": testData_swarm_services, "/tasks": testData_swarm_tasks, "/nodes": testData_swarm_nodes})
+    client = DockerClient(server.server_address)
+
+    assert getContainerIPsFromSwarm(client) == {
+        "www": "192.168.1.10", "web-1": "10.0.1.3", "web-2": "10.0.1.4", "db": "10.0.1.2", "db-1": "10.0.1.5", "agent": "192.168.1.11"}
+    # One request each, the tasks narrowed down on the manager
+    assert [path.split("?")[0] for path in server.requests_seen] == ["/services", "/tasks", "/nodes"]
+    assert "desired-state" in server.requests_seen[1]
+
+def test_getContainerIPsFromDocker(docker_server):
+    server = docker_server({"/containers/json": testData_containers})
+
+    res = getContainerIPsFromDocker(DockerClient(server.server_address))
+
+    assert res == {'traefik': '172.21.0.2', 'subdomain-service': '172.18.0.52'}
+
+def test_DockerClient_inspectContainer(docker_server):
+    stopped = dict(testData_containers[0], Name="/traefik", State={"Running": False})
+    del stopped["Names"]
+    server = docker_server({
+        "/containers/bbb222/json": dict(testData_containers[1], State={"Running": True}),
+        "/containers/aaa111/json": stopped,
+    })
+    client = DockerClient(server.server_address)
+
+    assert client.inspectContainer("bbb222").ips == ["172.18.0.52", "2001:db8::52", "10.0.0.5"]
+    assert client.inspectContainer("aaa111").ips == []
+    assert client.inspectContainer("gone") is None
+
+def test_DockerClient_events(docker_server, event_route):
+    build, release = event_route
+    events = [
+        {"Type": "container", "Action": "start", "Actor": {"ID": "aaa111"}, "time": 1},
+        {"Type": "container", "Action": "die", "Actor": {"ID": "aaa111"}, "time": 2},
+    ]
+    server = docker_server({"/events": build(events)})
+    client = DockerClient(server.server_address)
+
+    stream = client.events({"type": ["container"]}, since=10)
+    assert next(stream) == events[0]
+    assert next(stream) == events[1]
+    release.set()
+    assert list(stream) == []
+
+    path = server.requests_seen[0]
+    assert path.startswith("/events?filters=")
+    assert "since=10.000000000" in path
+
+# Stand-in for 'ssh host docker system dial-stdio' that relays stdin/stdout to a local socket
+FAKE_DIAL_SSH = r'''#!/usr/bin/env python3
+import os, socket, sys, threading
+with open(os.environ["FAKE_SSH_LOG"], "a") as log:
+    log.write(" ".join(sys.argv[1:]) + "\n")
+sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+sock.connect(os.environ["FAKE_DOCKER_SOCK"])
+def pump():
+    while True:
+        data = os.read(0, 65536)
+        if not data:
+            sock.shutdown(socket.SHUT_WR)
+            return
+        sock.sendall(data)
+threading.Thread(target=pump, daemon=True).start()
+while True:
+    data = sock.recv(65536)
+    if not data:
+        break
+    os.write(1, data)
+'''
+
+def test_DockerClient_ssh(docker_server, tmp_path, monkeypatch):
+    server = docker_server({"/containers/json": testData_containers})
+    exe = tmp_path / "ssh"
+    exe.write_text(FAKE_DIAL_SSH)
+    exe.chmod(0o755)
+    log = tmp_path / "ssh.log"
+    monkeypatch.setenv("FAKE_SSH_LOG", str(log))
+    monkeypatch.setenv("FAKE_DOCKER_SOCK", server.server_address)
+
+    with DockerClient("ssh://admin@node2:2222", sshexe=str(exe)) as client:
+        assert [r.name for r in client.listContainers()] == ["traefik", "subdomain_service", "hostnet"]
+        assert len(client.listContainers()) == 3
+
+    assert log.read_text().splitlines() == ["-p 2222 -- admin@node2 docker system dial-stdio"]
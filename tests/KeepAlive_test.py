@@ -0,0 +1,55 @@
+from http.client import RemoteDisconnected
+from typing import Dict, List, Optional, Tuple
+
+import pytest
+
+from bpe_docker_to_openwrt.KeepAlive import requestKeepAlive
+
+
+class FakeResponse:
+    status = 200
+
+    def read(self) -> bytes:
+        return b"ok"
+
+
+class FakeConnection:
+    """Fails the first failures requests, as a connection the server closed would"""
+
+    def __init__(self, failures: int):
+        self.failures = failures
+        self.requests: List[Tuple[str, str, Optional[bytes], Optional[Dict[str, str]]]] = []
+
+    def request(self, method, path, body=None, headers=None):
+        self.requests.append((method, path, body, headers))
+        if self.failures > 0:
+            self.failures -= 1
+            raise RemoteDisconnected("Remote end closed connection without response")
+
+    def getresponse(self):
+        return FakeResponse()
+
+
+def test_requestKeepAlive_retries_on_a_fresh_connection():
+    opened = [FakeConnection(1), FakeConnection(0)]
+    held = []
+
+    def connection():
+        if not held:
+            held.append(opened.pop(0))
+        return held[0]
+
+    response, body = requestKeepAlive(connection, held.clear, "POST", "/ubus", body=b"{}", headers={"Content-Type": "application/json"})
+
+    assert (response.status, body) == (200, b"ok")
+    assert opened == []
+    assert held[0].requests == [("POST", "/ubus", b"{}", {"Content-Type": "application/json"})]
+
+def test_requestKeepAlive_gives_up_after_the_retry():
+    conn = FakeConnection(2)
+    drops = []
+
+    with pytest.raises(RemoteDisconnected):
+        requestKeepAlive(lambda: conn, lambda: drops.append(1), "GET", "/containers/json")
+    assert len(conn.requests) == 2
+    assert len(drops) == 2
@@ -0,0 +1,71 @@
+import pytest
+import tracemalloc
+
+from bpe_docker_to_openwrt.MappingRecord import MappingRecord, ipKey, packIp
+from bpe_docker_to_openwrt.MappingTable import MappingTable
+
+# 'definition, names, ip, storesText'
+testData_roundtrip = [
+    ("'/bob1/1.2.3.4'", ("bob1",), "1.2.3.4", False),
+    ("/Bob2/bob2.lan/4.5.6.7", ("Bob2", "bob2.lan"), "4.5.6.7", False),
+    ("'/v6.lan/fd00::5'", ("v6.lan",), "fd00::5", False),
+    # Kept word for word when the parts would render it differently
+    ("/v6.lan/fd00:0::5", ("v6.lan",), "fd00:0::5", True),
+    ("/a//b/fe80::1", ("a", "b"), "fe80::1", True),
+    ("/leading.zero/010.1.1.1", ("leading.zero",), "010.1.1.1", True),
+    ("/local.lan/", ("local.lan",), "", True),
+    ("/upstream.lan/#", ("upstream.lan",), "#", True),
+    ("'/nothing'", (), "", True),
+    ("'/half/1.1.1.1", ("half",), "1.1.1.1", False),
+    ("", (), "", True),
+]
+
+@pytest.mark.parametrize('definition, names, ip, storesText', testData_roundtrip)
+def test_MappingRecord_roundtrip(definition, names, ip, storesText):
+    record = MappingRecord.fromDefinition(definition)
+    assert record.raw == definition
+    assert record.text == definition.strip("'")
+    assert (record.names, record.ip) == (names, ip)
+    assert (record._text is not None) == storesText
+
+def test_MappingRecord_compact():
+    record = MappingRecord.fromDefinition("'/Web.Docker.lan/web2.docker.lan/172.18.0.2'")
+    assert not hasattr(record, "__dict__")
+    assert record.keys == ("web.docker.lan", "web2.docker.lan")
+    # Already lowercase names share the interned key string
+    assert record.names[1] is record.keys[1]
+    lower = MappingRecord.fromDefinition("/db.docker.lan/172.18.0.3")
+    assert lower.names is lower.keys
+    assert (lower.version, lower.packed) == (4, 0xAC120003)
+
+def test_MappingRecord_equality_and_order():
+    assert MappingRecord.fromDefinition("'/a.lan/1.1.1.1'") == MappingRecord.fromDefinition("/a.lan/1.1.1.1")
+    assert MappingRecord.fromDefinition("/a.lan/fd00::1") != MappingRecord.fromDefinition("/a.lan/fd00:0::1")
+    assert ipKey("fd00:0::1") == ipKey("fd00::1") == MappingRecord.fromDefinition("/a.lan/fd00:0::1").ipKey
+    # ::1.2.3.4 is an IPv6 address, not 1.2.3.4
+    assert ipKey("::1.2.3.4") != ipKey("1.2.3.4")
+    assert packIp("1.2.3") == (0, 0) and packIp("1.2.3.256") == (0, 0) and packIp(" 1.2.3.4") == (0, 0)
+
+    records = [MappingRecord.fromDefinition(d) for d in ["/b/10.0.0.10", "/v6/::1", "/a/10.0.0.9", "/x/#"]]
+    assert [r.text for r in sorted(records)] == ["/x/#", "/a/10.0.0.9", "/b/10.0.0.10", "/v6/::1"]
+
+def test_MappingTable_matches_other_spellings():
+    table = MappingTable(["'/v6.lan/fd00:0::5'", "'/other.lan/fd00::5'"])
+    assert table.definitionsFor("fd00::5") == ["/v6.lan/fd00:0::5", "/other.lan/fd00::5"]
+    assert table.ipFor("v6.lan") == "fd00:0::5"
+    assert table.definitions() == ["'/v6.lan/fd00:0::5'", "'/other.lan/fd00::5'"]
+
+def test_MappingTable_memory_per_record():
+    count = 20000
+    definitions = [f"'/host{i}.docker.lan/10.{i // 65536}.{(i // 256) % 256}.{i % 256}'" for i in range(count)]
+
+    tracemalloc.start()
+    try:
+        table = MappingTable(definitions)
+        used = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+
+    assert len(table) == count
+    # Names, record, packed ip and index slots; the string-keyed table needed about 900
+    assert used / count < 500
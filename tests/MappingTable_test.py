@@ -0,0 +1,68 @@
+import pytest
+import time
+
+from bpe_docker_to_openwrt.MappingRecord import MappingRecord
+from bpe_docker_to_openwrt.MappingTable import MappingTable
+
+# 'definition, expected'
+testData_parseDefinition = [
+    ("'/bob1/1.2.3.4'", ("/bob1/1.2.3.4", ("bob1",), "1.2.3.4")),
+    ("/bob2/bob2.lan/4.5.6.7", ("/bob2/bob2.lan/4.5.6.7", ("bob2", "bob2.lan"), "4.5.6.7")),
+    ("/a//b/fe80::1", ("/a//b/fe80::1", ("a", "b"), "fe80::1")),
+    ("'/nothing'", ("/nothing", (), "")),
+]
+
+@pytest.mark.parametrize('definition, expected', testData_parseDefinition)
+def test_parseDefinition(definition, expected):
+    record = MappingRecord.fromDefinition(definition)
+    assert (record.text, record.names, record.ip) == expected
+
+def test_MappingTable_lookups():
+    table = MappingTable(["'/bob1/1.2.3.4'", "'/Bob2/bob2.lan/4.5.6.7'", "'/bad'", "'/bob3/4.5.6.7'"])
+
+    assert len(table) == 4
+    assert table.findByName("BOB2") == "/Bob2/bob2.lan/4.5.6.7"
+    assert table.findByName("bob2.LAN") == "/Bob2/bob2.lan/4.5.6.7"
+    assert table.findByName("bad") == ""
+    assert table.ipFor("bob1") == "1.2.3.4"
+    assert table.ipFor("nobody") is None
+    assert sorted(table.namesFor("4.5.6.7")) == ["Bob2", "bob2.lan", "bob3"]
+    assert table.definitionsFor("4.5.6.7") == ["/Bob2/bob2.lan/4.5.6.7", "/bob3/4.5.6.7"]
+    assert "bob3" in table and "BOB3" in table and "bob4" not in table
+    assert table.mappings() == {"bob1": "1.2.3.4", "Bob2": "4.5.6.7", "bob2.lan": "4.5.6.7", "bob3": "4.5.6.7"}
+    # The list keeps its original form, invalid entries included
+    assert table.definitions() == ["'/bob1/1.2.3.4'", "'/Bob2/bob2.lan/4.5.6.7'", "'/bad'", "'/bob3/4.5.6.7'"]
+
+def test_MappingTable_indexes_follow_changes():
+    table = MappingTable(["'/dup/1.1.1.1'", "'/dup/other/2.2.2.2'"])
+    assert table.findByName("dup") == "/dup/1.1.1.1"
+
+    # Quoted or not, it is the same definition
+    assert table.remove("/dup/1.1.1.1")
+    assert not table.remove("'/dup/1.1.1.1'")
+    assert table.findByName("dup") == "/dup/other/2.2.2.2"
+    assert table.definitionsFor("1.1.1.1") == []
+
+    assert table.addMapping(["new", "New.lan"], "3.3.3.3") == "/new/New.lan/3.3.3.3"
+    assert table.ipFor("new.lan") == "3.3.3.3"
+
+    table.remove("/dup/other/2.2.2.2")
+    table.remove("/new/New.lan/3.3.3.3")
+    assert len(table) == 0
+    assert table._byName == {} and table._byIp == {}
+
+def test_MappingTable_scales_linearly():
+    count = 20000
+    definitions = [f"'/host{i}.docker.lan/10.{i // 65536}.{(i // 256) % 256}.{i % 256}'" for i in range(count)]
+
+    start = time.perf_counter()
+    table = MappingTable(definitions)
+    for i in range(count):
+        assert table.findByName(f"HOST{i}.docker.lan") != ""
+    for i in range(0, count, 2):
+        table.remove(table.findByName(f"host{i}.docker.lan"))
+    elapsed = time.perf_counter() - start
+
+    assert len(table) == count // 2
+    # A quadratic scan would take minutes here
+    assert elapsed < 5
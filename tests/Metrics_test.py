@@ -0,0 +1,75 @@
+import json
+import pytest
+
+from bpe_docker_to_openwrt.Metrics import Metrics, NULL_SPAN
+
+
+def fakeClock(*readings: float):
+    values = list(readings)
+    return lambda: values.pop(0)
+
+def test_Metrics_disabled_records_nothing():
+    metrics = Metrics()
+
+    span = metrics.span("ssh", router="r1")
+    assert span is NULL_SPAN
+    with span:
+        pass
+    metrics.count("ssh_commands", router="r1")
+
+    assert metrics.snapshot()["spans"] == []
+    assert metrics.snapshot()["counters"] == []
+
+def test_Metrics_spans_and_counters():
+    metrics = Metrics(enabled=True, clock=fakeClock(1.0, 1.5, 2.0, 4.0, 10.0, 10.25), wallClock=lambda: 1700000000.0)
+
+    with metrics.span("ssh", router="r1"):
+        pass
+    with metrics.span("ssh", router="r1"):
+        pass
+    # A span that raises is still timed
+    with pytest.raises(RuntimeError):
+        with metrics.span("plan"):
+            raise RuntimeError("boom")
+    metrics.count("mappings", 3, action="add", router="r1")
+    metrics.count("mappings", 2, action="add", router="r1")
+    metrics.count("mappings", 1, action="remove", router="r1")
+
+    stats = metrics.spanStats("ssh", router="r1")
+    assert stats is not None
+    assert (stats.count, stats.seconds, stats.maxSeconds) == (2, 2.5, 2.0)
+    assert metrics.counterValue("mappings", action="add", router="r1") == 5
+    assert metrics.counterValue("mappings", action="replace", router="r1") == 0
+
+    snapshot = json.loads(metrics.toJson())
+    assert snapshot["timestamp"] == 1700000000.0
+    assert [(s["name"], s["labels"], s["count"]) for s in snapshot["spans"]] == [("plan", {}, 1), ("ssh", {"router": "r1"}, 2)]
+    assert len(snapshot["counters"]) == 2
+
+def test_Metrics_prometheus(tmp_path):
+    metrics = Metrics(enabled=True, clock=fakeClock(0.0, 0.5), wallClock=lambda: 1700000000.0)
+    with metrics.span("ssh", router='root@"odd"\\host'):
+        pass
+    metrics.count("ssh_commands", router="r1")
+    metrics.count("ssh-handshakes", router="r1")
+
+    path = tmp_path / "bpe.prom"
+    metrics.writePrometheus(path)
+
+    assert path.read_text() == "\n".join([
+        "# HELP bpe_docker_to_openwrt_span_seconds Time spent in each phase of a run",
+        "# TYPE bpe_docker_to_openwrt_span_seconds summary",
+        'bpe_docker_to_openwrt_span_seconds_sum{span="ssh",router="root@\\"odd\\"\\\\host"} 0.500000',
+        'bpe_docker_to_openwrt_span_seconds_count{span="ssh",router="root@\\"odd\\"\\\\host"} 1',
+        "# HELP bpe_docker_to_openwrt_span_max_seconds Longest single run of each phase",
+        "# TYPE bpe_docker_to_openwrt_span_max_seconds gauge",
+        'bpe_docker_to_openwrt_span_max_seconds{span="ssh",router="root@\\"odd\\"\\\\host"} 0.500000',
+        "# TYPE bpe_docker_to_openwrt_ssh_handshakes_total counter",
+        'bpe_docker_to_openwrt_ssh_handshakes_total{router="r1"} 1',
+        "# TYPE bpe_docker_to_openwrt_ssh_commands_total counter",
+        'bpe_docker_to_openwrt_ssh_commands_total{router="r1"} 1',
+        "# TYPE bpe_docker_to_openwrt_last_run_timestamp_seconds gauge",
+        "bpe_docker_to_openwrt_last_run_timestamp_seconds 1700000000.000",
+    ]) + "\n"
+    # Nothing left behind from the write-then-rename
+    assert [p.name for p in tmp_path.iterdir()] == ["bpe.prom"]
@@ -0,0 +1,98 @@
+import io
+import itertools
+import random
+import re
+import pytest
+
+import bpe_docker_to_openwrt.NamingRules as NamingRules_module
+
+from bpe_docker_to_openwrt.ContainerRecord import ContainerRecord
+from bpe_docker_to_openwrt.NamingRules import (COMPOSE_NUMBER_LABEL, COMPOSE_PROJECT_LABEL, COMPOSE_SERVICE_LABEL, HOSTNAME_LABEL,
+                                               NamingRules, compileBytesTable, compileTable)
+
+re_symbol = re.compile(r"[\@\#\$\%\\]")
+
+def chained(name: str, replaceUnderscores: str = "-", replaceDots: str = ".", replaceColons: str = "-", replaceSymbols: str = "") -> str:
+    """The replace chain the table stands in for"""
+    name = name.replace("_", replaceUnderscores).replace(".", replaceDots).replace(":", replaceColons)
+    return re_symbol.sub(replaceSymbols, name)
+
+def container(name: str, ip: str = "172.18.0.2", **labels: str) -> ContainerRecord:
+    return ContainerRecord(name=name, networks={"bridge": [ip]} if ip else {}, labels=labels)
+
+def compose(name: str, project: str, service: str, number: str = "1", ip: str = "172.18.0.2") -> ContainerRecord:
+    return container(name, ip, **{COMPOSE_PROJECT_LABEL: project, COMPOSE_SERVICE_LABEL: service, COMPOSE_NUMBER_LABEL: number})
+
+def test_compileTable_matches_the_replace_chain():
+    rng = random.Random(1)
+    # Replacements that feed later steps included
+    for replacements in itertools.product(["", "-", ".", "_", ":", "@", "x_", ".:"], repeat=4):
+        rules = NamingRules(*replacements)
+        for _ in range(5):
+            name = "".join(rng.choice("ab_.:@#$%\\-") for _ in range(10))
+            assert rules.translate(name) == chained(name, *replacements), (name, replacements)
+
+def test_compileBytesTable():
+    assert compileBytesTable(compileTable()) is not None
+    # More than one character out for one in can't be done byte for byte
+    assert compileBytesTable(compileTable(replaceUnderscores="--")) is None
+    assert NamingRules(replaceUnderscores="--").translate("a_b@c") == "a--bc"
+    assert NamingRules().translate("wëb_app") == "wëb-app"
+
+# 'desc, rules, record, expected'
+testData_NamingRules_nameFor = [
+    ("container name", NamingRules(), container("web_app:1@x"), "web-app-1x"),
+    ("hostname label wins", NamingRules(composeTemplate="{service}"),
+        container("edge_web_1", **{HOSTNAME_LABEL: "front_door", COMPOSE_SERVICE_LABEL: "web"}), "front-door"),
+    ("labels ignored", NamingRules(hostnameLabel=None), container("web", **{HOSTNAME_LABEL: "other"}), "web"),
+    ("empty label ignored", NamingRules(), container("web", **{HOSTNAME_LABEL: ""}), "web"),
+    ("custom label", NamingRules(hostnameLabel="dns.name"), container("web", **{"dns.name": "www"}), "www"),
+    ("compose template", NamingRules(composeTemplate="{service}-{number}.{project}"), compose("edge-web-2", "edge", "web", "2"), "web-2.edge"),
+    ("compose template without compose", NamingRules(composeTemplate="{service}.{project}"), container("plain"), "plain"),
+    ("rfc1123 lowercases", NamingRules(rfc1123=True), container("Web_App"), "web-app"),
+    ("rfc1123 fixes characters", NamingRules(rfc1123=True), container("web", **{HOSTNAME_LABEL: "my app!.-x-"}), "my-app.x"),
+    ("rfc1123 long label", NamingRules(rfc1123=True), container("a" * 70), "a" * 63),
+    ("rfc1123 long name", NamingRules(rfc1123=True, maxLength=20), container("abcdefghij.klmnopqrst.uvw"), "abcdefghij.klmnopqrs"),
+    ("rfc1123 nothing left", NamingRules(rfc1123=True), container("web", **{HOSTNAME_LABEL: "---"}), None),
+    ("nothing left", NamingRules(), container("@#"), None),
+]
+
+@pytest.mark.parametrize('desc, rules, record, expected', testData_NamingRules_nameFor)
+def test_NamingRules_nameFor(desc, rules, record, expected):
+    assert rules.nameFor(record) == expected
+
+def test_NamingRules_bad_template():
+    with pytest.raises(ValueError, match="{image}"):
+        NamingRules(composeTemplate="{service}-{image}")
+
+def test_NamingRules_assign(monkeypatch):
+    errors = io.StringIO()
+    monkeypatch.setattr(NamingRules_module, "stderr", errors)
+    rules = NamingRules()
+    records = [
+        container("web_app", "172.18.0.5"),
+        container("no_network", ""),
+        container("web-app", "172.18.0.6"),
+        container("web.app", "172.18.0.7"),
+        # Same name and ip is not a collision
+        container("db", "172.18.0.9"),
+        container("db", "172.18.0.9"),
+        container("@@", "172.18.0.10"),
+    ]
+
+    mappings, collisions = rules.assign(records)
+    assert mappings == {"web-app": "172.18.0.6", "web.app": "172.18.0.7", "db": "172.18.0.9"}
+    assert [(c.name, c.claims) for c in collisions] == [("web-app", [("web-app", "172.18.0.6"), ("web_app", "172.18.0.5")])]
+
+    assert "web-app is wanted by containers web-app, web_app, giving it to web-app" in errors.getvalue()
+    assert "No usable hostname for container @@" in errors.getvalue()
+
+    # The same winner whatever order the containers are listed in
+    assert rules.assign(reversed(records))[0] == mappings
+
+def test_NamingRules_compose_collisions():
+    rules = NamingRules(composeTemplate="{service}")
+    mappings, collisions = rules.assign([compose("b_web_1", "b", "web", ip="10.0.0.2"), compose("a_web_1", "a", "web", ip="10.0.0.1")])
+
+    assert mappings == {"web": "10.0.0.1"}
+    assert collisions[0].claims == [("a_web_1", "10.0.0.1"), ("b_web_1", "10.0.0.2")]
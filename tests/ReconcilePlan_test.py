@@ -0,0 +1,100 @@
+import pytest
+import time
+
+from bpe_docker_to_openwrt.MappingTable import MappingTable
+from bpe_docker_to_openwrt.ReconcilePlan import planChanges
+
+CURRENT = [
+    "'/web.docker.lan/172.18.0.2'",
+    "'/db.docker.lan/db.alias.docker.lan/172.18.0.3'",
+    "'/old.docker.lan/172.18.0.4'",
+    "'/printer.lan/192.168.1.20'",
+]
+
+def isDocker(name: str) -> bool:
+    return name.endswith(".docker.lan")
+
+# 'desc, desired, kwargs, expected'
+testData_planChanges = [
+    ("nothing to do",
+        {"web.docker.lan": "172.18.0.2", "db.docker.lan": "172.18.0.3", "db.alias.docker.lan": "172.18.0.3", "old.docker.lan": "172.18.0.4"},
+        {"owned": isDocker},
+        []),
+    ("stale names go, foreign names stay",
+        {"web.docker.lan": "172.18.0.2", "db.docker.lan": "172.18.0.3", "db.alias.docker.lan": "172.18.0.3"},
+        {"owned": isDocker},
+        ["- /old.docker.lan/172.18.0.4"]),
+    ("changed ip is one replacement",
+        {"web.docker.lan": "172.18.0.9", "db.docker.lan": "172.18.0.3", "db.alias.docker.lan": "172.18.0.3", "old.docker.lan": "172.18.0.4"},
+        {"owned": isDocker},
+        ["~ /web.docker.lan/172.18.0.2 -> /web.docker.lan/172.18.0.9"]),
+    ("dropping one name of a shared definition keeps the rest",
+        {"web.docker.lan": "172.18.0.2", "db.docker.lan": "172.18.0.3", "old.docker.lan": "172.18.0.4"},
+        {"owned": isDocker},
+        ["~ /db.docker.lan/db.alias.docker.lan/172.18.0.3 -> /db.docker.lan/172.18.0.3"]),
+    ("new name on a known ip joins its definition",
+        {"web.docker.lan": "172.18.0.2", "www.docker.lan": "172.18.0.2", "db.docker.lan": "172.18.0.3", "db.alias.docker.lan": "172.18.0.3", "old.docker.lan": "172.18.0.4"},
+        {"owned": isDocker},
+        ["~ /web.docker.lan/172.18.0.2 -> /web.docker.lan/www.docker.lan/172.18.0.2"]),
+    ("without merging it gets its own",
+        {"web.docker.lan": "172.18.0.2", "www.docker.lan": "172.18.0.2", "db.docker.lan": "172.18.0.3", "db.alias.docker.lan": "172.18.0.3", "old.docker.lan": "172.18.0.4"},
+        {"owned": isDocker, "merge": False},
+        ["+ /www.docker.lan/172.18.0.2"]),
+    ("new names sharing an ip are added together",
+        {"a.docker.lan": "172.18.0.7", "b.docker.lan": "172.18.0.7"},
+        {"scope": ["a.docker.lan", "b.docker.lan"]},
+        ["+ /a.docker.lan/b.docker.lan/172.18.0.7"]),
+    ("scope leaves everything else alone",
+        {"new.docker.lan": "172.18.0.8"},
+        {"scope": ["old.docker.lan", "new.docker.lan"]},
+        ["- /old.docker.lan/172.18.0.4", "+ /new.docker.lan/172.18.0.8"]),
+    ("names match in any case",
+        {"WEB.docker.lan": "172.18.0.2"},
+        {"scope": ["WEB.docker.lan"]},
+        []),
+]
+
+@pytest.mark.parametrize('desc, desired, kwargs, expected', testData_planChanges)
+def test_planChanges(desc, desired, kwargs, expected):
+    plan = planChanges(desired, MappingTable(CURRENT), **kwargs)
+    assert [str(change) for change in plan.changes] == expected
+
+def test_planChanges_counts():
+    desired = {"web.docker.lan": "172.18.0.9", "db.docker.lan": "172.18.0.3", "db.alias.docker.lan": "172.18.0.3", "new.docker.lan": "172.18.0.8"}
+    plan = planChanges(desired, MappingTable(CURRENT), owned=isDocker)
+
+    assert plan.counts() == {"add": 1, "remove": 1, "replace": 1, "unchanged": 1}
+    assert [change.action for change in plan.changes] == ["remove", "replace", "add"]
+
+def test_planChanges_compares_addresses_not_text():
+    table = MappingTable(["'/v6.docker.lan/fd00::7'", "'/w6.docker.lan/fd00::8'"])
+    plan = planChanges({"v6.docker.lan": "fd00:0:0::7", "x6.docker.lan": "fd00:0::8"}, table)
+
+    # v6 is spelled differently but already right
+    assert [str(change) for change in plan.changes] == ["- /w6.docker.lan/fd00::8", "+ /x6.docker.lan/fd00:0::8"]
+    assert plan.unchanged == 1
+
+def test_planChanges_scales():
+    count = 50000
+    definitions = [f"'/host{i}.docker.lan/10.{i // 65536}.{(i // 256) % 256}.{i % 256}'" for i in range(count)]
+    # Every tenth container moved, every hundredth is new
+    desired = {f"host{i}.docker.lan": f"10.{i // 65536}.{(i // 256) % 256}.{i % 256}" for i in range(count)}
+    for i in range(0, count, 10):
+        desired[f"host{i}.docker.lan"] = f"10.200.{(i // 256) % 256}.{i % 256}"
+    for i in range(0, count, 100):
+        desired[f"extra{i}.docker.lan"] = f"10.201.{(i // 256) % 256}.{i % 256}"
+
+    # Measured against parsing the same list, one linear pass, so a slow host slows both.
+    # Planning costs about as much; best of a few so one busy moment does not fail it.
+    best = float("inf")
+    for _ in range(3):
+        start = time.perf_counter()
+        table = MappingTable(definitions)
+        parsed = time.perf_counter() - start
+
+        start = time.perf_counter()
+        plan = planChanges(desired, table)
+        best = min(best, (time.perf_counter() - start) / parsed)
+
+    assert plan.counts() == {"add": count // 100, "remove": 0, "replace": count // 10, "unchanged": count - count // 10}
+    assert best < 2, best
@@ -3,8 +3,9 @@ import pytest
 from subprocess import CompletedProcess
 from typing import Dict, Any
 import pathlib
+import os
 
-from bpe_docker_to_openwrt.RouterObject import RouterObject
+from bpe_docker_to_openwrt.RouterObject import FINGERPRINT_CHANGED, RouterObject
 
 testData_RouterObject_init = [ 
     (
@@ -132,9 +133,18 @@ testData_RouterObject_getDefinedExtraDNS = [
     (
         0,
         "dhcp.cfg01522b.address='/bob.lan/172.17.0.99' '/bob2.lan/172.17.0.98'",
-        ["'/bob.lan/172.17.0.99'", "'/bob2.lan/172.17.0.98'"],
-        ["'/bob.lan/172.17.0.99'", "'/bob2.lan/172.17.0.98'"]
+        ["/bob.lan/172.17.0.99", "/bob2.lan/172.17.0.98"],
+        ["/bob.lan/172.17.0.99", "/bob2.lan/172.17.0.98"]
     ),
+    (
+        0,
+        "\npackage dhcp\n\nconfig dnsmasq\n\toption domainneeded '1'\n\tlist address '/bob.lan/172.17.0.99'\n\tlist address '/it'\\''s.lan/172.17.0.98'\n\n"
+        "config dnsmasq 'second'\n\tlist address '/other.lan/10.0.0.1'\n\nconfig host\n\toption name 'printer'\n",
+        ["/bob.lan/172.17.0.99", "/it's.lan/172.17.0.98"],
+        ["/bob.lan/172.17.0.99", "/it's.lan/172.17.0.98"]
+    ),
+    (0,"\npackage dhcp\n\nconfig dnsmasq\n\toption domainneeded '1'\n",[],[]),
+    (0,"package dhcp\nconfig dnsmasq\n\tlist address '/unterminated\n",None,[]),
 ]
 
 # 'desc, dns, definitions, last, expected'
@@ -274,17 +284,17 @@ def test_RouterObject_doSSHcmd():
     testObj = RouterObject('hostname', port=1234)
     
     res = testObj.doSSHcmd('command1', doTest=True, testRunReturn=CompletedProcess(args=[], returncode=0))
-    assert res.stderr.strip() == "Test: cmd[/usr/bin/ssh root@hostname -p 1234 command1]"
+    assert res.stderr.strip() == "Test: cmd[/usr/bin/ssh -p 1234 -o ConnectTimeout=10 -- root@hostname command1]"
 
     testObj.setUsername('bob')
     testObj._hostname = 'ahost'
     res = testObj.doSSHcmd('command1 arg1 arg2', doTest=True, testRunReturn=CompletedProcess(args=[], returncode=0))
-    assert res.stderr.strip() == "Test: cmd[/usr/bin/ssh bob@ahost -p 1234 command1 arg1 arg2]"
+    assert res.stderr.strip() == "Test: cmd[/usr/bin/ssh -p 1234 -o ConnectTimeout=10 -- bob@ahost command1 arg1 arg2]"
 
     testObj.setIdentityFile('tests/test_id1')
     testObj._username = ""
     res = testObj.doSSHcmd(['one','two','three'], doTest=True, testRunReturn=CompletedProcess(args=[], returncode=0))
-    assert res.stderr.strip() == f"Test: cmd[/usr/bin/ssh ahost -p 1234 -i {pathlib.Path('tests/test_id1').expanduser().resolve()} one two three]"
+    assert res.stderr.strip() == f"Test: cmd[/usr/bin/ssh -p 1234 -i {pathlib.Path('tests/test_id1').expanduser().resolve()} -o ConnectTimeout=10 -- ahost one two three]"
 
     testObj._sshexe = None
     try:
@@ -317,4 +327,562 @@ def test_RouterObject_mappingsFromDefinitions(desc, definitions, expected):
     testObj._lastDefinedExtraDNS = []
     res = testObj.mappingsFromDefinitions(definitions=definitions)
 
-    assert res == expected
\ No newline at end of file
+    assert res == expected
+
+def test_RouterObject_batch_queues_commands():
+    testObj = RouterObject('hostname')
+    testObj._lastDefinedExtraDNS = ["/old.lan/1.2.3.4"]
+
+    testObj.beginBatch()
+    assert testObj.InBatch
+    testObj.removeDNSMapping('old.lan')
+    testObj.addDNSMapping('new.lan', '5.6.7.8')
+    testObj.commit()
+
+    assert testObj._batch == [
+        "uci del_list dhcp.@dnsmasq[0].address='/old.lan/1.2.3.4'",
+        "uci add_list dhcp.@dnsmasq[0].address='/new.lan/5.6.7.8'",
+        "uci commit dhcp",
+        "service dnsmasq reload",
+    ]
+    assert testObj._lastDefinedExtraDNS == ["/new.lan/5.6.7.8"]
+
+    try:
+        testObj.beginBatch()
+        assert False
+    except Exception as e:
+        assert isinstance(e, RuntimeError)
+
+def test_RouterObject_applyBatch():
+    testObj = RouterObject('hostname')
+    testObj.beginBatch()
+    testObj.runOrQueue("uci add_list a='/x/1.1.1.1'")
+    testObj.runOrQueue("uci commit dhcp")
+    testObj.runOrQueue("service dnsmasq reload")
+
+    output = "@@bpe-batch:0:0\nuci: Parse error\n@@bpe-batch:1:1\n"
+    results = testObj.applyBatch(doTest=True, testRunReturn=CompletedProcess(args=[], returncode=0, stdout=output))
+
+    assert not testObj.InBatch
+    assert [(r.command, r.returncode, r.output) for r in results] == [
+        ("uci add_list a='/x/1.1.1.1'", 0, ""),
+        ("uci commit dhcp", 1, "uci: Parse error"),
+        ("service dnsmasq reload", 255, ""),
+    ]
+
+def test_RouterObject_batchScript():
+    testObj = RouterObject('hostname')
+    script = testObj.batchScript(["uci commit dhcp", "service dnsmasq reload"])
+
+    assert script == ('uci commit dhcp 2>&1; echo "@@bpe-batch:0:$?"\n'
+                      'service dnsmasq reload 2>&1; echo "@@bpe-batch:1:$?"\n')
+
+    # The script really does report per command status when run by a shell
+    from subprocess import run
+    res = run(["sh", "-s"], input=testObj.batchScript(["true", "false", "echo hi"]), capture_output=True, text=True)
+    results = testObj.parseBatchOutput(["true", "false", "echo hi"], res.stdout)
+    assert [(r.returncode, r.output) for r in results] == [(0, ""), (1, ""), (0, "hi")]
+
+# A stand-in ssh that logs its arguments and fakes the ControlMaster socket
+FAKE_SSH = r'''#!/usr/bin/env python3
+import os, sys
+args = sys.argv[1:]
+with open(os.environ["FAKE_SSH_LOG"], "a") as log:
+    log.write(" ".join(args) + "\n")
+path = args[args.index("-S") + 1] if "-S" in args else None
+if "-O" in args:
+    op = args[args.index("-O") + 1]
+    if op == "check":
+        sys.exit(0 if path and os.path.exists(path) else 255)
+    if op == "exit" and path and os.path.exists(path):
+        os.remove(path)
+    sys.exit(0)
+if os.environ.get("FAKE_SSH_HANG"):
+    import time
+    time.sleep(30)
+failures = os.environ.get("FAKE_SSH_FAILURES")
+if failures and "-O" not in args:
+    # Holds how many more connections should fail
+    left = int(open(failures).read())
+    if left > 0:
+        open(failures, "w").write(str(left - 1))
+        sys.stderr.write("ssh: connect to host hostname port 22: Connection refused\n")
+        sys.exit(255)
+if path and ("-M" in args or "ControlMaster=auto" in args) and not os.path.exists(path):
+    open(path, "w").close()
+if "-M" not in args:
+    print("ran " + args[-1])
+'''
+
+@pytest.fixture
+def fake_ssh(tmp_path, monkeypatch):
+    exe = tmp_path / "ssh"
+    exe.write_text(FAKE_SSH)
+    exe.chmod(0o755)
+    log = tmp_path / "ssh.log"
+    log.write_text("")
+    monkeypatch.setenv("FAKE_SSH_LOG", str(log))
+    return exe, log
+
+def test_RouterObject_connectionReuse(fake_ssh, tmp_path):
+    exe, log = fake_ssh
+    testObj = RouterObject('hostname', cmdname=str(exe))
+    testObj.enableConnectionReuse(controlPath=tmp_path / "ctl")
+
+    with testObj:
+        for i in range(5):
+            res = testObj.doSSHcmd(f"cmd{i}")
+            assert res.stdout.strip() == f"ran cmd{i}"
+
+    assert testObj.SSHStats == {"handshakes": 1, "commands": 5}
+    assert not (tmp_path / "ctl").exists()
+
+    calls = log.read_text().splitlines()
+    assert len([c for c in calls if " -M " in c]) == 1
+    assert all(f"-S {tmp_path / 'ctl'}" in c for c in calls)
+    assert calls[-1].endswith("-O exit -- root@hostname")
+
+def test_RouterObject_connectionReuse_keepMaster(fake_ssh, tmp_path):
+    exe, log = fake_ssh
+    testObj = RouterObject('hostname', cmdname=str(exe))
+    testObj.enableConnectionReuse(controlPath=tmp_path / "ctl", keepMaster=True)
+
+    for run in range(3):
+        with testObj:
+            testObj.doSSHcmd("cmd")
+
+    # The master from the first run survives and is picked up by the later ones
+    assert testObj.SSHStats == {"handshakes": 1, "commands": 3}
+    assert (tmp_path / "ctl").exists()
+
+    testObj.disableConnectionReuse()
+    assert not (tmp_path / "ctl").exists()
+
+def test_RouterObject_noConnectionReuse(fake_ssh):
+    exe, log = fake_ssh
+    testObj = RouterObject('hostname', cmdname=str(exe))
+
+    for i in range(3):
+        testObj.doSSHcmd("cmd")
+
+    assert testObj.SSHStats == {"handshakes": 3, "commands": 3}
+    assert "-S" not in log.read_text()
+
+def test_RouterObject_ssh_timeout(fake_ssh, monkeypatch):
+    import time
+    exe, log = fake_ssh
+    monkeypatch.setenv("FAKE_SSH_HANG", "1")
+    testObj = RouterObject('hostname', cmdname=str(exe))
+    testObj.setTimeouts(timeout=0.5, retries=2)
+
+    start = time.monotonic()
+    res = testObj.doSSHcmd("cmd")
+    assert time.monotonic() - start < 10
+    assert res.returncode == 124
+    assert "Timed out" in res.stderr
+    # It may have run, so it is not tried again
+    assert len(log.read_text().splitlines()) == 1
+
+@pytest.mark.parametrize('failures, retries, returncode, attempts', [
+    (0, 2, 0, 1),
+    (2, 2, 0, 3),
+    (3, 2, 255, 3),
+    (1, 0, 255, 1),
+])
+def test_RouterObject_ssh_retries(fake_ssh, monkeypatch, tmp_path, failures, retries, returncode, attempts):
+    exe, log = fake_ssh
+    counter = tmp_path / "failures"
+    counter.write_text(str(failures))
+    monkeypatch.setenv("FAKE_SSH_FAILURES", str(counter))
+    testObj = RouterObject('hostname', cmdname=str(exe))
+    testObj.setTimeouts(retries=retries, retryBackoff=1.0)
+    slept = []
+    testObj._sleep = slept.append
+
+    res = testObj.doSSHcmd("cmd")
+    assert res.returncode == returncode
+    assert len(log.read_text().splitlines()) == attempts
+    assert len(slept) == attempts - 1
+    assert all(0.5 * 2 ** i <= delay <= 2 ** i for i, delay in enumerate(slept))
+
+def test_RouterObject_ssh_deadline(fake_ssh):
+    from bpe_docker_to_openwrt.Deadline import DeadlineExceeded, runDeadline
+    exe, log = fake_ssh
+    testObj = RouterObject('hostname', cmdname=str(exe))
+
+    runDeadline.start(0)
+    try:
+        with pytest.raises(DeadlineExceeded):
+            testObj.doSSHcmd("cmd")
+    finally:
+        runDeadline.clear()
+    assert log.read_text() == ""
+
+@pytest.mark.parametrize('spec, expected', [
+    ("openwrt.lan", "root@openwrt.lan:22"),
+    ("admin@mesh1", "admin@mesh1:22"),
+    ("admin@10.0.0.2:2222", "admin@10.0.0.2:2222"),
+])
+def test_RouterObject_fromSpec(spec, expected):
+    assert RouterObject.fromSpec(spec).Target == expected
+
+@pytest.mark.parametrize('spec', ["-oProxyCommand=reboot", "root@-oProxyCommand=reboot", "-l@host", "host:22 -v", "host:port", ""])
+def test_RouterObject_fromSpec_invalid(spec):
+    with pytest.raises(ValueError):
+        RouterObject.fromSpec(spec)
+
+def test_RouterObject_applyPlan_atomic():
+    from bpe_docker_to_openwrt.ReconcilePlan import planChanges
+    testObj = RouterObject('hostname')
+    testObj._lastDefinedExtraDNS = ["'/web.lan/1.1.1.1'"]
+    plan = planChanges({"web.lan": "2.2.2.2"}, testObj.Mappings)
+
+    # The replace's add_list failed, so the router reverted and nothing was committed
+    output = "@@bpe-batch:0:0\nuci: Invalid argument\n@@bpe-batch:1:1\n"
+    results = testObj.applyPlan(plan, doTest=True, testRunReturn=CompletedProcess(args=[], returncode=1, stdout=output))
+
+    assert [(r.command, r.returncode) for r in results] == [
+        ("uci del_list dhcp.@dnsmasq[0].address='/web.lan/1.1.1.1'", 0),
+        ("uci add_list dhcp.@dnsmasq[0].address='/web.lan/2.2.2.2'", 1),
+        ("uci commit dhcp", 255),
+        ("service dnsmasq reload", 255),
+    ]
+    assert testObj.mappedIP("web.lan") == "1.1.1.1"
+    assert not testObj.InBatch
+
+    # An atomic script stops at the first failure
+    from subprocess import run
+    res = run(["sh", "-s"], input=testObj.batchScript(["true", "false", "echo hi"], atomic=True), capture_output=True, text=True)
+    results = testObj.parseBatchOutput(["true", "false", "echo hi"], res.stdout)
+    assert [(r.returncode, r.output) for r in results] == [(0, ""), (1, ""), (255, "")]
+
+def test_RouterObject_applyPlan_fingerprint_guard():
+    from subprocess import run
+    from bpe_docker_to_openwrt.ReconcilePlan import planChanges
+    testObj = RouterObject('hostname')
+    testObj._cmd_fingerprint = "echo 0123456789abcdef0123456789abcdef"
+    testObj._lastDefinedExtraDNS = ["'/web.lan/1.1.1.1'"]
+    plan = planChanges({"web.lan": "2.2.2.2"}, testObj.Mappings)
+
+    results = testObj.applyPlan(plan, expectFingerprint="0123456789abcdef0123456789abcdef", doTest=True,
+                                testRunReturn=CompletedProcess(args=[], returncode=0, stdout="".join(f"@@bpe-batch:{i}:0\n" for i in range(5))))
+    assert results[0].command == testObj.fingerprintGuard("0123456789abcdef0123456789abcdef")
+    assert len(results) == 5
+
+    # The guard is a real shell test, and an atomic script stops there when it fails
+    commands = [testObj.fingerprintGuard("ffffffffffffffffffffffffffffffff"), "echo changed"]
+    res = run(["sh", "-s"], input=testObj.batchScript(commands, atomic=True), capture_output=True, text=True)
+    assert [r.returncode for r in testObj.parseBatchOutput(commands, res.stdout)] == [FINGERPRINT_CHANGED, 255]
+    commands[0] = testObj.fingerprintGuard("0123456789abcdef0123456789abcdef")
+    res = run(["sh", "-s"], input=testObj.batchScript(commands, atomic=True), capture_output=True, text=True)
+    assert [r.returncode for r in testObj.parseBatchOutput(commands, res.stdout)] == [0, 0]
+
+def test_RouterObject_stateCache(tmp_path):
+    from bpe_docker_to_openwrt.StateCache import StateCache
+    cache = StateCache(tmp_path)
+    testObj = RouterObject('hostname')
+    testObj.enableStateCache(cache)
+    full = "@@bpe-fingerprint:abc\ndhcp.cfg01411c.address='/a.lan/1.1.1.1' '/b.lan/2.2.2.2'\n"
+
+    # Nothing cached yet, so the whole list comes over and is stored
+    assert testObj.getDefinedExtraDNS(doTest=True, testRunReturn=CompletedProcess(args=[], returncode=0, stdout=full)) == ["/a.lan/1.1.1.1", "/b.lan/2.2.2.2"]
+    assert cache.load(testObj.Target).fingerprint == "abc"
+    assert testObj.fingerprintScript("abc").splitlines()[2] == '[ "$fp" = abc ] && exit 0'
+
+    # Same fingerprint: the router only sent the marker
+    testObj._lastDefinedExtraDNS = []
+    assert testObj.getDefinedExtraDNS(doTest=True, testRunReturn=CompletedProcess(args=[], returncode=0, stdout="@@bpe-fingerprint:abc\n")) == ["/a.lan/1.1.1.1", "/b.lan/2.2.2.2"]
+    assert testObj.LastQueryOk and testObj.CacheHits == 1
+    assert testObj.mappedIP("b.lan") == "2.2.2.2"
+
+    # Our own commit moves the cache on to the new fingerprint
+    testObj.beginBatch()
+    testObj.addDNSMapping("c.lan", "3.3.3.3")
+    testObj.commit()
+    output = "@@bpe-batch:0:0\n@@bpe-batch:1:0\n@@bpe-batch:2:0\n@@bpe-fingerprint:def\n"
+    results = testObj.applyBatch(doTest=True, testRunReturn=CompletedProcess(args=[], returncode=0, stdout=output))
+    assert [r.returncode for r in results] == [0, 0, 0]
+    state = cache.load(testObj.Target)
+    assert state.fingerprint == "def" and "/c.lan/3.3.3.3" in state.definitions
+
+    # Or forgets it
+    testObj.enableStateCache(cache, invalidateOnCommit=True)
+    testObj.beginBatch()
+    testObj.commit()
+    testObj.applyBatch(doTest=True, testRunReturn=CompletedProcess(args=[], returncode=0, stdout="@@bpe-batch:0:0\n@@bpe-batch:1:0\n"))
+    assert cache.load(testObj.Target) is None
+
+def test_RouterObject_fingerprintScript(tmp_path):
+    from subprocess import run
+    bindir = tmp_path / "bin"
+    bindir.mkdir()
+    fakeUci = bindir / "uci"
+    fakeUci.write_text("#!/bin/sh\necho \"dhcp.x.address='/a.lan/1.1.1.1'\"\n")
+    fakeUci.chmod(0o755)
+    env = dict(os.environ, PATH=f"{bindir}:{os.environ['PATH']}")
+    testObj = RouterObject('hostname')
+
+    first = run(["sh", "-s"], input=testObj.fingerprintScript(), capture_output=True, text=True, env=env)
+    fingerprint, rest = testObj.splitFingerprint(first.stdout)
+    assert len(fingerprint) == 32
+    assert rest == "dhcp.x.address='/a.lan/1.1.1.1'\n"
+
+    again = run(["sh", "-s"], input=testObj.fingerprintScript(fingerprint), capture_output=True, text=True, env=env)
+    assert again.returncode == 0
+    assert testObj.splitFingerprint(again.stdout) == (fingerprint, "")
+
+    # A corrupted cache entry is only ever compared, never run
+    marker = tmp_path / "injected"
+    corrupt = run(["sh", "-s"], input=testObj.fingerprintScript(f'x" ] || touch {marker}; [ "'), capture_output=True, text=True, env=env)
+    assert not marker.exists()
+    assert testObj.splitFingerprint(corrupt.stdout) == (fingerprint, rest)
+
+def test_RouterObject_hostsFile_plan():
+    from bpe_docker_to_openwrt.ReconcilePlan import planChanges
+    testObj = RouterObject('hostname')
+    testObj.useHostsFile("/tmp/hosts/bpe-docker")
+    content = "# Managed by bpe-docker-to-openwrt, changes will be overwritten\n172.18.0.2 web.docker.lan\n172.18.0.3 db.docker.lan db2.docker.lan\n"
+
+    assert testObj.getDefinedExtraDNS(doTest=True, testRunReturn=CompletedProcess(args=[], returncode=0, stdout=content)) == [
+        "/web.docker.lan/172.18.0.2", "/db.docker.lan/db2.docker.lan/172.18.0.3"]
+    # Writing back what was read is a no-op
+    assert testObj.renderHostsFile() == content
+    testObj.beginBatch()
+    testObj.commit()
+    assert testObj.applyBatch() == []
+
+    plan = planChanges({"web.docker.lan": "172.18.0.9", "db.docker.lan": "172.18.0.3", "db2.docker.lan": "172.18.0.3"}, testObj.Mappings)
+    results = testObj.applyPlan(plan, doTest=True, testRunReturn=CompletedProcess(args=[], returncode=0, stdout="@@bpe-batch:0:0\n"))
+
+    # No uci edits and no dnsmasq restart, just one upload
+    assert len(results) == 1
+    assert "uci" not in results[0].command and "service dnsmasq" not in results[0].command
+    assert "killall -HUP dnsmasq" in results[0].command
+    assert testObj.renderHostsFile().endswith("172.18.0.9 web.docker.lan\n")
+
+def test_RouterObject_hostsFile_missing():
+    testObj = RouterObject('hostname')
+    testObj.useHostsFile("/tmp/hosts/bpe-docker")
+    # No file yet: cat prints nothing
+    assert testObj.getDefinedExtraDNS(doTest=True, testRunReturn=CompletedProcess(args=[], returncode=0, stdout="")) == []
+    testObj.beginBatch()
+    testObj.commit()
+    assert testObj.applyBatch() == []
+
+    testObj.Mappings.addMapping(["web.docker.lan"], "172.18.0.2")
+    testObj.beginBatch()
+    testObj.commit()
+    assert len(testObj._batch) == 1
+    assert "172.18.0.2 web.docker.lan" in testObj._batch[0]
+    testObj.cancelBatch()
+
+def test_RouterObject_hostsUploadCommand(tmp_path):
+    from subprocess import run
+    bindir = tmp_path / "bin"
+    bindir.mkdir()
+    fakeKillall = bindir / "killall"
+    fakeKillall.write_text(f"#!/bin/sh\necho \"$@\" >> {tmp_path / 'signals'}\n")
+    fakeKillall.chmod(0o755)
+    env = dict(os.environ, PATH=f"{bindir}:{os.environ['PATH']}")
+    hostsFile = tmp_path / "hosts" / "bpe-docker"
+
+    testObj = RouterObject('hostname')
+    testObj.useHostsFile(str(hostsFile))
+    testObj.Mappings.addMapping(["web.docker.lan"], "172.18.0.2")
+    testObj.Mappings.addMapping(["db.docker.lan", "it's.odd"], "172.18.0.3")
+    content = testObj.renderHostsFile()
+    import hashlib
+    command = testObj.hostsUploadCommand(content, hashlib.md5(content.encode()).hexdigest())
+
+    assert run(["sh", "-c", command], env=env).returncode == 0
+    assert hostsFile.read_text() == content
+    # Same content again: the file is left alone and dnsmasq is not signalled
+    assert run(["sh", "-c", command], env=env).returncode == 0
+    assert (tmp_path / "signals").read_text() == "-HUP dnsmasq\n"
+
+def test_RouterObject_hostsShards(tmp_path):
+    from subprocess import run
+    from bpe_docker_to_openwrt.ReconcilePlan import planChanges
+    bindir = tmp_path / "bin"
+    bindir.mkdir()
+    fakeKillall = bindir / "killall"
+    fakeKillall.write_text(f"#!/bin/sh\necho \"$@\" >> {tmp_path / 'signals'}\n")
+    fakeKillall.chmod(0o755)
+    env = dict(os.environ, PATH=f"{bindir}:{os.environ['PATH']}")
+    hosts = tmp_path / "hosts"
+    hosts.mkdir()
+    header = "# Managed by bpe-docker-to-openwrt, changes will be overwritten\n"
+    (hosts / "bpe-docker.a.lan").write_text(header + "10.0.0.1 web.a.lan\n")
+    (hosts / "bpe-docker.b.lan").write_text(header + "10.0.1.1 web.b.lan\n10.0.1.2 db.b.lan\n")
+    # Not ours, so never read or written
+    (hosts / "other").write_text("10.9.9.9 web.a.lan\n")
+
+    testObj = RouterObject('hostname')
+    testObj.useHostsFile(str(hosts / "bpe-docker"), shards=["a.lan", "b.lan"])
+    assert testObj.hostsFiles() == [str(hosts / name) for name in ("bpe-docker", "bpe-docker.a.lan", "bpe-docker.b.lan")]
+    assert testObj.hostsFileFor("x.web.B.lan") == str(hosts / "bpe-docker.b.lan")
+    assert testObj.hostsFileFor("web.c.lan") == str(hosts / "bpe-docker")
+
+    listed = run(["sh", "-c", testObj._cmd_showDns], capture_output=True, text=True, env=env)
+    assert sorted(testObj.getDefinedExtraDNS(doTest=True, testRunReturn=CompletedProcess(args=[], returncode=0, stdout=listed.stdout))) == [
+        "/db.b.lan/10.0.1.2", "/web.a.lan/10.0.0.1", "/web.b.lan/10.0.1.1"]
+    # Writing back what was read touches nothing
+    testObj.beginBatch()
+    testObj.commit()
+    assert testObj.applyBatch() == []
+
+    plan = planChanges({"web.a.lan": "10.0.0.9", "new.c.lan": "10.0.2.1"}, testObj.Mappings, owned=lambda name: not name.endswith(".b.lan"))
+    testObj.beginBatch()
+    testObj.queuePlan(plan)
+    testObj.commit()
+    command = testObj._batch[0]
+    testObj.cancelBatch()
+    assert "bpe-docker.b.lan" not in command
+
+    before = (hosts / "bpe-docker.b.lan").stat().st_mtime_ns
+    assert run(["sh", "-c", command], env=env).returncode == 0
+    assert (hosts / "bpe-docker.a.lan").read_text() == header + "10.0.0.9 web.a.lan\n"
+    assert (hosts / "bpe-docker").read_text() == header + "10.0.2.1 new.c.lan\n"
+    assert (hosts / "bpe-docker.b.lan").stat().st_mtime_ns == before
+    assert (hosts / "other").read_text() == "10.9.9.9 web.a.lan\n"
+    # One signal for both files
+    assert (tmp_path / "signals").read_text() == "-HUP dnsmasq\n"
+
+def test_RouterObject_hostsUploadScript_failure(tmp_path):
+    from subprocess import run
+    blocked = tmp_path / "blocked"
+    blocked.write_text("")
+    testObj = RouterObject('hostname')
+    testObj.useHostsFile(str(tmp_path / "hosts"))
+
+    # The first file can't be written (its directory is a file), the second still is
+    command = testObj.hostsUploadScript([(str(blocked / "bpe-docker"), "x\n", "0" * 32), (str(tmp_path / "hosts"), "y\n", "0" * 32)])
+    res = run(["sh", "-c", f"killall() {{ true; }}; {command}"], capture_output=True, text=True)
+    assert res.returncode == 1
+    assert (tmp_path / "hosts").read_text() == "y\n"
+
+def test_RouterObject_writeHostsFile_on_stdin(tmp_path):
+    from subprocess import run
+    hostsFile = tmp_path / "bpe-docker"
+    testObj = RouterObject('hostname')
+    testObj.useHostsFile(str(hostsFile))
+    # Well over the 128 KiB a single argument may be
+    for index in range(10000):
+        testObj.Mappings.addMapping([f"container{index}.docker.lan"], f"172.18.{index // 250}.{index % 250 + 2}")
+    calls = []
+
+    def recordSSH(shellcmd, inputText=None):
+        calls.append((shellcmd, inputText))
+        return run(["sh", "-s"], input=f"killall() {{ true; }}\n{inputText}", capture_output=True, text=True)
+    testObj.runSSH = recordSSH
+
+    testObj.writeHostsFile()
+    shellcmd, inputText = calls[0]
+    assert shellcmd[-1] == "sh -s"
+    assert max(len(arg) for arg in shellcmd) < 1000
+    assert hostsFile.read_text() == testObj.renderHostsFile()
+
+def test_RouterObject_hostsFile_batch_leaves_uci_alone():
+    testObj = RouterObject('hostname')
+    assert "uci revert dhcp" in testObj.batchScript(["false"], atomic=True)
+    testObj.useHostsFile("/tmp/hosts/bpe-docker")
+    # Staged dhcp changes are someone else's
+    assert "uci" not in testObj.batchScript(["false"], atomic=True)
+
+def test_RouterObject_applyPlan_raises():
+    from bpe_docker_to_openwrt.Deadline import DeadlineExceeded
+    from bpe_docker_to_openwrt.ReconcilePlan import planChanges
+    testObj = RouterObject('hostname')
+    testObj.getDefinedExtraDNS(doTest=True, testRunReturn=CompletedProcess(args=[], returncode=0, stdout="dhcp.x.address='/a.lan/1.1.1.1'\n"))
+
+    def outOfTime(shellcmd, inputText=None):
+        raise DeadlineExceeded("Out of time before ssh to hostname")
+    testObj.runSSH = outOfTime
+
+    with pytest.raises(DeadlineExceeded):
+        testObj.applyPlan(planChanges({"a.lan": "1.1.1.9", "b.lan": "2.2.2.2"}, testObj.Mappings))
+    # The router did not change, and neither did what we think it holds
+    assert testObj.Mappings.definitions() == ["/a.lan/1.1.1.1"]
+    assert not testObj.InBatch
+
+def test_RouterObject_routerLock(tmp_path):
+    from subprocess import run
+    lock = str(tmp_path / "bpe.lock")
+    first = RouterObject('hostname')
+    first.useRouterLock(lock, ttl=60)
+
+    assert run(["sh", "-c", first.routerLockScript()]).returncode == 0
+    # Held: the second run asks for a rerun and backs off
+    assert run(["sh", "-c", first.routerLockScript()]).returncode == 75
+    assert run(["sh", "-c", first.routerUnlockScript()], capture_output=True, text=True).stdout == "rerun\n"
+    assert run(["sh", "-c", first.routerUnlockScript()], capture_output=True, text=True).stdout == ""
+
+    # Left behind by a run that died long ago
+    (tmp_path / "bpe.lock").mkdir()
+    (tmp_path / "bpe.lock" / "at").write_text("1000\n")
+    assert run(["sh", "-c", first.routerLockScript()]).returncode == 0
+    assert not (tmp_path / "bpe.lock.rerun").exists()
+
+def test_RouterObject_routerLock_held():
+    testObj = RouterObject('hostname')
+    assert testObj.acquireRouterLock(doTest=True) is True
+
+    testObj.useRouterLock()
+    assert testObj.acquireRouterLock(doTest=True, testRunReturn=CompletedProcess(args=[], returncode=75)) is False
+    with pytest.raises(RuntimeError):
+        testObj.acquireRouterLock(doTest=True, testRunReturn=CompletedProcess(args=[], returncode=255))
+
+    assert testObj.acquireRouterLock(doTest=True, testRunReturn=CompletedProcess(args=[], returncode=0))
+    testObj.releaseRouterLock(doTest=True, testRunReturn=CompletedProcess(args=[], returncode=0, stdout="rerun\n"))
+    assert testObj.takeRerunRequest()
+    assert not testObj.takeRerunRequest()
+
+def test_RouterObject_ubus(ubus_server):
+    from bpe_docker_to_openwrt.UbusClient import UbusClient
+    from bpe_docker_to_openwrt.ReconcilePlan import planChanges
+    host, port = ubus_server.server_address
+    testObj = RouterObject('hostname')
+    testObj.useUbus(UbusClient(f"http://{host}:{port}/ubus", password="secret"), fallback=False)
+
+    assert testObj.getDefinedExtraDNS() == ["/a.lan/1.1.1.1"]
+    assert testObj.LastQueryOk
+    results = testObj.applyPlan(planChanges({"a.lan": "1.1.1.9", "b.lan": "2.2.2.2"}, testObj.Mappings))
+
+    assert [r.returncode for r in results] == [0]
+    assert ubus_server.dhcp["cfg01411c"]["address"] == ["/a.lan/1.1.1.9", "/b.lan/2.2.2.2"]
+    # No ssh at all
+    assert testObj.SSHStats == {"handshakes": 0, "commands": 0}
+
+def test_RouterObject_ubus_fallback():
+    from bpe_docker_to_openwrt.UbusClient import UbusClient
+    testObj = RouterObject('hostname')
+    testObj.useUbus(UbusClient("http://127.0.0.1:1/ubus", timeout=2))
+
+    output = "dhcp.cfg01411c.address='/a.lan/1.1.1.1'\n"
+    assert testObj.getDefinedExtraDNS(doTest=True, testRunReturn=CompletedProcess(args=[], returncode=0, stdout=output)) == ["/a.lan/1.1.1.1"]
+
+    # The write falls back to rewriting the whole list over ssh
+    testObj.beginBatch()
+    testObj.addDNSMapping("b.lan", "2.2.2.2")
+    testObj.commit()
+    output = "".join(f"@@bpe-batch:{i}:0\n" for i in range(5))
+    results = testObj.applyBatch(doTest=True, testRunReturn=CompletedProcess(args=[], returncode=0, stdout=output))
+    assert [r.command for r in results] == [
+        "uci -q delete dhcp.@dnsmasq[0].address; true",
+        "uci add_list dhcp.@dnsmasq[0].address='/a.lan/1.1.1.1'",
+        "uci add_list dhcp.@dnsmasq[0].address='/b.lan/2.2.2.2'",
+        "uci commit dhcp",
+        "service dnsmasq reload",
+    ]
+
+def test_RouterObject_quotes_definitions():
+    from subprocess import run
+    testObj = RouterObject('hostname')
+    testObj.beginBatch()
+    testObj.addDNSMapping("it's.lan", "1.1.1.1")
+    command = testObj._batch[0]
+
+    assert command == "uci add_list dhcp.@dnsmasq[0].address='/it'\\''s.lan/1.1.1.1'"
+    # The shell hands uci the definition unchanged
+    echoed = run(["sh", "-c", command.replace("uci add_list dhcp.@dnsmasq[0].address=", "printf %s ")], capture_output=True, text=True)
+    assert echoed.stdout == "/it's.lan/1.1.1.1"
@@ -0,0 +1,93 @@
+import threading
+
+import pytest
+
+from bpe_docker_to_openwrt.RouterObject import BatchResult
+from bpe_docker_to_openwrt.RouterPool import runOnRouters
+from bpe_docker_to_openwrt.main import reconcileRouters, DesiredState
+
+from tests.fakes import RecordingRouter
+
+
+def test_runOnRouters_concurrent():
+    routers = [RecordingRouter({}, hostname=f"router{i}") for i in range(3)]
+    # Only passes if all three routers are being worked on at the same time
+    barrier = threading.Barrier(3, timeout=5)
+
+    def action(router):
+        barrier.wait()
+        return [BatchResult("uci commit dhcp", 0, "")]
+
+    outcomes = runOnRouters(routers, action, maxWorkers=3)
+
+    assert sorted(outcomes) == ["root@router0:22", "root@router1:22", "root@router2:22"]
+    assert all(outcome.ok for outcome in outcomes.values())
+
+def test_runOnRouters_duplicate_targets():
+    # 'openwrt.lan' and 'root@openwrt.lan:22' are the same router
+    routers = [RecordingRouter({}, hostname="openwrt.lan"), RecordingRouter({}, hostname="other.lan"), RecordingRouter({}, hostname="openwrt.lan")]
+
+    with pytest.raises(ValueError, match="root@openwrt.lan:22"):
+        runOnRouters(routers, lambda router: [])
+
+def test_runOnRouters_bounded():
+    routers = [RecordingRouter({}, hostname=f"router{i}") for i in range(6)]
+    lock = threading.Lock()
+    running = [0]
+    peak = [0]
+
+    def action(router):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        threading.Event().wait(0.02)
+        with lock:
+            running[0] -= 1
+
+    outcomes = runOnRouters(routers, action, maxWorkers=2)
+
+    assert len(outcomes) == 6
+    assert peak[0] <= 2
+
+def test_runOnRouters_failures_are_isolated():
+    routers = [RecordingRouter({}, hostname=name) for name in ("good", "raises", "badcmd")]
+
+    def action(router):
+        if router._hostname == "raises":
+            raise RuntimeError("unreachable")
+        if router._hostname == "badcmd":
+            return [BatchResult("uci commit dhcp", 0, ""), BatchResult("service dnsmasq reload", 1, "")]
+        return []
+
+    outcomes = runOnRouters(routers, action)
+
+    assert outcomes["root@good:22"].ok
+    assert not outcomes["root@raises:22"].ok
+    assert outcomes["root@raises:22"].error == "unreachable"
+    assert not outcomes["root@badcmd:22"].ok
+    assert outcomes["root@badcmd:22"].error == "1 of 2 commands failed"
+
+def test_reconcileRouters():
+    primary = RecordingRouter({"web.docker.lan": "172.18.0.5", "gone.docker.lan": "172.18.0.6"}, hostname="primary")
+    mesh = RecordingRouter({}, hostname="mesh")
+    failover = RecordingRouter({}, hostname="failover", failQuery=True)
+
+    state = DesiredState({"web.docker.lan": "172.18.0.5", "db.docker.lan": "172.18.0.9"}, ["docker.lan"])
+    outcomes = reconcileRouters([primary, mesh, failover], state)
+
+    assert primary.applied == [[
+        "uci del_list dhcp.@dnsmasq[0].address='/gone.docker.lan/172.18.0.6'",
+        "uci add_list dhcp.@dnsmasq[0].address='/db.docker.lan/172.18.0.9'",
+        "uci commit dhcp",
+        "service dnsmasq reload",
+    ]]
+    assert mesh.applied == [[
+        "uci add_list dhcp.@dnsmasq[0].address='/web.docker.lan/172.18.0.5'",
+        "uci add_list dhcp.@dnsmasq[0].address='/db.docker.lan/172.18.0.9'",
+        "uci commit dhcp",
+        "service dnsmasq reload",
+    ]]
+    # A router whose state could not be read must not be touched
+    assert failover.applied == []
+    assert outcomes["root@primary:22"].ok and outcomes["root@mesh:22"].ok
+    assert not outcomes["root@failover:22"].ok
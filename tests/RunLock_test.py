@@ -0,0 +1,76 @@
+import subprocess
+import sys
+
+from bpe_docker_to_openwrt.RunLock import RunLock
+
+
+def test_RunLock_acquire(tmp_path):
+    path = tmp_path / "locks" / "run.lock"
+    first = RunLock(path)
+    second = RunLock(path)
+
+    assert first.acquire()
+    assert not second.acquire()
+    assert second.holder().isdigit()
+    first.release()
+    assert second.acquire()
+    second.release()
+
+def test_RunLock_dies_with_its_process(tmp_path):
+    path = tmp_path / "run.lock"
+    holder = subprocess.Popen([sys.executable, "-c", f"""
+import sys, time
+from bpe_docker_to_openwrt.RunLock import RunLock
+RunLock({str(path)!r}).acquire()
+print("locked", flush=True)
+time.sleep(30)
+"""], stdout=subprocess.PIPE, text=True)
+    try:
+        assert holder.stdout.readline() == "locked\n"
+        assert not RunLock(path).acquire()
+        assert RunLock(path).holder() == str(holder.pid)
+    finally:
+        holder.kill()
+        holder.wait()
+
+    assert RunLock(path).acquire()
+
+def test_RunLock_coalesces(tmp_path):
+    path = tmp_path / "run.lock"
+    lock = RunLock(path)
+    passes = []
+
+    def action() -> bool:
+        passes.append(len(passes))
+        if len(passes) == 1:
+            # Two more runs start while the first pass is busy: both give up, asking for one more pass between them
+            assert RunLock(path).run(lambda: False) is None
+            assert RunLock(path).run(lambda: False) is None
+        return True
+
+    assert lock.run(action) is True
+    assert passes == [0, 1]
+    assert not lock.rerunRequested()
+    # Let go at the end
+    assert RunLock(path).acquire()
+
+def test_RunLock_leftover_request(tmp_path):
+    lock = RunLock(tmp_path / "run.lock")
+    # Left by a run that asked just as the last holder was letting go
+    lock.requestRerun()
+
+    assert lock.run(lambda: True) is True
+    assert not lock.RerunPath.exists()
+
+def test_RunLock_without_a_file():
+    lock = RunLock(None, maxReruns=2)
+    passes = []
+
+    def action() -> bool:
+        passes.append(True)
+        lock.requestRerun()
+        return len(passes) < 3
+
+    # Asked every time, but only goes again maxReruns times
+    assert lock.run(action) is False
+    assert len(passes) == 3
@@ -0,0 +1,45 @@
+import pytest
+
+from bpe_docker_to_openwrt.ReconcilePlan import Change, Plan
+from bpe_docker_to_openwrt.SavedPlan import PlanError, RouterPlan, SavedPlan, desiredFingerprint
+
+FINGERPRINT = "0123456789abcdef0123456789abcdef"
+
+def test_SavedPlan_roundtrip(tmp_path):
+    plan = Plan([Change("remove", "/old.docker.lan/172.18.0.4"), Change("replace", "/web.docker.lan/172.18.0.2", "/web.docker.lan/172.18.0.9"),
+                 Change("add", newDefinition="/new.docker.lan/172.18.0.8")], unchanged=3)
+    saved = SavedPlan("abc", [RouterPlan("root@openwrt.lan:22", FINGERPRINT, plan)], createdAt=1700000000.0)
+
+    path = tmp_path / "plan.json"
+    saved.save(path)
+    loaded = SavedPlan.load(path)
+
+    assert loaded == saved
+    assert [p.name for p in tmp_path.iterdir()] == ["plan.json"]
+
+def test_desiredFingerprint_ignores_order():
+    a = desiredFingerprint({"a.lan": "1.1.1.1", "b.lan": "2.2.2.2"}, ["lan", "docker.lan"], [])
+    b = desiredFingerprint({"b.lan": "2.2.2.2", "a.lan": "1.1.1.1"}, ["docker.lan", "lan"], [])
+    assert a == b
+    assert a != desiredFingerprint({"a.lan": "1.1.1.1", "b.lan": "2.2.2.3"}, ["lan", "docker.lan"], [])
+    assert a != desiredFingerprint({"a.lan": "1.1.1.1", "b.lan": "2.2.2.2"}, ["lan"], ["docker.lan"])
+
+# 'desc, text'
+testData_invalid = [
+    ("not json", "{"),
+    ("wrong format", '{"format": 99, "createdAt": 0, "dockerFingerprint": "", "routers": []}'),
+    ("missing routers", '{"format": 1, "createdAt": 0, "dockerFingerprint": ""}'),
+    ("fingerprint that is not an md5", '{"format": 1, "createdAt": 0, "dockerFingerprint": "", "routers": '
+        '[{"target": "r", "fingerprint": "$(reboot)", "changes": []}]}'),
+    ("target that is an ssh option", '{"format": 1, "createdAt": 0, "dockerFingerprint": "", "routers": '
+        f'[{{"target": "-oProxyCommand=reboot", "fingerprint": "{FINGERPRINT}", "changes": []}}]}}'),
+    ("router twice", '{"format": 1, "createdAt": 0, "dockerFingerprint": "", "routers": '
+        f'[{{"target": "r", "fingerprint": "{FINGERPRINT}", "changes": []}}, {{"target": "r", "fingerprint": "{FINGERPRINT}", "changes": []}}]}}'),
+    ("unknown action", '{"format": 1, "createdAt": 0, "dockerFingerprint": "", "routers": '
+        f'[{{"target": "r", "fingerprint": "{FINGERPRINT}", "changes": [{{"action": "wipe"}}]}}]}}'),
+]
+
+@pytest.mark.parametrize('desc, text', testData_invalid)
+def test_SavedPlan_invalid(desc, text):
+    with pytest.raises(PlanError):
+        SavedPlan.fromJson(text)
@@ -0,0 +1,32 @@
+import json
+
+from bpe_docker_to_openwrt.StateCache import StateCache
+
+
+def test_StateCache_roundtrip(tmp_path):
+    now = [1000.0]
+    cache = StateCache(tmp_path / "cache", ttl=60, clock=lambda: now[0])
+
+    assert cache.load("root@openwrt.lan:22") is None
+    cache.save("root@openwrt.lan:22", "abc123", ["'/a.lan/1.1.1.1'", "'/b.lan/2.2.2.2'"])
+
+    state = cache.load("root@openwrt.lan:22")
+    assert state is not None
+    assert (state.fingerprint, state.definitions, state.savedAt) == ("abc123", ["'/a.lan/1.1.1.1'", "'/b.lan/2.2.2.2'"], 1000.0)
+    # One file per router, named after it
+    assert [p.name for p in (tmp_path / "cache").iterdir()] == ["root_openwrt.lan_22.json"]
+
+    now[0] += 61
+    assert cache.load("root@openwrt.lan:22") is None
+
+def test_StateCache_invalidate_and_damage(tmp_path):
+    cache = StateCache(tmp_path, ttl=-1)
+    cache.save("r1", "fp", [])
+    cache.invalidate("r1")
+    cache.invalidate("r1")
+    assert cache.load("r1") is None
+
+    cache.pathFor("r2").write_text("{not json")
+    assert cache.load("r2") is None
+    cache.pathFor("r3").write_text(json.dumps({"fingerprint": "x"}))
+    assert cache.load("r3") is None
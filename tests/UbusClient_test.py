@@ -0,0 +1,48 @@
+import pytest
+
+from bpe_docker_to_openwrt.UbusClient import UbusClient, UbusError
+
+
+def clientFor(server, password: str = "secret") -> UbusClient:
+    host, port = server.server_address
+    return UbusClient(f"http://{host}:{port}/ubus", password=password)
+
+def test_UbusClient_login_once_and_keepalive(ubus_server):
+    with clientFor(ubus_server) as client:
+        sections = client.uciSections("dhcp", "dnsmasq")
+        client.uciSetAndCommit("dhcp", "cfg01411c", {"address": ["/a.lan/1.1.1.1", "/b.lan/2.2.2.2"]})
+        assert client.uciSections("dhcp", "dnsmasq")[0]["address"] == ["/a.lan/1.1.1.1", "/b.lan/2.2.2.2"]
+
+        assert [section[".name"] for section in sections] == ["cfg01411c"]
+        assert client.Stats == {"requests": 4, "logins": 1}
+    # Set and commit went out as one batched request over the same connection
+    assert ubus_server.requests == 4
+    assert ubus_server.connections == 1
+
+def test_UbusClient_relogin_on_expired_session(ubus_server):
+    client = clientFor(ubus_server)
+    client.uciSections("dhcp", "dnsmasq")
+    ubus_server.expireSessions()
+
+    assert client.uciSections("dhcp", "dnsmasq")[0][".name"] == "cfg01411c"
+    assert client.Stats["logins"] == 2
+
+# 'desc, password, failing, code'
+testData_UbusClient_errors = [
+    ("bad password", "wrong", set(), 6),
+    ("call fails", "secret", {("uci", "commit")}, 5),
+]
+
+@pytest.mark.parametrize('desc, password, failing, code', testData_UbusClient_errors)
+def test_UbusClient_errors(ubus_server, desc, password, failing, code):
+    ubus_server.failing = failing
+    client = clientFor(ubus_server, password)
+
+    with pytest.raises(UbusError) as e:
+        client.uciSetAndCommit("dhcp", "cfg01411c", {"address": []})
+    assert e.value.code == code
+
+def test_UbusClient_unreachable():
+    client = UbusClient("http://127.0.0.1:1/ubus", timeout=2)
+    with pytest.raises(OSError):
+        client.call("uci", "get", {"config": "dhcp"})
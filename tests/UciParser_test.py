@@ -0,0 +1,80 @@
+import pytest
+
+from bpe_docker_to_openwrt.UciParser import UciParseError, parseExport, parseUci, tokenize
+
+# 'text, expected'
+testData_tokenize = [
+    ("list address '/a.lan/1.1.1.1'", ["list", "address", "/a.lan/1.1.1.1"]),
+    ("option name 'two words'", ["option", "name", "two words"]),
+    (r"option name 'it'\''s'", ["option", "name", "it's"]),
+    (r'option name "say \"hi\"" # trailing comment', ["option", "name", 'say "hi"']),
+    ("'/a/1' '/b/2'   ", ["/a/1", "/b/2"]),
+    ("''", [""]),
+    ("   ", []),
+]
+
+@pytest.mark.parametrize('text, expected', testData_tokenize)
+def test_tokenize(text, expected):
+    assert tokenize(text) == expected
+
+@pytest.mark.parametrize('text', ["option name 'open", 'option name "open', "trailing \\"])
+def test_tokenize_unterminated(text):
+    with pytest.raises(UciParseError):
+        tokenize(text)
+
+EXPORT = """
+package dhcp
+
+config dnsmasq
+\toption domainneeded '1'
+\tlist address '/a.lan/1.1.1.1'
+\tlist address '/b c.lan/2.2.2.2'
+
+config dnsmasq 'guest'
+\tlist address '/g.lan/10.0.0.1'
+
+config host
+\toption name 'printer'
+\toption ip '192.168.1.20'
+"""
+
+def test_parseExport():
+    dhcp = parseExport(EXPORT)["dhcp"]
+
+    assert [(s.type, s.name, s.index) for s in dhcp.sections] == [
+        ("dnsmasq", "@dnsmasq[0]", 0), ("dnsmasq", "guest", 1), ("host", "@host[0]", 0)]
+    assert dhcp.section("@dnsmasq[0]").getList("address") == ["/a.lan/1.1.1.1", "/b c.lan/2.2.2.2"]
+    assert dhcp.section("@dnsmasq[-1]") is dhcp.section("guest")
+    assert dhcp.section("@dnsmasq[2]") is None
+    assert dhcp.section("@host[0]").get("name") == "printer"
+    # A one item list is still a list
+    assert dhcp.section("guest").lists == {"address": ["/g.lan/10.0.0.1"]}
+    assert parseUci(EXPORT) == parseExport(EXPORT)
+
+def test_parseShow():
+    text = ("dhcp.@dnsmasq[0]=dnsmasq\n"
+            "dhcp.@dnsmasq[0].domainneeded='1'\n"
+            "dhcp.@dnsmasq[0].address='/a.lan/1.1.1.1' '/b c.lan/2.2.2.2'\n"
+            "dhcp.guest=dnsmasq\n"
+            "dhcp.guest.address='/g.lan/10.0.0.1'\n")
+    dhcp = parseUci(text)["dhcp"]
+
+    assert [s.name for s in dhcp.sectionsOfType("dnsmasq")] == ["@dnsmasq[0]", "guest"]
+    assert dhcp.section("@dnsmasq[0]").getList("address") == ["/a.lan/1.1.1.1", "/b c.lan/2.2.2.2"]
+    # uci show prints a one item list like an option
+    assert dhcp.section("guest").getList("address") == ["/g.lan/10.0.0.1"]
+
+@pytest.mark.parametrize('text', ["package dhcp\n\toption orphan '1'\n", "package dhcp\nconfig\n", "garbage line\n"])
+def test_parse_rejects_malformed(text):
+    with pytest.raises(UciParseError):
+        parseUci(text)
+
+def test_parseExport_large():
+    import time
+    count = 50000
+    text = "package dhcp\n\nconfig dnsmasq\n" + "".join(f"\tlist address '/host{i}.lan/10.0.{i // 256 % 256}.{i % 256}'\n" for i in range(count))
+
+    start = time.perf_counter()
+    section = parseExport(text)["dhcp"].section("@dnsmasq[0]")
+    assert len(section.getList("address")) == count
+    assert time.perf_counter() - start < 5
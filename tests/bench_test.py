@@ -0,0 +1,40 @@
+import importlib.util
+import json
+import pathlib
+
+import pytest
+
+
+@pytest.fixture(scope="module")
+def bench():
+    path = pathlib.Path(__file__).resolve().parent.parent / "benchmarks" / "bench.py"
+    spec = importlib.util.spec_from_file_location("bench", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def test_bench_smoke(bench, tmp_path):
+    output = tmp_path / "bench.json"
+    assert bench.main(["--sizes", "10", "--repeat", "1", "--output", str(output)]) == 0
+
+    report = json.loads(output.read_text())
+    assert [r["benchmark"] for r in report["results"]] == [
+        "getContainerIPs", "namingRules", "getDefinedExtraDNS", "mappingsFromDefinitions", "findDefinitionWithDNS", "reconcile"]
+    assert all(r["size"] == 10 and r["seconds"] >= 0 for r in report["results"])
+
+def test_bench_synthetic_data(bench):
+    from subprocess import CompletedProcess
+    from bpe_docker_to_openwrt.main import getContainerIPs
+
+    parsed = getContainerIPs(doTest=True, testRunReturn=CompletedProcess(args=[], returncode=0, stdout=bench.dockerInspectOutput(20)))
+    assert len(parsed) == 20
+    assert parsed["app-10.svc"] == "172.18.0.10"
+
+    desired = bench.desiredState(200)
+    assert len(desired) == 200 - 2 + 2
+
+def test_bench_compare(bench):
+    old = {"results": [{"benchmark": "reconcile", "size": 10, "seconds": 1.0}]}
+    new = {"results": [{"benchmark": "reconcile", "size": 10, "seconds": 2.0}, {"benchmark": "other", "size": 10, "seconds": 9.0}]}
+    assert bench.compare(old, new, 1.5) == ["reconcile at 10: 1.000000s -> 2.000000s"]
+    assert bench.compare(old, new, 3) == []
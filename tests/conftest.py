@@ -0,0 +1,176 @@
+import pytest
+import json
+import socketserver
+import threading
+from http.server import BaseHTTPRequestHandler
+from typing import Any, Dict, List, Set, Tuple
+
+
+class StubDockerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path: str, routes: Dict[str, Any]):
+        self.routes = routes
+        self.requests_seen: List[str] = []
+        self.connections = 0
+        super().__init__(path, StubDockerHandler)
+
+
+class StubDockerHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def do_GET(self):
+        self.server.requests_seen.append(self.path)
+        route = self.server.routes.get(self.path.split("?")[0])
+        if route is None:
+            body = b'{"message": "page not found"}'
+            self.send_response(404)
+        else:
+            if callable(route):
+                route = route(self)
+                if route is None:
+                    return
+            body = json.dumps(route).encode()
+            self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def docker_server(tmp_path):
+    """Start a stub engine on a unix socket. Call it with a route table."""
+    servers = []
+
+    def start(routes: Dict[str, Any]) -> StubDockerServer:
+        server = StubDockerServer(str(tmp_path / f"docker{len(servers)}.sock"), routes)
+        threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def event_route():
+    """Build a route that streams docker events as a chunked response.
+
+    The stream stays open until the returned threading.Event is set, like a
+    real engine with nothing more to report.
+    """
+    release = threading.Event()
+
+    def build(events):
+        def route(handler):
+            handler.send_response(200)
+            handler.send_header("Content-Type", "application/json")
+            handler.send_header("Transfer-Encoding", "chunked")
+            handler.end_headers()
+            for event in events:
+                data = json.dumps(event).encode() + b"\n"
+                handler.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+                handler.wfile.flush()
+            release.wait(5)
+            handler.wfile.write(b"0\r\n\r\n")
+            handler.close_connection = True
+            return None
+        return route
+
+    yield build, release
+    release.set()
+
+
+class StubUbusServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """Enough of uhttpd's /ubus endpoint and rpcd to exercise uci over JSON-RPC"""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, password: str = "secret"):
+        self.password = password
+        self.sessions: Set[str] = set()
+        self.dhcp = {"cfg01411c": {".type": "dnsmasq", ".name": "cfg01411c", ".index": 0, "address": ["/a.lan/1.1.1.1"]}}
+        self.pending: Dict[str, Any] = {}
+        self.calls: List[Tuple[str, str]] = []
+        self.requests = 0
+        self.connections = 0
+        self.failing: Set[str] = set()
+        super().__init__(("127.0.0.1", 0), StubUbusHandler)
+
+    def expireSessions(self):
+        self.sessions: Set[str] = set()
+
+    def handle_call(self, session, obj, method, args):
+        self.calls.append((obj, method))
+        if (obj, method) in self.failing:
+            return {"result": [5]}
+        if obj == "session" and method == "login":
+            if args.get("password") != self.password:
+                return {"result": [6]}
+            token = f"{len(self.sessions) + 1:032x}"
+            self.sessions.add(token)
+            return {"result": [0, {"ubus_rpc_session": token}]}
+        if session not in self.sessions:
+            return {"error": {"code": -32002, "message": "Access denied"}}
+        if obj == "uci" and method == "get":
+            values = {name: section for name, section in self.dhcp.items() if section[".type"] == args.get("type")}
+            return {"result": [0, {"values": values}]}
+        if obj == "uci" and method == "set":
+            if args.get("section") not in self.dhcp:
+                return {"result": [4]}
+            self.pending.setdefault(args["section"], {}).update(args["values"])
+            return {"result": [0]}
+        if obj == "uci" and method == "commit":
+            for name, values in self.pending.items():
+                self.dhcp[name].update(values)
+            self.pending = {}
+            return {"result": [0]}
+        return {"result": [3]}
+
+
+class StubUbusHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def do_POST(self):
+        self.server.requests += 1
+        payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        requests = payload if isinstance(payload, list) else [payload]
+        replies = []
+        for request in requests:
+            reply = self.server.handle_call(*request["params"])
+            reply.update({"jsonrpc": "2.0", "id": request["id"]})
+            replies.append(reply)
+        body = json.dumps(replies if isinstance(payload, list) else replies[0]).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def ubus_server():
+    """A stub rpcd on a local port, password 'secret', one dnsmasq section"""
+    server = StubUbusServer()
+    threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,45 @@
+from typing import List, Optional
+
+from bpe_docker_to_openwrt.RouterObject import FINGERPRINT_CHANGED, BatchResult, RouterObject
+
+
+class RecordingRouter(RouterObject):
+    """Router that records each applied batch instead of running ssh"""
+
+    def __init__(self, mappings, hostname: str = "hostname", failQuery: bool = False, fingerprint: str = "0" * 32, failApply: bool = False):
+        super().__init__(hostname)
+        self._lastDefinedExtraDNS = [f"/{dns}/{ip}" for dns, ip in mappings.items()]
+        self.failQuery = failQuery
+        self.failApply = failApply
+        self.fingerprint = fingerprint
+        self.applied: List[List[str]] = []
+
+    def getDefinedExtraDNS(self, doTest=False, testRunReturn=None) -> Optional[List[str]]:
+        self._lastQueryOk = not self.failQuery
+        if self.failQuery:
+            return None
+        return list(self._lastDefinedExtraDNS)
+
+    def getDefinedExtraDNSWithFingerprint(self, doTest=False, testRunReturn=None):
+        return self.getDefinedExtraDNS(), self.fingerprint
+
+    def fingerprintGuard(self, expected: str) -> str:
+        return f"check fingerprint {expected}"
+
+    def applyBatch(self, doTest=False, testRunReturn=None):
+        batch = self._batch or []
+        self._batch = None
+        if len(batch) > 0 and batch[0].startswith("check fingerprint ") and batch[0].split()[-1] != self.fingerprint:
+            # The guard failed, so nothing after it ran
+            return [BatchResult(cmd, FINGERPRINT_CHANGED if index == 0 else 255, "") for index, cmd in enumerate(batch)]
+        if self.failApply and len(batch) > 0:
+            # The first command failed and the rest were skipped
+            return [BatchResult(cmd, 1 if index == 0 else 255, "") for index, cmd in enumerate(batch)]
+        self.applied.append(batch)
+        return []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
@@ -1,8 +1,15 @@
 import pytest
+import os
 #from subprocess import CalledProcessError
 from subprocess import CompletedProcess
 
 from bpe_docker_to_openwrt.main import getContainerIPs
+from bpe_docker_to_openwrt.main import collectContainers, DockerEndpoint, DesiredState, ownerDomain, reconcile
+from bpe_docker_to_openwrt.main import applySavedPlan, saveRouterPlans
+from bpe_docker_to_openwrt.SavedPlan import SavedPlan
+from bpe_docker_to_openwrt.Metrics import metrics
+
+from tests.fakes import RecordingRouter
 
 @pytest.mark.parametrize("testRunReturn,expected", [
     # Basic valid input
@@ -137,4 +144,363 @@ def test_getContainerIPs(testRunReturn, expected):
     container_listing = getContainerIPs(doTest=True, testRunReturn=testRunReturn)
 
     assert container_listing == expected
-    
\ No newline at end of file
+    
+@pytest.mark.parametrize("spec,expected", [
+    (None, DockerEndpoint(None, "docker.lan")),
+    ("ssh://admin@node2", DockerEndpoint("ssh://admin@node2", "docker.lan")),
+    ("tcp://10.0.0.3:2375,node3.lan", DockerEndpoint("tcp://10.0.0.3:2375", "node3.lan")),
+    (",node4.lan", DockerEndpoint(None, "node4.lan")),
+])
+def test_DockerEndpoint_fromSpec(spec, expected):
+    assert DockerEndpoint.fromSpec(spec, "docker.lan") == expected
+
+def test_collectContainers():
+    listings = {
+        "unix:///var/run/docker.sock": {"web": "172.18.0.5", "shared": "10.0.0.1", "clash": "10.0.0.2"},
+        "ssh://node2": {"web": "172.19.0.5", "shared": "10.0.0.1", "clash": "10.0.0.3"},
+        "ssh://node3": {"web": "172.20.0.5"},
+        "ssh://down": {},
+    }
+
+    def listing(endpoint):
+        if endpoint.url == "ssh://down":
+            raise OSError("connection refused")
+        return listings[endpoint.url]
+
+    endpoints = [
+        DockerEndpoint("unix:///var/run/docker.sock", "docker.lan"),
+        DockerEndpoint("ssh://node2", "docker.lan"),
+        DockerEndpoint("ssh://node3", "node3.docker.lan"),
+        DockerEndpoint("ssh://down", "down.docker.lan"),
+    ]
+    state = collectContainers(endpoints, listing=listing)
+
+    assert state.mappings == {
+        "shared.docker.lan": "10.0.0.1",
+        "web.node3.docker.lan": "172.20.0.5",
+    }
+    assert sorted(c.name for c in state.conflicts) == ["clash.docker.lan", "web.docker.lan"]
+    assert state.domains == ["docker.lan", "node3.docker.lan"]
+    assert state.frozenDomains == ["down.docker.lan"]
+    assert state.errors == {"ssh://down": "connection refused"}
+
+def test_ownerDomain():
+    domains = ["docker.lan", "node3.docker.lan"]
+    assert ownerDomain("a.node3.docker.lan", domains) == "node3.docker.lan"
+    assert ownerDomain("a.docker.lan", domains) == "docker.lan"
+    assert ownerDomain("a.lan", domains) is None
+
+def test_reconcile_leaves_frozen_and_foreign_domains_alone():
+    router = RecordingRouter({
+        "old.docker.lan": "172.18.0.1",
+        "old.down.docker.lan": "172.18.0.2",
+        "printer.lan": "192.168.1.5",
+    })
+
+    reconcile(router, {"new.docker.lan": "172.18.0.3"}, ["docker.lan"], ["down.docker.lan"])
+
+    assert router.applied == [[
+        "uci del_list dhcp.@dnsmasq[0].address='/old.docker.lan/172.18.0.1'",
+        "uci add_list dhcp.@dnsmasq[0].address='/new.docker.lan/172.18.0.3'",
+        "uci commit dhcp",
+        "service dnsmasq reload",
+    ]]
+
+def test_saved_plan_apply(tmp_path):
+    state = DesiredState({"new.docker.lan": "172.18.0.3"}, ["docker.lan"])
+    path = tmp_path / "plan.json"
+    router = RecordingRouter({"old.docker.lan": "172.18.0.1", "printer.lan": "192.168.1.5"}, fingerprint="a" * 32)
+
+    assert saveRouterPlans([router], state, str(path))
+    # Planning changes nothing
+    assert router.applied == []
+
+    saved = SavedPlan.load(path)
+    assert [str(change) for change in saved.routers[0].plan.changes] == ["- /old.docker.lan/172.18.0.1", "+ /new.docker.lan/172.18.0.3"]
+
+    # Applying needs no read of the router, just its own session
+    fresh = RecordingRouter({}, fingerprint="a" * 32)
+    assert applySavedPlan(saved, [fresh], state)
+    assert fresh.applied == [[
+        "check fingerprint " + "a" * 32,
+        "uci del_list dhcp.@dnsmasq[0].address='/old.docker.lan/172.18.0.1'",
+        "uci add_list dhcp.@dnsmasq[0].address='/new.docker.lan/172.18.0.3'",
+        "uci commit dhcp",
+        "service dnsmasq reload",
+    ]]
+
+def test_saved_plan_refuses_drift(tmp_path):
+    state = DesiredState({"new.docker.lan": "172.18.0.3"}, ["docker.lan"])
+    path = tmp_path / "plan.json"
+    assert saveRouterPlans([RecordingRouter({}, fingerprint="a" * 32)], state, str(path))
+    saved = SavedPlan.load(path)
+
+    # The router was changed behind our back
+    moved = RecordingRouter({}, fingerprint="b" * 32)
+    assert not applySavedPlan(saved, [moved], state)
+    assert moved.applied == []
+
+    # So were the containers
+    untouched = RecordingRouter({}, fingerprint="a" * 32)
+    assert not applySavedPlan(saved, [untouched], DesiredState({"new.docker.lan": "172.18.0.4"}, ["docker.lan"]))
+    assert untouched.applied == []
+
+def test_saved_plan_transport_failure_is_not_a_refusal(tmp_path, capsys):
+    state = DesiredState({"new.docker.lan": "172.18.0.3"}, ["docker.lan"])
+    path = tmp_path / "plan.json"
+    assert saveRouterPlans([RecordingRouter({}, fingerprint="a" * 32)], state, str(path))
+    saved = SavedPlan.load(path)
+
+    # ssh could not connect, so no marker came back for any command
+    unreachable = RecordingRouter({}, fingerprint="a" * 32)
+    unreachable.applyBatch = lambda doTest=False, testRunReturn=None: unreachable.parseBatchOutput(unreachable._batch or [], "")
+    assert not applySavedPlan(saved, [unreachable], state)
+    out = capsys.readouterr().out
+    assert "exit status 255" in out
+    assert "REFUSED" not in out
+
+def test_saved_plan_router_lock(tmp_path, capsys):
+    state = DesiredState({"new.docker.lan": "172.18.0.3"}, ["docker.lan"])
+    path = tmp_path / "plan.json"
+    assert saveRouterPlans([RecordingRouter({}, fingerprint="a" * 32)], state, str(path))
+    saved = SavedPlan.load(path)
+
+    locked = RecordingRouter({}, fingerprint="a" * 32)
+    locked.acquireRouterLock = lambda doTest=False, testRunReturn=None: False
+    assert not applySavedPlan(saved, [locked], state)
+    assert locked.applied == []
+    assert "router lock" in capsys.readouterr().out
+
+def test_saved_plan_not_written_on_failure(tmp_path):
+    path = tmp_path / "plan.json"
+    routers = [RecordingRouter({}, hostname="one"), RecordingRouter({}, hostname="two", failQuery=True)]
+    assert not saveRouterPlans(routers, DesiredState({"a.docker.lan": "172.18.0.3"}, ["docker.lan"]), str(path))
+    assert not path.exists()
+
+@pytest.fixture
+def enabled_metrics():
+    metrics.reset()
+    metrics.enable()
+    yield metrics
+    metrics.disable()
+    metrics.reset()
+
+def test_reconcile_metrics(enabled_metrics):
+    router = RecordingRouter({"old.docker.lan": "172.18.0.1", "same.docker.lan": "172.18.0.2"})
+
+    reconcile(router, {"same.docker.lan": "172.18.0.2", "new.docker.lan": "172.18.0.3"}, ["docker.lan"])
+    getContainerIPs(doTest=True, testRunReturn=CompletedProcess(args=[], returncode=0, stdout="web 172.18.0.5\n"))
+
+    for action, expected in [("add", 1), ("remove", 1), ("replace", 0), ("unchanged", 1)]:
+        assert enabled_metrics.counterValue("mappings", action=action, router=router.Target) == expected
+    assert enabled_metrics.counterValue("containers_discovered", source="cli") == 1
+    assert enabled_metrics.spanStats("plan", router=router.Target).count == 1
+    assert enabled_metrics.spanStats("docker_discovery", source="cli").count == 1
+
+# 'line, expected'
+testData_parseContainerLine = [
+    ("/web_app bridge=172.18.0.5, proxy=172.21.0.2,fd00::5",
+        ("web_app", {"bridge": ["172.18.0.5"], "proxy": ["172.21.0.2", "fd00::5"]})),
+    ("legacy 172.18.0.5 fe80::1", ("legacy", {"": ["172.18.0.5", "fe80::1"]})),
+    ("stopped bridge=,", ("stopped", {})),
+    ("cafe beef", None),
+    ("bad/name 172.18.0.5", None),
+    ("web bridge=999.1.1.1", None),
+    ("lonely", None),
+]
+
+@pytest.mark.parametrize('line, expected', testData_parseContainerLine)
+def test_parseContainerLine(line, expected):
+    from bpe_docker_to_openwrt.main import parseContainerLine
+    record = parseContainerLine(line)
+    if expected is None:
+        assert record is None
+    else:
+        assert (record.name, record.networks) == expected
+
+def test_parseContainerLine_families():
+    from bpe_docker_to_openwrt.main import parseContainerLine
+    assert parseContainerLine("web net=172.18.0.5,fd00::5").addresses == [("net", "172.18.0.5", 4), ("net", "fd00::5", 6)]
+
+def test_parseContainerLine_long_malformed_line_is_linear():
+    import time
+    from bpe_docker_to_openwrt.main import parseContainerLine
+    # The old nested regex backtracked on lines like this
+    line = "name" + " 1a2b" * 50000 + " !"
+    start = time.perf_counter()
+    assert parseContainerLine(line) is None
+    assert time.perf_counter() - start < 1
+
+FAKE_DOCKER = r'''#!/bin/sh
+if [ "$1" = "ps" ]; then
+    [ -n "$FAKE_DOCKER_EMPTY" ] || { echo aaa; echo bbb; }
+    exit 0
+fi
+if [ "$1" = "inspect" ]; then
+    [ "$#" -le 3 ] && { echo '"docker inspect" requires at least 1 argument.' >&2; exit 1; }
+    [ -n "$FAKE_DOCKER_HANG" ] && { echo "/web_app bridge=172.18.0.5,"; sleep 30; }
+    echo "/web_app bridge=172.18.0.5,"
+    echo "garbage"
+    echo "/db bridge=172.18.0.9, backend=10.0.0.9,"
+    [ -n "$FAKE_DOCKER_FAIL" ] && { echo "Error: No such object: ccc" >&2; exit 1; }
+    exit 0
+fi
+exit 2
+'''
+
+@pytest.fixture
+def fake_docker(tmp_path, monkeypatch):
+    bindir = tmp_path / "bin"
+    bindir.mkdir()
+    exe = bindir / "docker"
+    exe.write_text(FAKE_DOCKER)
+    exe.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bindir}:{os.environ['PATH']}")
+    return monkeypatch
+
+def test_iterContainerRecords_streams(fake_docker):
+    from bpe_docker_to_openwrt.main import iterContainerRecords
+    records = list(iterContainerRecords())
+
+    assert [(r.name, r.ips) for r in records] == [("web_app", ["172.18.0.5"]), ("db", ["172.18.0.9", "10.0.0.9"])]
+    assert getContainerIPs() == {"web-app": "172.18.0.5", "db": "172.18.0.9"}
+
+def test_iterContainerRecords_failure(fake_docker):
+    from subprocess import CalledProcessError
+    from bpe_docker_to_openwrt.main import iterContainerRecords
+    fake_docker.setenv("FAKE_DOCKER_FAIL", "1")
+
+    seen = []
+    with pytest.raises(CalledProcessError) as e:
+        for record in iterContainerRecords():
+            seen.append(record.name)
+    assert seen == ["web_app", "db"]
+    assert "No such object" in e.value.stderr
+    assert getContainerIPs() == {}
+
+def test_iterContainerRecords_timeout(fake_docker):
+    import time
+    from subprocess import TimeoutExpired
+    from bpe_docker_to_openwrt.main import iterContainerRecords
+    fake_docker.setenv("FAKE_DOCKER_HANG", "1")
+
+    start = time.monotonic()
+    seen = []
+    with pytest.raises(TimeoutExpired):
+        for record in iterContainerRecords(timeout=0.5):
+            seen.append(record.name)
+    assert time.monotonic() - start < 10
+    assert seen == ["web_app"]
+    # A listing cut short must not pass for a complete one
+    with pytest.raises(TimeoutExpired):
+        getContainerIPs(timeout=0.5)
+
+def test_collectContainers_docker_timeout_freezes_domain(fake_docker):
+    fake_docker.setenv("FAKE_DOCKER_HANG", "1")
+
+    state = collectContainers([DockerEndpoint(None, "docker.lan")], listing=lambda endpoint: getContainerIPs(timeout=0.5))
+    assert state.mappings == {}
+    assert state.frozenDomains == ["docker.lan"]
+    assert "timed out" in state.errors["local"]
+
+def test_docker_outage_removes_nothing(fake_docker, tmp_path):
+    from bpe_docker_to_openwrt.main import listingFromEndpoint, planFor
+    # No engine on the socket, and the cli fails too
+    fake_docker.setenv("DOCKER_HOST", f"unix://{tmp_path / 'missing.sock'}")
+    fake_docker.setenv("FAKE_DOCKER_FAIL", "1")
+
+    state = collectContainers([DockerEndpoint(None, "docker.lan")], listing=listingFromEndpoint)
+    assert state.frozenDomains == ["docker.lan"]
+    assert "local" in state.errors
+
+    router = RecordingRouter({"web.docker.lan": "172.18.0.5", "db.docker.lan": "172.18.0.9"})
+    router.getDefinedExtraDNS()
+    assert planFor(router, state.mappings, state.domains, state.frozenDomains).isEmpty()
+
+def test_docker_cli_nothing_running_cleans_up(fake_docker, tmp_path):
+    from bpe_docker_to_openwrt.main import listingFromEndpoint, planFor
+    # No engine on the socket, and the cli lists no containers at all
+    fake_docker.setenv("DOCKER_HOST", f"unix://{tmp_path / 'missing.sock'}")
+    fake_docker.setenv("FAKE_DOCKER_EMPTY", "1")
+
+    state = collectContainers([DockerEndpoint(None, "docker.lan")], listing=listingFromEndpoint)
+    assert state.frozenDomains == []
+    assert state.errors == {}
+
+    router = RecordingRouter({"web.docker.lan": "172.18.0.5"})
+    router.getDefinedExtraDNS()
+    plan = planFor(router, state.mappings, state.domains, state.frozenDomains)
+    assert [change.action for change in plan.changes] == ["remove"]
+
+def test_listingFromEndpoint_naming_rules(docker_server):
+    from bpe_docker_to_openwrt.main import listingFromEndpoint
+    from bpe_docker_to_openwrt.NamingRules import COMPOSE_PROJECT_LABEL, COMPOSE_SERVICE_LABEL, NamingRules
+
+    def listed(name: str, ip: str, **labels: str):
+        return {"Names": [f"/{name}"], "Labels": labels, "NetworkSettings": {"Networks": {"bridge": {"IPAddress": ip}}}}
+    server = docker_server({"/containers/json": [
+        listed("Edge_Web_1", "172.18.0.5", **{COMPOSE_PROJECT_LABEL: "edge", COMPOSE_SERVICE_LABEL: "web"}),
+        listed("Plain_DB", "172.18.0.9"),
+    ]})
+    rules = NamingRules(composeTemplate="{service}.{project}", rfc1123=True)
+
+    assert listingFromEndpoint(DockerEndpoint(f"unix://{server.server_address}", "docker.lan"), rules=rules) == {
+        "web.edge": "172.18.0.5", "plain-db": "172.18.0.9"}
+
+def test_listingFromEndpoint_swarm_needs_a_manager(docker_server):
+    from bpe_docker_to_openwrt.main import listingFromEndpoint
+    from bpe_docker_to_openwrt.DockerClient import DockerError
+    # A worker refuses swarm requests, and the docker cli is no substitute
+    server = docker_server({"/containers/json": []})
+
+    with pytest.raises(DockerError):
+        listingFromEndpoint(DockerEndpoint(f"unix://{server.server_address}", "docker.lan"), swarm=True)
+    state = collectContainers([DockerEndpoint(None, "docker.lan")], listing=lambda endpoint: listingFromEndpoint(
+        DockerEndpoint(f"unix://{server.server_address}", "docker.lan"), swarm=True))
+    assert state.frozenDomains == ["docker.lan"]
+
+def test_main_swarm_watch():
+    from bpe_docker_to_openwrt.main import main
+    assert main(["--swarm", "--watch"]) == 2
+
+def test_main_lock_file(tmp_path):
+    from bpe_docker_to_openwrt.main import main
+    from bpe_docker_to_openwrt.RunLock import RunLock
+    lock = RunLock(tmp_path / "run.lock")
+    assert lock.acquire()
+
+    # Another run is in progress: ask it to go again and leave without touching docker or the routers
+    assert main(["--lock-file", str(tmp_path / "run.lock"), "--router", "nowhere.invalid"]) == 0
+    assert lock.rerunRequested()
+    lock.release()
+
+    assert main(["--lock-file", str(tmp_path / "run.lock"), "--watch"]) == 2
+    assert main(["--lock-file", str(tmp_path / "run.lock"), "--no-lock"]) == 2
+
+def test_main_lock_by_default(tmp_path, monkeypatch):
+    from bpe_docker_to_openwrt.main import main
+    from bpe_docker_to_openwrt.RunLock import RunLock
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    lock = RunLock(tmp_path / "bpe-docker-to-openwrt" / "run.lock")
+    assert lock.acquire()
+
+    # Overlapping cron runs are kept apart without asking for it
+    assert main(["--router", "nowhere.invalid"]) == 0
+    assert lock.rerunRequested()
+    lock.release()
+
+def test_main_bad_compose_template():
+    from bpe_docker_to_openwrt.main import main
+    assert main(["--compose-template", "{service}-{image}"]) == 2
+
+def test_main_bad_router():
+    from bpe_docker_to_openwrt.main import main
+    assert main(["--router=-oProxyCommand=reboot"]) == 2
+
+def test_main_duplicate_router():
+    from bpe_docker_to_openwrt.main import main
+    assert main(["--router", "openwrt.lan", "--router", "root@openwrt.lan:22"]) == 2
+
+def test_main_hosts_shards_needs_hosts_file():
+    from bpe_docker_to_openwrt.main import main
+    assert main(["--hosts-shards"]) == 2
@@ -0,0 +1,130 @@
+import importlib.util
+import pathlib
+
+import pytest
+
+from bpe_docker_to_openwrt.ReconcilePlan import planChanges
+from bpe_docker_to_openwrt.RouterObject import RouterObject
+
+
+@pytest.fixture(scope="module")
+def simrouter():
+    path = pathlib.Path(__file__).resolve().parent.parent / "benchmarks" / "simrouter.py"
+    spec = importlib.util.spec_from_file_location("simrouter", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+@pytest.fixture
+def sim(simrouter, tmp_path):
+    sim = simrouter.Simulation(tmp_path / "sim")
+    sim.addRouter("openwrt.lan", ["/a.docker.lan/172.18.0.2", "/b.docker.lan/172.18.0.3", "/other.lan/10.0.0.1"])
+    with sim.activated():
+        yield sim
+
+def router(sim) -> RouterObject:
+    testObj = RouterObject.fromSpec("root@openwrt.lan", cmdname=sim.ssh)
+    testObj._sleep = lambda seconds: None
+    return testObj
+
+def test_simrouter_uci(simrouter, tmp_path):
+    sim = simrouter.Simulation(tmp_path)
+    uci = sim.uci(sim.addRouter("r1", ["/a.lan/1.1.1.1"]).name)
+
+    assert uci.run(["-q", "add_list", "dhcp.@dnsmasq[0].address=/it's.lan/2.2.2.2"], iter(()))[0] == 0
+    assert uci.run(["del_list", "dhcp.cfg01411c.address=/a.lan/1.1.1.1"], iter(()))[0] == 0
+    rc, shown, errors = uci.run(["show", "dhcp.cfg01411c.address"], iter(()))
+    assert shown == "dhcp.cfg01411c.address='/it'\\''s.lan/2.2.2.2'\n"
+    # Nothing committed yet
+    assert sim.addresses("r1") == ["/a.lan/1.1.1.1"]
+
+    assert uci.run(["commit", "dhcp"], iter(()))[0] == 0
+    assert sim.addresses("r1") == ["/it's.lan/2.2.2.2"]
+    assert sim.pending("r1") == []
+    assert uci.run(["batch"], iter(["add_list dhcp.@dnsmasq[0].address='/c.lan/3.3.3.3'\n", "revert dhcp\n"]))[0] == 0
+    assert sim.pending("r1") == []
+
+def test_simrouter_reconcile(sim):
+    testObj = router(sim)
+    testObj.enableConnectionReuse(sim.root / "ctl")
+
+    assert testObj.getDefinedExtraDNS() == ["/a.docker.lan/172.18.0.2", "/b.docker.lan/172.18.0.3", "/other.lan/10.0.0.1"]
+    plan = planChanges({"a.docker.lan": "172.18.0.9", "c.docker.lan": "172.18.0.4"}, testObj.Mappings,
+                       owned=lambda name: name.endswith(".docker.lan"))
+    results = testObj.applyPlan(plan)
+    testObj.closeConnection()
+
+    assert all(res.returncode == 0 for res in results)
+    assert sorted(sim.addresses()) == ["/a.docker.lan/172.18.0.9", "/c.docker.lan/172.18.0.4", "/other.lan/10.0.0.1"]
+    # Read and apply over one connection, with one commit and reload
+    assert sim.stats() == {"sessions": 2, "handshakes": 1, "commits": 1, "reloads": 1, "signals": 0}
+
+def test_simrouter_failed_commit_reverts(simrouter, tmp_path):
+    sim = simrouter.Simulation(tmp_path, fail="uci commit*")
+    sim.addRouter("openwrt.lan", ["/a.docker.lan/172.18.0.2"])
+    with sim.activated():
+        testObj = router(sim)
+        testObj.getDefinedExtraDNS()
+        results = testObj.applyPlan(planChanges({"b.docker.lan": "172.18.0.3"}, testObj.Mappings))
+
+    assert any(res.returncode != 0 for res in results)
+    assert sim.addresses() == ["/a.docker.lan/172.18.0.2"]
+    assert sim.pending() == []
+    assert sim.stats()["reloads"] == 0
+
+def test_simrouter_connect_failures(sim):
+    sim.failConnections("openwrt.lan", 2)
+    testObj = router(sim)
+
+    testObj.setTimeouts(retries=2)
+    assert len(testObj.getDefinedExtraDNS()) == 3
+    assert testObj.LastQueryOk
+
+    sim.failConnections("openwrt.lan", 3)
+    testObj.getDefinedExtraDNS()
+    assert not testObj.LastQueryOk
+
+def test_simrouter_runLoad(simrouter):
+    report = simrouter.runLoad(50, None, [], handshake=0.0, latency=0.0, uciLatency=0.0, reloadLatency=0.0, fail=None)
+
+    assert [run["exitCode"] for run in report["runs"]] == [0, 0]
+    assert report["addressesAfter"] == 50
+    # The second run finds nothing to do
+    assert report["runs"][1]["router"]["commits"] == 0
+
+def test_simrouter_router_lock(sim):
+    first, second = router(sim), router(sim)
+    for testObj in (first, second):
+        testObj.useRouterLock()
+
+    assert first.acquireRouterLock()
+    assert not second.acquireRouterLock()
+    first.releaseRouterLock()
+    # The run that backed off asked the holder to go again
+    assert first.takeRerunRequest()
+    assert second.acquireRouterLock()
+    second.releaseRouterLock()
+    assert not second.takeRerunRequest()
+
+def test_simrouter_scheduler_waits_for_router_lock(sim):
+    from bpe_docker_to_openwrt.ChangeScheduler import ChangeScheduler
+    cron, watched = router(sim), router(sim)
+    for testObj in (cron, watched):
+        testObj.useRouterLock()
+    watched.getDefinedExtraDNS()
+    scheduler = ChangeScheduler(watched, quietWindow=0)
+
+    # A one-shot run has the router: the watcher's change waits instead of racing it
+    assert cron.acquireRouterLock()
+    scheduler.scheduleAdd("c.docker.lan", "172.18.0.4")
+    assert scheduler.flush() == 0
+    assert scheduler.Pending == 1
+    assert "/c.docker.lan/172.18.0.4" not in sim.addresses()
+
+    cron.releaseRouterLock()
+    assert cron.takeRerunRequest()
+    assert scheduler.flush() == 1
+    assert "/c.docker.lan/172.18.0.4" in sim.addresses()
+    # The flush let go of the lock again
+    assert cron.acquireRouterLock()
+    cron.releaseRouterLock()
@@ -0,0 +1,58 @@
+import json
+import os
+import pathlib
+import subprocess
+import sys
+
+from bpe_docker_to_openwrt.RouterObject import RouterObject, resolveExecutable
+
+SRC = str(pathlib.Path(__file__).resolve().parent.parent / "src")
+
+# Cold import of the cli module against a cold import of the stdlib modules it is built
+# on, measured in the same process so a slow or busy host slows both. Set a little above
+# what it costs now, so the package's own import time can't quietly double; what must
+# not be imported at all is checked by LAZY_MODULES.
+REFERENCE_MODULES = ["argparse", "json", "subprocess", "typing", "dataclasses", "pathlib", "re"]
+IMPORT_BUDGET_RATIO = float(os.environ.get("BPE_IMPORT_BUDGET_RATIO", "2.0"))
+
+# Only needed once output is rendered or a particular transport is used
+LAZY_MODULES = ["rich", "http.client", "ssl", "email", "hashlib", "concurrent.futures", "tempfile",
+                "bpe_docker_to_openwrt.DockerClient", "bpe_docker_to_openwrt.UbusClient"]
+
+def runPython(*args: str) -> subprocess.CompletedProcess:
+    env = dict(os.environ, PYTHONPATH=SRC)
+    return subprocess.run([sys.executable, *args], capture_output=True, text=True, env=env, check=True)
+
+def test_import_is_lazy():
+    res = runPython("-c", "import json, sys, bpe_docker_to_openwrt.main; print(json.dumps(sorted(sys.modules)))")
+    loaded = set(json.loads(res.stdout))
+    assert [module for module in LAZY_MODULES if module in loaded] == []
+
+def test_import_time_budget():
+    # Best of a few, so one slow run on a busy machine does not fail the test
+    best = float("inf")
+    for _ in range(5):
+        res = runPython("-X", "importtime", "-c", f"import {', '.join(REFERENCE_MODULES)}; import bpe_docker_to_openwrt.main")
+        # Cumulative microseconds of each top level import
+        cumulative = {}
+        for line in res.stderr.splitlines():
+            fields = line.split("|")
+            if len(fields) == 3 and fields[1].strip().isdigit() and not fields[2].startswith("  "):
+                cumulative[fields[2].strip()] = int(fields[1])
+        reference = sum(cumulative.get(module, 0) for module in REFERENCE_MODULES)
+        best = min(best, cumulative["bpe_docker_to_openwrt.main"] / reference)
+    assert best < IMPORT_BUDGET_RATIO, best
+
+def test_banner_does_not_load_rich():
+    # Checked through richAttr's cache, so it holds whether or not rich is installed
+    res = runPython("-c", "from bpe_docker_to_openwrt.main import richAttr, run; code = run(['--hosts-shards']); "
+                          "print(code, richAttr.cache_info().currsize)")
+    assert res.stdout.splitlines()[-1] == "2 0"
+
+def test_ssh_lookup_is_cached():
+    RouterObject("one")
+    before = resolveExecutable.cache_info()
+    RouterObject("two", cmdname="ssh")
+    after = resolveExecutable.cache_info()
+    assert after.misses == before.misses
+    assert after.hits == before.hits + 1